@@ -0,0 +1,119 @@
+"""Активность пользователей без записи на каждый клик.
+
+Клик, пачка кликов и открытие приложения вызывают ActivityTracker.touch —
+это только словарь и скетч в памяти воркера:
+  * pending — telegram_id -> время последней активности с прошлого сброса;
+    раз в ACTIVITY_FLUSH_SEC (app.py) всё накопленное уходит в
+    Storage.record_activity — users.last_active одним executemany, то есть
+    не чаще раза за интервал на пользователя;
+  * на каждый день (UTC) — HyperLogLog-скетч уникальных пользователей.
+    Повторная активность за день скетч не меняет; при сбросе он сливается
+    (поэлементный max регистров) с сохранённым — activity_days в SQLite.
+    Слияние коммутативно и идемпотентно, поэтому воркеры пишут в одну
+    строку дня независимо друг от друга.
+
+DAU/WAU/MAU — объединение 1/7/30 дневных скетчей: константа по времени и
+памяти (HLL_P = 12: 4096 байт на день, ошибка ~1.6%), без обхода users.
+Несброшенная активность других воркеров видна с задержкой до интервала.
+"""
+import math
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+HLL_P = 12
+HLL_M = 1 << HLL_P
+_ALPHA = 0.7213 / (1 + 1.079 / HLL_M)
+
+
+class HyperLogLog:
+    """Оценка числа уникальных элементов; регистры — bytes/bytearray длины HLL_M"""
+
+    def __init__(self, registers: Optional[bytes] = None):
+        if registers is not None and len(registers) != HLL_M:
+            raise ValueError(f"expected {HLL_M} registers, got {len(registers)}")
+        self.registers = bytearray(registers) if registers is not None else bytearray(HLL_M)
+
+    def add(self, item) -> bool:
+        """True — регистр вырос (оценка могла измениться)"""
+        h = int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "big")
+        idx = h >> (64 - HLL_P)
+        rest = h & ((1 << (64 - HLL_P)) - 1)
+        rank = (64 - HLL_P) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        self.registers = bytearray(merge_registers(self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        zeros = self.registers.count(0)
+        estimate = _ALPHA * HLL_M * HLL_M / sum(2.0 ** -r for r in self.registers)
+        # Малые значения — linear counting по пустым регистрам
+        if estimate <= 2.5 * HLL_M and zeros:
+            estimate = HLL_M * math.log(HLL_M / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+
+def merge_registers(a: Optional[bytes], b: bytes) -> bytes:
+    """Объединение двух скетчей в байтах (a может отсутствовать)"""
+    return bytes(map(max, a, b)) if a else bytes(b)
+
+
+def utc_day() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class ActivityTracker:
+    """Активность воркера между сбросами; touch вызывается из event loop, take — тоже"""
+
+    def __init__(self):
+        self.pending: Dict[int, str] = {}
+        self.sketches: Dict[str, HyperLogLog] = {}
+
+    def touch(self, telegram_id: int):
+        now = datetime.now(timezone.utc)
+        self.pending[telegram_id] = now.strftime("%Y-%m-%d %H:%M:%S")
+        # Повторное добавление не меняет скетч: память — 4 КБ на день, сколько бы ни было пользователей
+        self.sketches.setdefault(now.strftime("%Y-%m-%d"), HyperLogLog()).add(telegram_id)
+
+    def take(self):
+        """Забрать накопленное для сброса: ({telegram_id: last_active}, {day: регистры})"""
+        pending, self.pending = self.pending, {}
+        sketches, self.sketches = self.sketches, {}
+        return pending, {day: sketch.to_bytes() for day, sketch in sketches.items()}
+
+    def restore(self, pending: Dict[int, str], days: Dict[str, bytes]):
+        """Сброс не удался — вернуть данные, чтобы ушли со следующим"""
+        for telegram_id, ts in pending.items():
+            self.pending.setdefault(telegram_id, ts)
+        for day, registers in days.items():
+            self.sketches.setdefault(day, HyperLogLog()).merge(HyperLogLog(registers))
+
+    def unflushed(self) -> Dict[str, bytes]:
+        """Скетчи этого воркера, ещё не сброшенные в хранилище"""
+        return {day: sketch.to_bytes() for day, sketch in self.sketches.items()}
+
+
+def active_users(days: Dict[str, bytes], today: str = None,
+                 windows=(("dau", 1), ("wau", 7), ("mau", 30))) -> Dict[str, int]:
+    """Уникальные пользователи за последние N дней (включая today) по дневным скетчам day -> регистры"""
+    today = datetime.strptime(today or utc_day(), "%Y-%m-%d")
+    result = {}
+    union = HyperLogLog()
+    covered = 0
+    # Окна вложены: скетч дня вливается один раз, по возрастанию окна
+    for name, n in sorted(windows, key=lambda w: w[1]):
+        while covered < n:
+            registers = days.get((today - timedelta(days=covered)).strftime("%Y-%m-%d"))
+            if registers:
+                union.merge(HyperLogLog(registers))
+            covered += 1
+        result[name] = union.count()
+    return result
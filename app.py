@@ -1,13 +1,26 @@
-from fastapi import FastAPI, HTTPException
+import time
+_BOOT_T0 = time.perf_counter()  # холодный старт воркера считаем от первого импорта
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import os, sqlite3, time, random, requests, traceback, hashlib, hmac, json
+import os, re, sqlite3, random, traceback, hashlib, hmac, json, asyncio, urllib.parse, base64, functools
+from collections import OrderedDict
 from contextlib import closing
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Tuple
+from datetime import datetime, timedelta, timezone
+from schema import ensure_schema
+import metrics
+import sqlprofile
+import sampler
+import shared_state
+import storage
+import activity
+import sessions
+import idempotency
 
 load_dotenv()
 
@@ -22,6 +35,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Профилирование SQL по запросам — только при SQL_PROFILE=1 (см. sqlprofile.py)
+if sqlprofile.SQL_PROFILE:
+    app.add_middleware(sqlprofile.QueryProfileMiddleware)
+# Снаружи всех остальных middleware: латентность меряется целиком
+app.add_middleware(metrics.MetricsMiddleware)
 
 # ---------------- PATHS ----------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -33,31 +51,90 @@ if os.path.exists(WEBAPP_DIR):
 # ---------------- ENV ----------------
 DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "data.db"))
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
+# Клики и платежи — только с токеном сессии (Authorization: Bearer, выдаёт /api/session).
+# По умолчанию обязателен, если задан токен бота; без него initData не проверить
+SESSION_REQUIRED = os.getenv("SESSION_REQUIRED", "1" if TELEGRAM_BOT_TOKEN else "0") == "1"
 
 TRONGRID_API_KEY = os.getenv("TRONGRID_API_KEY", "").strip()
 TRON_RECEIVE_ADDRESS = os.getenv("TRON_RECEIVE_ADDRESS", "").strip()
 TRC20_USDT_CONTRACT = os.getenv("TRC20_USDT_CONTRACT", "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t").strip()
-TRONGRID_BASE = "https://api.trongrid.io"
+# Переопределяется для нагрузочных тестов (fake_trongrid.py)
+TRONGRID_BASE = os.getenv("TRONGRID_BASE", "https://api.trongrid.io").rstrip("/")
 
 PAYMENT_TIME_SLOP_SEC = int(os.getenv("PAYMENT_TIME_SLOP_SEC", "300"))
 MAX_OVERPAY = float(os.getenv("MAX_OVERPAY", "1000"))
+# Неоплаченный счёт истекает через INVOICE_TTL_MIN и освобождает уникальную сумму.
+# Свипер раз в INVOICE_SWEEP_SEC закрывает истёкшие пачками по INVOICE_SWEEP_BATCH
+INVOICE_TTL_MIN = int(os.getenv("INVOICE_TTL_MIN", "60"))
+INVOICE_SWEEP_SEC = int(os.getenv("INVOICE_SWEEP_SEC", "60"))
+INVOICE_SWEEP_BATCH = int(os.getenv("INVOICE_SWEEP_BATCH", "500"))
+# Уникальных сумм на пакет: price + k/10000, k = 1..PAYMENT_AMOUNT_SLOTS
+PAYMENT_AMOUNT_SLOTS = int(os.getenv("PAYMENT_AMOUNT_SLOTS", "999"))
+
+MIN_WITHDRAW = float(os.getenv("MIN_WITHDRAW", "20"))
+
+# Если задан — /metrics требует Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+# Размер страницы чтения в /admin/payments
+ADMIN_PAGE_SIZE = 1000
+# Пул read-only соединений для GET (на воркер) и предел длительности одного чтения
+DB_READ_POOL = int(os.getenv("DB_READ_POOL", "4"))
+DB_READ_TIMEOUT_MS = int(os.getenv("DB_READ_TIMEOUT_MS", "2000"))
+# Админские эндпоинты (/admin/*) — Authorization: Bearer <ADMIN_TOKEN>; пустой — выключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+
+# Лимит тапов пользователя в секунду, общий для всех воркеров (0 — без лимита).
+# Клиент с кулдауном 120 мс даёт ~8/с, запас — на сетевые пачки
+TAP_RATE_LIMIT = int(os.getenv("TAP_RATE_LIMIT", "20"))
+# Пачки тапов клиента (/api/sync, /api/tap/batch): не больше TAP_BATCH_MAX тапов в пачке; лимит — TAP_RATE_LIMIT
+# в среднем за минуту, чтобы накопленная офлайн очередь проходила. batch_id помнится TAP_BATCH_TTL_H часов
+TAP_BATCH_MAX = int(os.getenv("TAP_BATCH_MAX", "500"))
+TAP_BATCH_TTL_H = int(os.getenv("TAP_BATCH_TTL_H", "24"))
+# last_active и скетчи DAU/WAU/MAU копятся в памяти воркера и сбрасываются раз в ACTIVITY_FLUSH_SEC (0 — выключено)
+ACTIVITY_FLUSH_SEC = float(os.getenv("ACTIVITY_FLUSH_SEC", "300"))
+# Кэш ответа /api/user/{id} в воркере, сек (0 — выключен); сбрасывается инвалидацией от любого воркера
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "5"))
+# Сколько ответов держит кэш (LRU): старые вытесняются, память не растёт с числом пользователей
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# Сети вывода (как в селекте withdrawNetwork) и грубая проверка адреса
+WITHDRAW_NETWORKS = {
+    "TRC20": re.compile(r"^T[1-9A-HJ-NP-Za-km-z]{33}$"),
+    "BEP20": re.compile(r"^0x[0-9a-fA-F]{40}$"),
+    "TON": re.compile(r"^[A-Za-z0-9_-]{48}$"),
+}
 
 # Настройки
 WELCOME_TAPS = 10000
 WELCOME_REWARD = 0.0001
+# Сколько новый пользователь может заработать кликами до покупки пакета (storage.WELCOME_CAP)
 WELCOME_CAP = 1.0
+storage.WELCOME_CAP = WELCOME_CAP
 
 # ---------------- PACKAGES ----------------
+# energy_cap / energy_regen — потолок энергии и восстановление в секунду (без пакета — storage.FREE_ENERGY_*);
+# daily_taps — кликов в день (TAP_DAY_TZ), без пакета — storage.FREE_DAILY_TAPS
 PACKAGES = {
-    1: {"name": "Новичок", "price": 10.0, "taps": 100000, "reward": 0.0002, "cap": 20.0},
-    2: {"name": "Профи", "price": 50.0, "taps": 500000, "reward": 0.00025, "cap": 125.0},
-    3: {"name": "VIP", "price": 100.0, "taps": 1000000, "reward": 0.0003, "cap": 300.0},
+    1: {"name": "Новичок", "price": 10.0, "taps": 100000, "reward": 0.0002, "cap": 20.0,
+        "energy_cap": 2000, "energy_regen": 2.0, "daily_taps": 20000},
+    2: {"name": "Профи", "price": 50.0, "taps": 500000, "reward": 0.00025, "cap": 125.0,
+        "energy_cap": 3000, "energy_regen": 3.0, "daily_taps": 50000},
+    3: {"name": "VIP", "price": 100.0, "taps": 1000000, "reward": 0.0003, "cap": 300.0,
+        "energy_cap": 5000, "energy_regen": 5.0, "daily_taps": 100000},
 }
+storage.ENERGY_LIMITS.update({p["name"]: (p["energy_cap"], p["energy_regen"]) for p in PACKAGES.values()})
+storage.DAILY_LIMITS.update({p["name"]: p["daily_taps"] for p in PACKAGES.values()})
+# Срок действия пакета после оплаты
+PACKAGE_DAYS = 30
 
 # ================== DB ==================
+DB_FACTORY = sqlprofile.ProfiledConnection if sqlprofile.SQL_PROFILE else metrics.MetricsConnection
+
 def get_db():
     """Получение соединения с БД"""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+    # file:...?mode=memory&cache=shared — общая in-memory БД (бенчмарки)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30, uri=DB_PATH.startswith("file:"),
+                           factory=DB_FACTORY)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
@@ -65,79 +142,94 @@ def get_db():
     conn.execute("PRAGMA busy_timeout=5000;")
     return conn
 
+def _open_read_db(path: str):
+    """Read-only соединение: mode=ro + query_only, без PRAGMA писателя (journal_mode, synchronous)"""
+    if path.startswith("file:"):
+        uri = path  # общая in-memory БД бенчмарков: mode=memory, защищает только query_only
+    else:
+        uri = f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro"
+    conn = sqlite3.connect(uri, check_same_thread=False, timeout=30, uri=True, factory=DB_FACTORY)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    return conn
+
+READ_POOL = storage.ReadPool(_open_read_db, DB_READ_POOL, DB_READ_TIMEOUT_MS)
+
+def read_db():
+    """Соединение для чтения из пула: with read_db() as conn: ..."""
+    return READ_POOL.connection(DB_PATH)
+
+SCHEMA_INFO: Dict[str, Any] = {}
+BOOT_INFO: Dict[str, Any] = {}
+
 def init_db():
-    """Инициализация базы данных"""
+    """Приведение схемы к текущей версии (см. schema.py); если версия совпадает — без DDL"""
+    global SCHEMA_INFO
     with closing(get_db()) as conn:
-        cur = conn.cursor()
-        
-        # Таблица пользователей
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            welcome_given BOOLEAN DEFAULT 0
-        );
-        """)
-        
-        # Таблица баланса и кликов
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_stats (
-            user_id INTEGER PRIMARY KEY,
-            balance REAL DEFAULT 0.0,
-            free_taps INTEGER DEFAULT 10000,
-            total_taps INTEGER DEFAULT 0,
-            package_taps_remaining INTEGER DEFAULT 0,
-            tap_reward REAL DEFAULT 0.0001,
-            package_type TEXT,
-            package_expires TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        );
-        """)
-        
-        # Таблица платежей
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            package_id INTEGER NOT NULL,
-            amount REAL NOT NULL,
-            unique_amount REAL NOT NULL,
-            status TEXT DEFAULT 'pending',
-            tx_hash TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            paid_at TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        );
-        """)
-        
-        # Таблица обработанных транзакций
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS processed_transactions (
-            tx_hash TEXT PRIMARY KEY,
-            payment_id INTEGER,
-            amount REAL NOT NULL,
-            timestamp INTEGER NOT NULL
-        );
-        """)
-        
-        # Индексы
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_created ON payments(created_at);")
-        
-        conn.commit()
+        SCHEMA_INFO = ensure_schema(conn)
 
 init_db()
 
+# ================== SHARED STATE ==================
+# Один воркер — в памяти процесса; serve.py --workers N — общий брокер (см. shared_state.py)
+SHARED = shared_state.create_state()
+PENDING_SET = "payments_pending"
+USER_CACHE: "OrderedDict[int, Any]" = OrderedDict()
+_pending_count: Dict[str, Any] = {"value": None}
+
+def _on_shared_message(channel: str, message: str):
+    if channel == "user":
+        USER_CACHE.pop(int(message), None)
+    elif channel == "*":
+        USER_CACHE.clear()
+
+SHARED.subscribe(_on_shared_message)
+
+def invalidate_user(telegram_id: int):
+    """Сбросить кэш пользователя во всех воркерах"""
+    if USER_CACHE_TTL:
+        SHARED.publish("user", str(telegram_id))
+
+async def _shared_call(method: str, *args):
+    """Вызов общего состояния; брокер недоступен — None вместо ошибки запроса"""
+    try:
+        return await getattr(SHARED, method)(*args)
+    except shared_state.SharedStateError as e:
+        print(f"⚠️ shared state {method}: {e}")
+        return None
+
+async def tap_allowed(telegram_id: int) -> bool:
+    if not TAP_RATE_LIMIT:
+        return True
+    count = await _shared_call("incr", f"tap:{telegram_id}:{int(time.time())}", 2.0)
+    # Без брокера лучше пропустить тап, чем отказать всем
+    return count is None or count <= TAP_RATE_LIMIT
+
+async def tap_batch_allowed(telegram_id: int, taps: int) -> bool:
+    if not TAP_RATE_LIMIT:
+        return True
+    count = await _shared_call("incr", f"tapb:{telegram_id}:{int(time.time() // 60)}", 120.0, taps)
+    return count is None or count <= TAP_RATE_LIMIT * 60
+
 # ================== MODELS ==================
+class SessionRequest(BaseModel):
+    init_data: str
+
 class TapRequest(BaseModel):
     telegram_id: int
 
+class TapBatchRequest(BaseModel):
+    telegram_id: int
+    batch_id: str
+    count: int
+
+class SyncRequest(BaseModel):
+    telegram_id: int
+    version: int
+    taps: int = 0
+    batch_id: Optional[str] = None
+
 class CreateInvoiceRequest(BaseModel):
     telegram_id: int
     package_id: int
@@ -146,85 +238,32 @@ class CheckInvoiceRequest(BaseModel):
     telegram_id: int
     invoice_id: int
 
-# ================== USER MANAGEMENT ==================
-def get_or_create_user(conn, telegram_id: int) -> int:
-    """Получить или создать пользователя, возвращает user_id"""
-    cur = conn.cursor()
-    
-    # Проверяем существующего пользователя
-    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    
-    if row:
-        return row['id']
-    
-    # Создаем нового пользователя
-    cur.execute("""
-        INSERT INTO users (telegram_id, welcome_given)
-        VALUES (?, 0)
-    """, (telegram_id,))
-    
-    user_id = cur.lastrowid
-    
-    # Создаем запись в статистике с приветственным бонусом
-    cur.execute("""
-        INSERT INTO user_stats (user_id, free_taps, tap_reward, balance)
-        VALUES (?, 10000, 0.0001, 1.0)
-    """, (user_id,))
-    
-    # Отмечаем, что бонус выдан
-    cur.execute("UPDATE users SET welcome_given = 1 WHERE id = ?", (user_id,))
-    
-    conn.commit()
-    return user_id
-
-def get_user_stats(conn, user_id: int) -> Dict:
-    """Получить статистику пользователя"""
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT 
-            us.balance,
-            us.free_taps,
-            us.total_taps,
-            us.package_taps_remaining,
-            us.tap_reward,
-            us.package_type,
-            us.package_expires,
-            u.welcome_given
-        FROM user_stats us
-        JOIN users u ON u.id = us.user_id
-        WHERE us.user_id = ?
-    """, (user_id,))
-    
-    row = cur.fetchone()
-    if not row:
-        return {
-            "balance": 0.0,
-            "free_taps": 10000,
-            "total_taps": 0,
-            "package_taps": 0,
-            "tap_reward": 0.0001,
-            "package_type": None,
-            "has_package": False,
-            "welcome_given": False
-        }
-    
-    has_package = bool(row['package_taps_remaining'] > 0 and 
-                      (not row['package_expires'] or 
-                       datetime.fromisoformat(row['package_expires']) > datetime.now()))
-    
-    return {
-        "balance": float(row['balance'] or 0),
-        "free_taps": int(row['free_taps'] or 10000),
-        "total_taps": int(row['total_taps'] or 0),
-        "package_taps": int(row['package_taps_remaining'] or 0),
-        "tap_reward": float(row['tap_reward'] or 0.0001),
-        "package_type": row['package_type'],
-        "has_package": has_package,
-        "welcome_given": bool(row['welcome_given'])
-    }
+class CreateWithdrawRequest(BaseModel):
+    telegram_id: int
+    amount: float
+    network: str
+    address: str
+    idempotency_key: Optional[str] = None
+    full_name: Optional[str] = None
+
+# ================== STORAGE ==================
+# Пользователи, клики и платежи — через storage.py (STORAGE_BACKEND=sqlite|memory)
+if storage.STORAGE_BACKEND == "memory" and shared_state.SHARED_STATE_SOCKET:
+    raise RuntimeError("STORAGE_BACKEND=memory keeps data in one process; run a single worker")
+STORAGE = storage.create_storage(get_db, read=read_db)
 
 # ================== PAYMENT HELPERS ==================
+_tron_session = None
+
+def tron_session():
+    """HTTP-сессия TronGrid: requests импортируем при первом платеже, а не при старте воркера"""
+    global _tron_session
+    if _tron_session is None:
+        import requests
+        _tron_session = requests.Session()
+        _tron_session.headers.update(tron_headers())
+    return _tron_session
+
 def tron_headers():
     headers = {"accept": "application/json"}
     if TRONGRID_API_KEY:
@@ -245,7 +284,16 @@ def check_tron_transaction(amount: float, created_at: int) -> Optional[Dict]:
             "order_by": "block_timestamp,desc"
         }
         
-        response = requests.get(url, headers=tron_headers(), params=params, timeout=15)
+        started = time.perf_counter()
+        try:
+            response = tron_session().get(url, params=params, timeout=15)
+        except Exception as e:
+            metrics.TRON_LATENCY.observe(time.perf_counter() - started, "error")
+            metrics.TRON_ERRORS.inc(type(e).__name__)
+            raise
+        metrics.TRON_LATENCY.observe(time.perf_counter() - started, response.status_code)
+        if response.status_code >= 400:
+            metrics.TRON_ERRORS.inc(f"http_{response.status_code}")
         response.raise_for_status()
         
         transactions = response.json().get("data", [])
@@ -277,7 +325,286 @@ def check_tron_transaction(amount: float, created_at: int) -> Optional[Dict]:
     
     return None
 
+# ================== INVOICE EXPIRY ==================
+def _amount_candidates(price: float):
+    """Уникальные суммы для счёта: сначала случайные, затем все подряд (занятые пропускает storage)"""
+    for k in random.sample(range(1, PAYMENT_AMOUNT_SLOTS + 1), min(32, PAYMENT_AMOUNT_SLOTS)):
+        yield round(price + k / 10000, 6)
+    for k in range(1, PAYMENT_AMOUNT_SLOTS + 1):
+        yield round(price + k / 10000, 6)
+
+def _invoice_epoch(created_at: str) -> int:
+    """created_at счёта (CURRENT_TIMESTAMP, UTC) -> unix-время"""
+    return int(datetime.strptime(created_at[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+async def expire_invoices() -> int:
+    """Истечь все просроченные счета пачками; между пачками лок записи свободен"""
+    cutoff = _sql_ago(minutes=INVOICE_TTL_MIN)
+    total = 0
+    while True:
+        ids = await asyncio.to_thread(STORAGE.expire_payments, cutoff, INVOICE_SWEEP_BATCH)
+        for payment_id in ids:
+            await _shared_call("srem", PENDING_SET, payment_id)
+        total += len(ids)
+        if len(ids) < INVOICE_SWEEP_BATCH:
+            return total
+
+def _sql_ago(**delta) -> str:
+    return (datetime.now(timezone.utc) - timedelta(**delta)).strftime("%Y-%m-%d %H:%M:%S")
+
+async def prune_tap_batches() -> int:
+    """Забыть batch_id старше TAP_BATCH_TTL_H — пачками, как истечение счетов"""
+    cutoff = _sql_ago(hours=TAP_BATCH_TTL_H)
+    total = 0
+    while True:
+        n = await asyncio.to_thread(STORAGE.prune_tap_batches, cutoff, INVOICE_SWEEP_BATCH)
+        total += n
+        if n < INVOICE_SWEEP_BATCH:
+            return total
+
+async def expire_packages() -> int:
+    """Сбросить истёкшие пакеты пачками; клик их и так не оплатит, здесь — чтобы сбросились и у неактивных"""
+    now = int(time.time())
+    total = 0
+    while True:
+        telegram_ids = await asyncio.to_thread(STORAGE.expire_packages, now, INVOICE_SWEEP_BATCH)
+        for telegram_id in telegram_ids:
+            invalidate_user(telegram_id)
+        total += len(telegram_ids)
+        if len(telegram_ids) < INVOICE_SWEEP_BATCH:
+            return total
+
+async def prune_idempotency_keys() -> int:
+    """Забыть Idempotency-Key старше IDEMPOTENCY_TTL_H — пачками"""
+    cutoff = _sql_ago(hours=idempotency.IDEMPOTENCY_TTL_H)
+    total = 0
+    while True:
+        n = await asyncio.to_thread(STORAGE.prune_requests, cutoff, INVOICE_SWEEP_BATCH)
+        total += n
+        if n < INVOICE_SWEEP_BATCH:
+            return total
+
+async def _sweeper():
+    """Фоновое обслуживание раз в INVOICE_SWEEP_SEC: счета, пакеты, старые batch_id и Idempotency-Key"""
+    while True:
+        await asyncio.sleep(INVOICE_SWEEP_SEC)
+        # Один воркер на интервал: первый, кто увеличил счётчик; без брокера — каждый сам
+        ticket = await _shared_call("incr", f"sweep:{int(time.time() // INVOICE_SWEEP_SEC)}", INVOICE_SWEEP_SEC * 2)
+        if ticket not in (None, 1):
+            continue
+        try:
+            expired = await expire_invoices()
+            packages = await expire_packages()
+            pruned = await prune_tap_batches()
+            keys = await prune_idempotency_keys()
+        except Exception as e:
+            print(f"⚠️ sweeper: {e}")
+            continue
+        if expired:
+            metrics.PAYMENTS_EXPIRED.inc(value=expired)
+            print(f"⌛ expired {expired} invoice(s) older than {INVOICE_TTL_MIN} min")
+        if packages:
+            metrics.PACKAGES_EXPIRED.inc(value=packages)
+            print(f"⌛ expired {packages} package(s)")
+        if pruned:
+            print(f"🧹 pruned {pruned} tap batch id(s) older than {TAP_BATCH_TTL_H} h")
+        if keys:
+            print(f"🧹 pruned {keys} idempotency key(s) older than {idempotency.IDEMPOTENCY_TTL_H} h")
+
+_sweeper_task: Dict[str, Any] = {"task": None}
+
+# ================== ACTIVITY ==================
+ACTIVITY = activity.ActivityTracker()
+
+def touch_activity(telegram_id: int):
+    if ACTIVITY_FLUSH_SEC > 0:
+        ACTIVITY.touch(telegram_id)
+
+async def flush_activity() -> int:
+    """Накопленная активность -> storage одной транзакцией; при ошибке вернётся в трекер"""
+    last_active, days = ACTIVITY.take()
+    if not last_active and not days:
+        return 0
+    try:
+        await asyncio.to_thread(STORAGE.record_activity, last_active, days)
+    except Exception:
+        ACTIVITY.restore(last_active, days)
+        raise
+    return len(last_active)
+
+async def _activity_flusher():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_SEC)
+        try:
+            await flush_activity()
+        except Exception as e:
+            print(f"⚠️ activity flush: {e}")
+
+_activity_task: Dict[str, Any] = {"task": None}
+
+# ================== SESSIONS ==================
+SESSIONS = sessions.SessionTokens(sessions.session_secret(TELEGRAM_BOT_TOKEN))
+
+def authorize(http: Request, telegram_id: int) -> Optional[Tuple[int, Optional[int]]]:
+    """(telegram_id, user_id) запроса по токену сессии; None — токен неверен или не для этого telegram_id.
+
+    Без токена, если SESSION_REQUIRED выключен, — telegram_id из тела и user_id None (как раньше).
+    """
+    auth = http.headers.get("authorization", "")
+    if auth.startswith("Bearer "):
+        session = SESSIONS.verify(auth[7:])
+        if session is None or session[0] != telegram_id:
+            return None
+        return session
+    if SESSION_REQUIRED:
+        return None
+    return telegram_id, None
+
+def _unauthorized() -> JSONResponse:
+    return JSONResponse(status_code=401, content={"ok": False, "error": "Unauthorized"})
+
+# ================== IDEMPOTENCY ==================
+REPLAY_CACHE = idempotency.ResponseCache()
+
+def _response_body(result) -> Tuple[int, str]:
+    """(status, JSON) ответа маршрута: dict или JSONResponse"""
+    if isinstance(result, Response):
+        return result.status_code, bytes(result.body).decode()
+    return 200, json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+
+def _replay(key: str, stored, fingerprint: str, source: str):
+    """Ответ по уже записанному ключу: 422 — другое тело, 409 — ещё выполняется, иначе сохранённый ответ"""
+    # Тот же ключ с другим телом — не повтор: чужой ответ не отдаём (NULL — ключ старше отпечатков)
+    if stored[2] is not None and stored[2] != fingerprint:
+        metrics.IDEMPOTENCY_LOOKUPS.inc("mismatch")
+        return JSONResponse(status_code=422, content={
+            "ok": False, "error": "Idempotency-Key reused with a different request"})
+    if stored[0] is None:
+        metrics.IDEMPOTENCY_LOOKUPS.inc("in_progress")
+        return JSONResponse(status_code=409, content={"ok": False, "error": "Request in progress"})
+    metrics.IDEMPOTENCY_LOOKUPS.inc(source)
+    if source == "storage":
+        REPLAY_CACHE.put(key, *stored)
+    return Response(content=stored[1], status_code=stored[0], media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+def idempotent(route: str, render=None):
+    """Маршрут с заголовком Idempotency-Key: повтор получает сохранённый ответ, не выполняясь (idempotency.py).
+
+    render(результат хранилища) -> ответ маршрута: ключ без отдельного резерва, хранилище пишет его
+    с ответом в транзакции эффекта (idempotency.Pending в http.state.idempotency).
+    """
+    def wrap(handler):
+        @functools.wraps(handler)
+        async def endpoint(request, http: Request):
+            # У закешированных страниц ключ — поле idempotency_key в теле
+            header = (http.headers.get("idempotency-key") or getattr(request, "idempotency_key", None) or "").strip()
+            if not header:
+                return await handler(request, http)
+            if not re.fullmatch(r"[A-Za-z0-9_.:-]{1,128}", header):
+                return JSONResponse(status_code=400, content={"ok": False, "error": "Invalid Idempotency-Key"})
+            # Сохранённый ответ — только тому же пользователю
+            if authorize(http, request.telegram_id) is None:
+                return _unauthorized()
+            key = idempotency.request_key(route, request.telegram_id, header)
+
+            fingerprint = idempotency.fingerprint(request.model_dump(exclude={"idempotency_key"}))
+
+            stored = REPLAY_CACHE.get(key)
+            if stored is not None:
+                return _replay(key, stored, fingerprint, "memory")
+
+            if render is not None:
+                stored = STORAGE.find_request(key)
+                if stored is not None:
+                    return _replay(key, stored, fingerprint, "storage")
+                metrics.IDEMPOTENCY_LOOKUPS.inc("miss")
+                pending = http.state.idempotency = idempotency.Pending(
+                    key, fingerprint, lambda result: _response_body(render(result)))
+                try:
+                    result = await handler(request, http)
+                except idempotency.Replay as e:
+                    # Параллельный повтор записал ключ между find_request и транзакцией
+                    return _replay(key, e.stored, fingerprint, "storage")
+                if pending.response is not None:
+                    REPLAY_CACHE.put(key, *pending.response, fingerprint)
+                return result
+
+            stored = STORAGE.claim_request(key, _sql_ago(seconds=idempotency.IDEMPOTENCY_CLAIM_SEC), fingerprint)
+            if stored is not None:
+                return _replay(key, stored, fingerprint, "storage")
+            metrics.IDEMPOTENCY_LOOKUPS.inc("miss")
+
+            try:
+                result = await handler(request, http)
+            except BaseException:
+                STORAGE.release_request(key)
+                raise
+            status, body = _response_body(result)
+            if idempotency.replayable(status):
+                STORAGE.finish_request(key, status, body)
+                REPLAY_CACHE.put(key, status, body, fingerprint)
+            else:
+                STORAGE.release_request(key)
+            return result
+        return endpoint
+    return wrap
+
+def _pending(http: Request) -> Optional[idempotency.Pending]:
+    """Ключ запроса для хранилища (маршрут с @idempotent(render=...)); None — без Idempotency-Key"""
+    return getattr(http.state, "idempotency", None)
+
 # ================== ROUTES ==================
+@app.on_event("startup")
+async def report_cold_start():
+    """Время холодного старта воркера: импорт модуля + схема, до приёма запросов"""
+    BOOT_INFO.update({
+        "pid": os.getpid(),
+        "boot_ms": round((time.perf_counter() - _BOOT_T0) * 1000, 1),
+        "schema_ms": SCHEMA_INFO.get("ms"),
+        "schema_applied": SCHEMA_INFO.get("applied"),
+    })
+    print(f"🚀 worker {BOOT_INFO['pid']} ready in {BOOT_INFO['boot_ms']} ms "
+          f"(schema v{SCHEMA_INFO.get('version')}: {SCHEMA_INFO.get('ms')} ms, applied {SCHEMA_INFO.get('applied')})")
+
+@app.on_event("startup")
+async def start_shared_state():
+    """Подключение к брокеру и заполнение множества неоплаченных счетов"""
+    global SHARED
+    try:
+        await SHARED.start()
+    except OSError as e:
+        print(f"⚠️ shared state broker {shared_state.SHARED_STATE_SOCKET} unavailable ({e}), "
+              f"falling back to per-process state")
+        SHARED = shared_state.LocalState()
+        SHARED.subscribe(_on_shared_message)
+    await _shared_call("sinit", PENDING_SET, STORAGE.pending_payment_ids())
+    print(f"🔗 shared state: {SHARED.mode}")
+
+@app.on_event("startup")
+async def start_sweeper():
+    if INVOICE_SWEEP_SEC > 0:
+        _sweeper_task["task"] = asyncio.create_task(_sweeper())
+
+@app.on_event("startup")
+async def start_activity_flusher():
+    if ACTIVITY_FLUSH_SEC > 0:
+        _activity_task["task"] = asyncio.create_task(_activity_flusher())
+
+@app.on_event("shutdown")
+async def stop_shared_state():
+    for holder in (_sweeper_task, _activity_task):
+        task = holder.pop("task", None)
+        if task is not None:
+            task.cancel()
+    try:
+        await flush_activity()
+    except Exception as e:
+        print(f"⚠️ activity flush: {e}")
+    await SHARED.close()
+    STORAGE.close()
+    READ_POOL.reset()
+
 @app.get("/")
 async def home():
     if os.path.exists(INDEX_PATH):
@@ -289,10 +616,121 @@ async def health():
     return {
         "ok": True,
         "db": os.path.exists(DB_PATH),
+        "storage": STORAGE.name,
+        "read_pool": READ_POOL.stats(),
         "tron_configured": bool(TRON_RECEIVE_ADDRESS),
+        "schema_version": SCHEMA_INFO.get("version"),
+        "boot_ms": BOOT_INFO.get("boot_ms"),
         "timestamp": int(time.time())
     }
 
+def _pending_invoices() -> int:
+    # Из общего множества (обновляется в /metrics); без брокера — из БД
+    if _pending_count["value"] is not None:
+        return _pending_count["value"]
+    return STORAGE.count_pending_payments()
+
+metrics.Gauge("payments_pending", "Invoices waiting for payment", _pending_invoices)
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """Метрики в формате Prometheus"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("authorization", ""),
+                                                 f"Bearer {METRICS_TOKEN}"):
+        return PlainTextResponse("forbidden\n", status_code=403)
+    _pending_count["value"] = await _shared_call("scard", PENDING_SET)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/debug/queries")
+async def debug_queries(request: Request, limit: int = 50):
+    """Последние сэмплированные профили SQL (SQL_PROFILE=1, Authorization: Bearer <SQL_DEBUG_TOKEN>)"""
+    token = sqlprofile.SQL_DEBUG_TOKEN
+    if not token or not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {token}"):
+        return JSONResponse(status_code=403, content={"ok": False, "error": "forbidden"})
+    recent = list(sqlprofile.RECENT)[-limit:]
+    return {"ok": True, "enabled": sqlprofile.SQL_PROFILE, "sample": sqlprofile.SQL_PROFILE_SAMPLE,
+            "slow_ms": sqlprofile.SQL_SLOW_MS, "requests": recent[::-1]}
+
+@app.post("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, hz: int = 100,
+                        format: str = "collapsed", idle: bool = False):
+    """Профиль CPU этого воркера за seconds секунд (collapsed stacks или speedscope JSON)"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return JSONResponse(status_code=403, content={"ok": False, "error": "forbidden"})
+    
+    profiler = sampler.SamplingProfiler(hz=hz, include_idle=idle)
+    try:
+        # Семплер работает в отдельном потоке, event loop в это время обслуживает запросы
+        await asyncio.to_thread(profiler.run, seconds)
+    except sampler.Busy as e:
+        return JSONResponse(status_code=409, content={"ok": False, "error": str(e)})
+    
+    summary = {"pid": os.getpid(), **profiler.summary()}
+    if format == "speedscope":
+        return JSONResponse(profiler.speedscope(f"worker {os.getpid()}"),
+                            headers={"X-Profile-Summary": json.dumps(summary)})
+    return PlainTextResponse(profiler.collapsed(), headers={"X-Profile-Summary": json.dumps(summary)})
+
+@app.get("/admin/payments")
+async def admin_payments(request: Request, status: Optional[str] = None, since: Optional[str] = None,
+                         until: Optional[str] = None, cursor: Optional[str] = None, limit: int = 0):
+    """Выгрузка платежей NDJSON по возрастанию (created_at, id), since <= created_at < until (UTC).
+    
+    Читается страницами по ADMIN_PAGE_SIZE по ключу — каждая страница короткое чтение, без OFFSET.
+    limit > 0 — не больше limit строк, последней строкой {"next": <cursor>} для продолжения.
+    """
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return JSONResponse(status_code=403, content={"ok": False, "error": "forbidden"})
+    try:
+        after = _decode_cursor(cursor) if cursor else None
+        since, until = _sql_time(since), _sql_time(until)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+    
+    def rows():
+        key, sent = after, 0
+        while True:
+            page_size = ADMIN_PAGE_SIZE if not limit else min(ADMIN_PAGE_SIZE, limit - sent)
+            page = STORAGE.scan_payments(status, since, until, after=key, limit=page_size)
+            for p in page:
+                yield json.dumps(p, ensure_ascii=False) + "\n"
+            sent += len(page)
+            if len(page) < page_size:
+                return
+            key = (page[-1]['created_at'], page[-1]['id'])
+            if limit and sent >= limit:
+                yield json.dumps({"next": _encode_cursor(page[-1])}) + "\n"
+                return
+    
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+@app.get("/admin/activity")
+async def admin_activity(request: Request, day: Optional[str] = None):
+    """Оценка DAU/WAU/MAU (HyperLogLog, ошибка ~1.6%) на день day (UTC, по умолчанию сегодня).
+
+    Читает не больше 30 дневных скетчей по 4 КБ — время не зависит от числа пользователей.
+    Несброшенная активность этого воркера учитывается, других воркеров — после их сброса.
+    """
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return JSONResponse(status_code=403, content={"ok": False, "error": "forbidden"})
+    try:
+        last = datetime.strptime(day or activity.utc_day(), "%Y-%m-%d")
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+    try:
+        first = (last - timedelta(days=29)).strftime("%Y-%m-%d")
+        last = last.strftime("%Y-%m-%d")
+        days = await asyncio.to_thread(STORAGE.activity_days, first, last)
+        for d, registers in ACTIVITY.unflushed().items():
+            if first <= d <= last:
+                days[d] = activity.merge_registers(days.get(d), registers)
+        return {"ok": True, "day": last, **activity.active_users(days, last)}
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
+        )
+
 @app.get("/api/version")
 async def version():
     return {"ok": True, "build": BUILD, "ts": int(time.time())}
@@ -307,108 +745,207 @@ async def get_packages():
         "currency": "USDT"
     }
 
+@app.post("/api/session")
+async def create_session(request: SessionRequest):
+    """initData мини-приложения -> токен сессии; дальше клики и платежи проверяют только его"""
+    if not TELEGRAM_BOT_TOKEN:
+        return {"ok": False, "error": "Sessions are not configured"}
+    init = sessions.verify_init_data(request.init_data, TELEGRAM_BOT_TOKEN)
+    if init is None:
+        return _unauthorized()
+    try:
+        telegram_id = int(init["user"]["id"])
+        user_id = STORAGE.provision_user(telegram_id)
+        token, expires = SESSIONS.issue(user_id, telegram_id)
+        return {"ok": True, "token": token, "expires": expires, "user_id": user_id, "telegram_id": telegram_id}
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
+        )
+
 @app.get("/api/user/{telegram_id}")
 async def get_user(telegram_id: int):
+    touch_activity(telegram_id)
+    cached = USER_CACHE.get(telegram_id)
+    if cached is not None:
+        if cached[0] > time.monotonic():
+            USER_CACHE.move_to_end(telegram_id)
+            return cached[1]
+        del USER_CACHE[telegram_id]
     try:
-        with closing(get_db()) as conn:
-            # Получаем или создаем пользователя
-            user_id = get_or_create_user(conn, telegram_id)
-            
-            # Получаем статистику
-            stats = get_user_stats(conn, user_id)
-            
-            return {
-                "ok": True,
-                "user_id": user_id,
-                "telegram_id": telegram_id,
-                "stats": stats
-            }
-            
+        # Получаем или создаем пользователя и его статистику
+        user_id, stats = STORAGE.load_user(telegram_id)
+        
+        result = {
+            "ok": True,
+            "user_id": user_id,
+            "telegram_id": telegram_id,
+            "stats": stats
+        }
+        if USER_CACHE_TTL:
+            USER_CACHE[telegram_id] = (time.monotonic() + USER_CACHE_TTL, result)
+            USER_CACHE.move_to_end(telegram_id)
+            if len(USER_CACHE) > USER_CACHE_SIZE:
+                USER_CACHE.popitem(last=False)
+        return result
+        
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
         )
 
+def _tap_response(result: Dict) -> Dict:
+    """Ответ /api/tap на результат apply_taps (он же сохраняется с Idempotency-Key)"""
+    if not result['taps']:
+        if result['earn_cap_remaining'] == 0:
+            return {"ok": False, "error": "Earning cap reached", "earn_cap_remaining": 0}
+        if not result['daily_taps_left']:
+            return {"ok": False, "error": "Daily tap limit reached", "daily_taps_left": 0}
+        return {"ok": False, "error": "Not enough energy", "energy": int(result['energy'])}
+    return {
+        "ok": True,
+        "earned": result['earned'],
+        "balance": result['balance'],
+        "free_taps": result['free_taps'],
+        "package_taps": result['package_taps'],
+        "total_taps": result['total_taps'],
+        "tap_reward": result['tap_reward'],
+        "energy": int(result['energy']),
+        "daily_taps_left": result['daily_taps_left'],
+        "earn_cap_remaining": result['earn_cap_remaining']
+    }
+
 @app.post("/api/tap")
-async def process_tap(request: TapRequest):
+@idempotent("tap", render=_tap_response)
+async def process_tap(request: TapRequest, http: Request):
     """Обработка клика"""
+    session = authorize(http, request.telegram_id)
+    if session is None:
+        return _unauthorized()
+    telegram_id, user_id = session
+    if not await tap_allowed(telegram_id):
+        return JSONResponse(status_code=429, content={"ok": False, "error": "Too many taps"})
     try:
-        with closing(get_db()) as conn:
-            # Начинаем транзакцию
-            conn.execute("BEGIN IMMEDIATE")
-            cur = conn.cursor()
-            
-            # Получаем user_id
-            cur.execute("SELECT id FROM users WHERE telegram_id = ?", (request.telegram_id,))
-            user_row = cur.fetchone()
-            
-            if not user_row:
-                conn.rollback()
-                return {"ok": False, "error": "User not found"}
-            
-            user_id = user_row['id']
-            
-            # Получаем текущую статистику
-            cur.execute("""
-                SELECT balance, free_taps, package_taps_remaining, tap_reward, total_taps
-                FROM user_stats 
-                WHERE user_id = ?
-            """, (user_id,))
-            
-            stats_row = cur.fetchone()
-            if not stats_row:
-                conn.rollback()
-                return {"ok": False, "error": "Stats not found"}
-            
-            balance = float(stats_row['balance'] or 0)
-            free_taps = int(stats_row['free_taps'] or 10000)
-            package_taps = int(stats_row['package_taps_remaining'] or 0)
-            tap_reward = float(stats_row['tap_reward'] or 0.0001)
-            total_taps = int(stats_row['total_taps'] or 0)
-            
-            earned = 0.0
-            new_free_taps = free_taps
-            new_package_taps = package_taps
-            
-            # Определяем тип клика и начисляем
-            if free_taps > 0:
-                # Бесплатные клики
-                earned = 0.0001
-                new_free_taps = free_taps - 1
-            elif package_taps > 0:
-                # Клики из пакета
-                earned = tap_reward
-                new_package_taps = package_taps - 1
-            else:
-                # Клики после окончания пакета
-                earned = 0.0001
-            
-            new_balance = balance + earned
-            new_total_taps = total_taps + 1
-            
-            # Обновляем статистику
-            cur.execute("""
-                UPDATE user_stats 
-                SET balance = ?,
-                    free_taps = ?,
-                    package_taps_remaining = ?,
-                    total_taps = ?
-                WHERE user_id = ?
-            """, (new_balance, new_free_taps, new_package_taps, new_total_taps, user_id))
-            
-            conn.commit()
-            
-            return {
-                "ok": True,
-                "earned": earned,
-                "balance": new_balance,
-                "free_taps": new_free_taps,
-                "package_taps": new_package_taps,
-                "total_taps": new_total_taps,
-                "tap_reward": tap_reward if package_taps > 0 else 0.0001
-            }
-            
+        # Тип клика (бесплатный / из пакета / после пакета) и начисление — storage.tap_outcome
+        result = STORAGE.apply_taps(telegram_id, user_id=user_id, request=_pending(http))
+        if result is None:
+            return {"ok": False, "error": "User not found"}
+        touch_activity(telegram_id)
+        
+        if result['taps']:
+            for tap_type, n in result['types'].items():
+                metrics.TAPS.inc(tap_type, value=n)
+            invalidate_user(telegram_id)
+        
+        return _tap_response(result)
+        
+    except idempotency.Replay:
+        raise
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
+        )
+
+@app.post("/api/tap/batch")
+@idempotent("tap_batch")
+async def process_tap_batch(request: TapBatchRequest, http: Request):
+    """Пачка тапов из очереди клиента; повтор того же batch_id не начисляет второй раз.
+
+    Текущий клиент шлёт пачки в /api/sync (те же tap_batches); маршрут оставлен для закэшированных
+    в Telegram страниц со старой очередью — их неотправленные пачки должны дойти.
+    """
+    if not (0 < request.count <= TAP_BATCH_MAX) or not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", request.batch_id):
+        return {"ok": False, "error": "Invalid batch"}
+    session = authorize(http, request.telegram_id)
+    if session is None:
+        return _unauthorized()
+    telegram_id, user_id = session
+    if not await tap_batch_allowed(telegram_id, request.count):
+        return JSONResponse(status_code=429, content={"ok": False, "error": "Too many taps"})
+    try:
+        result = STORAGE.apply_tap_batch(telegram_id, request.batch_id, request.count, user_id=user_id)
+        if result is None:
+            return {"ok": False, "error": "User not found"}
+        touch_activity(telegram_id)
+        
+        metrics.TAP_BATCHES.inc("duplicate" if result['duplicate'] else "applied")
+        if not result['duplicate']:
+            for tap_type, n in result['types'].items():
+                metrics.TAPS.inc(tap_type, value=n)
+            invalidate_user(telegram_id)
+        
+        return {
+            "ok": True,
+            "batch_id": request.batch_id,
+            # меньше count — не хватило энергии, дневной квоты или лимита заработка, остаток пачки отброшен
+            "applied": result['taps'],
+            "duplicate": result['duplicate'],
+            "earned": result['earned'],
+            "balance": result['balance'],
+            "free_taps": result['free_taps'],
+            "package_taps": result['package_taps'],
+            "total_taps": result['total_taps'],
+            "tap_reward": result['tap_reward'],
+            "energy": int(result['energy']),
+            "daily_taps_left": result['daily_taps_left'],
+            "earn_cap_remaining": result['earn_cap_remaining']
+        }
+        
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
+        )
+
+@app.post("/api/sync")
+@idempotent("sync")
+async def sync_progress(request: SyncRequest, http: Request):
+    """Синхронизация прогресса: клики, накопленные с версии version -> новая версия и изменившиеся поля.
+
+    Клиент присылает только дельту кликов, абсолютные значения (баланс и т.п.) не принимаются.
+    version -1 — состояние клиенту неизвестно, в changed придут все поля.
+    batch_id — id пачки из очереди клиента: помнится в tap_batches вместе с начислением,
+    повтор (ретрай после обрыва) не начисляет второй раз.
+    """
+    if not (0 <= request.taps <= TAP_BATCH_MAX):
+        return {"ok": False, "error": "Invalid sync"}
+    if request.batch_id is not None and not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", request.batch_id):
+        return {"ok": False, "error": "Invalid batch"}
+    session = authorize(http, request.telegram_id)
+    if session is None:
+        return _unauthorized()
+    telegram_id, user_id = session
+    if request.taps and not await tap_batch_allowed(telegram_id, request.taps):
+        return JSONResponse(status_code=429, content={"ok": False, "error": "Too many taps"})
+    try:
+        result = STORAGE.sync_taps(telegram_id, request.version, request.taps, user_id=user_id,
+                                   batch_id=request.batch_id)
+        if result is None:
+            return {"ok": False, "error": "User not found"}
+        touch_activity(telegram_id)
+        
+        if request.batch_id is not None:
+            metrics.TAP_BATCHES.inc("duplicate" if result['duplicate'] else "applied")
+        for tap_type, n in result['types'].items():
+            metrics.TAPS.inc(tap_type, value=n)
+        if result['changed']:
+            invalidate_user(telegram_id)
+        
+        return {
+            "ok": True,
+            "version": result['version'],
+            # меньше taps — не хватило энергии, дневной квоты или лимита заработка
+            "applied": result['taps'],
+            "duplicate": result['duplicate'],
+            "earned": result['earned'],
+            # stale — версия клиента устарела, в changed все поля
+            "stale": result['stale'],
+            "changed": result['changed']
+        }
+        
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -416,8 +953,11 @@ async def process_tap(request: TapRequest):
         )
 
 @app.post("/api/payments/create")
-async def create_payment(request: CreateInvoiceRequest):
+@idempotent("payment_create")
+async def create_payment(request: CreateInvoiceRequest, http: Request):
     """Создание счета на оплату"""
+    if authorize(http, request.telegram_id) is None:
+        return _unauthorized()
     try:
         # Проверяем пакет
         if request.package_id not in PACKAGES:
@@ -425,39 +965,24 @@ async def create_payment(request: CreateInvoiceRequest):
         
         package = PACKAGES[request.package_id]
         
-        with closing(get_db()) as conn:
-            # Проверяем/создаем пользователя
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM users WHERE telegram_id = ?", (request.telegram_id,))
-            user_row = cur.fetchone()
-            
-            if not user_row:
-                user_id = get_or_create_user(conn, request.telegram_id)
-            else:
-                user_id = user_row['id']
-            
-            # Создаем уникальную сумму
-            unique_amount = round(package['price'] + random.randint(1, 999) / 10000, 6)
-            
-            # Создаем запись о платеже
-            cur.execute("""
-                INSERT INTO payments (user_id, package_id, amount, unique_amount, status)
-                VALUES (?, ?, ?, ?, 'pending')
-            """, (user_id, request.package_id, package['price'], unique_amount))
-            
-            payment_id = cur.lastrowid
-            conn.commit()
-            
-            return {
-                "ok": True,
-                "payment_id": payment_id,
-                "package": package,
-                "amount": package['price'],
-                "unique_amount": unique_amount,
-                "address": TRON_RECEIVE_ADDRESS,
-                "instructions": f"Send exactly {unique_amount:.6f} USDT (TRC20)"
-            }
-            
+        # Платеж с уникальной суммой, не занятой живым счётом (пользователь создается, если его еще нет)
+        created = STORAGE.create_payment(request.telegram_id, request.package_id, package['price'],
+                                         _amount_candidates(package['price']))
+        if created is None:
+            return {"ok": False, "error": "No free payment slot, try later"}
+        payment_id, unique_amount = created
+        await _shared_call("sadd", PENDING_SET, payment_id)
+        
+        return {
+            "ok": True,
+            "payment_id": payment_id,
+            "package": package,
+            "amount": package['price'],
+            "unique_amount": unique_amount,
+            "address": TRON_RECEIVE_ADDRESS,
+            "instructions": f"Send exactly {unique_amount:.6f} USDT (TRC20)"
+        }
+        
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -465,139 +990,227 @@ async def create_payment(request: CreateInvoiceRequest):
         )
 
 @app.post("/api/payments/check")
-async def check_payment(request: CheckInvoiceRequest):
+async def check_payment(request: CheckInvoiceRequest, http: Request):
     """Проверка статуса оплаты"""
+    if authorize(http, request.telegram_id) is None:
+        return _unauthorized()
     try:
-        with closing(get_db()) as conn:
-            conn.execute("BEGIN IMMEDIATE")
-            cur = conn.cursor()
-            
-            # Находим платеж
-            cur.execute("""
-                SELECT p.*, u.telegram_id 
-                FROM payments p
-                JOIN users u ON u.id = p.user_id
-                WHERE p.id = ? AND u.telegram_id = ?
-            """, (request.invoice_id, request.telegram_id))
-            
-            payment = cur.fetchone()
-            
-            if not payment:
-                conn.rollback()
-                return {"ok": False, "error": "Payment not found"}
-            
-            # Если уже оплачен
-            if payment['status'] == 'paid':
-                conn.commit()
+        payment = STORAGE.get_payment(request.telegram_id, request.invoice_id)
+        if not payment:
+            return {"ok": False, "error": "Payment not found"}
+        
+        # Если уже оплачен
+        if payment['status'] == 'paid':
+            return {
+                "ok": True,
+                "paid": True,
+                "tx_hash": payment['tx_hash'],
+                "package": PACKAGES.get(payment['package_id'])
+            }
+        
+        # Проверяем транзакцию — вне транзакции БД, запрос в TronGrid не держит лок записи
+        tx_info = check_tron_transaction(payment['unique_amount'], _invoice_epoch(payment['created_at']))
+        
+        # Счёт закрыт свипером: сумма могла уйти новому счёту, перевод по нему — только через ручную проверку
+        if payment['status'] == 'expired':
+            return _late_payment(payment, tx_info)
+        
+        if tx_info:
+            package = PACKAGES[payment['package_id']]
+            expires_at = int(time.time()) + PACKAGE_DAYS * 86400
+            # Помечаем как оплаченный и начисляем пакет; параллельная проверка могла успеть первой
+            if not STORAGE.confirm_payment(payment['id'], tx_info, package, expires_at):
+                payment = STORAGE.get_payment(request.telegram_id, request.invoice_id)
+                if payment['status'] == 'expired':
+                    return _late_payment(payment, tx_info)
                 return {
                     "ok": True,
-                    "paid": True,
+                    "paid": payment['status'] == 'paid',
                     "tx_hash": payment['tx_hash'],
-                    "package": PACKAGES.get(payment['package_id'])
-                }
-            
-            # Проверяем транзакцию
-            payment_time = int(time.time())  # временное решение
-            tx_info = check_tron_transaction(payment['unique_amount'], payment_time)
-            
-            if tx_info:
-                # Помечаем как оплаченный
-                cur.execute("""
-                    UPDATE payments 
-                    SET status = 'paid', 
-                        tx_hash = ?,
-                        paid_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                """, (tx_info['tx_hash'], payment['id']))
-                
-                # Регистрируем транзакцию
-                cur.execute("""
-                    INSERT OR IGNORE INTO processed_transactions (tx_hash, payment_id, amount, timestamp)
-                    VALUES (?, ?, ?, ?)
-                """, (tx_info['tx_hash'], payment['id'], tx_info['amount'], tx_info['timestamp']))
-                
-                # Начисляем пакет
-                package = PACKAGES[payment['package_id']]
-                user_id = payment['user_id']
-                
-                # Обновляем статистику
-                expires_at = datetime.now() + timedelta(days=30)
-                cur.execute("""
-                    UPDATE user_stats 
-                    SET package_taps_remaining = package_taps_remaining + ?,
-                        tap_reward = ?,
-                        package_type = ?,
-                        package_expires = ?
-                    WHERE user_id = ?
-                """, (package['taps'], package['reward'], 
-                      package['name'], expires_at.isoformat(), user_id))
-                
-                conn.commit()
-                
-                return {
-                    "ok": True,
-                    "paid": True,
-                    "tx_hash": tx_info['tx_hash'],
-                    "amount": tx_info['amount'],
-                    "package": package,
-                    "message": "Package activated!"
+                    "package": package
                 }
+            invalidate_user(request.telegram_id)
+            await _shared_call("srem", PENDING_SET, payment['id'])
             
-            conn.commit()
             return {
                 "ok": True,
-                "paid": False,
-                "status": "waiting",
-                "message": "Payment not received yet"
+                "paid": True,
+                "tx_hash": tx_info['tx_hash'],
+                "amount": tx_info['amount'],
+                "package": package,
+                "message": "Package activated!"
             }
-            
+        
+        return {
+            "ok": True,
+            "paid": False,
+            "status": "waiting",
+            "message": "Payment not received yet"
+        }
+        
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
         )
 
+def _late_payment(payment: Dict, tx_info: Optional[Dict]) -> Dict:
+    if not tx_info:
+        return {"ok": True, "paid": False, "status": "expired", "message": "Invoice expired, create a new one"}
+    if STORAGE.flag_late_payment(payment['id'], tx_info):
+        metrics.PAYMENTS_LATE.inc()
+        print(f"⚠️ late transfer {tx_info['tx_hash']} ({tx_info['amount']} USDT) for expired invoice {payment['id']}")
+    return {
+        "ok": True,
+        "paid": False,
+        "status": "review",
+        "tx_hash": tx_info['tx_hash'],
+        "message": "Payment received after the invoice expired, it will be reviewed manually"
+    }
+
+# ---------------- KEYSET CURSORS ----------------
+# Курсор страницы — ключ (created_at, id) последней отданной строки; для клиента — непрозрачная строка
+def _encode_cursor(payment: Dict) -> str:
+    raw = json.dumps([payment['created_at'], payment['id']], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(token: str) -> tuple:
+    try:
+        created_at, payment_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(created_at, str) or not isinstance(payment_id, int):
+        raise ValueError("Invalid cursor")
+    return created_at, payment_id
+
+def _sql_time(value: Optional[str]) -> Optional[str]:
+    """2024-05-01 или 2024-05-01T12:00:00 -> формат CURRENT_TIMESTAMP (UTC)"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+
 @app.get("/api/payments/history/{telegram_id}")
-async def payment_history(telegram_id: int):
-    """История платежей пользователя"""
+async def payment_history(telegram_id: int, limit: int = 20, cursor: Optional[str] = None):
+    """История платежей пользователя, новые первыми; следующая страница — ?cursor=<next>"""
     try:
-        with closing(get_db()) as conn:
-            cur = conn.cursor()
-            
-            # Находим user_id
-            cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
-            user_row = cur.fetchone()
-            
-            if not user_row:
-                return {"ok": True, "payments": []}
-            
-            user_id = user_row['id']
+        limit = max(1, min(limit, 100))
+        try:
+            before = _decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+        
+        # Одна лишняя строка — признак, что есть следующая страница
+        payments = STORAGE.payment_history(telegram_id, limit=limit + 1, before=before)
+        page = payments[:limit]
+        return {
+            "ok": True,
+            "payments": [
+                {
+                    "id": p['id'],
+                    "package_id": p['package_id'],
+                    "amount": p['amount'],
+                    "status": p['status'],
+                    "created_at": p['created_at'],
+                    "paid_at": p['paid_at']
+                }
+                for p in page
+            ],
+            "next": _encode_cursor(page[-1]) if len(payments) > limit else None
+        }
+        
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"ok": False, "error": str(e)}
+        )
+
+def _withdrawal_json(w) -> Dict:
+    return {
+        "id": w['id'],
+        "amount": w['amount'],
+        "network": w['network'],
+        "address": w['address'],
+        "status": w['status'],
+        "created_at": w['created_at'],
+        "processed_at": w['processed_at']
+    }
+
+def _withdrawals_unavailable() -> JSONResponse:
+    # Выводы и выплаты (payouts.py) работают с балансом в SQLite
+    return JSONResponse(status_code=501, content={"ok": False, "error": f"Withdrawals are not available "
+                                                                       f"with {STORAGE.name} storage"})
+
+def _withdrawal_response(result: Dict) -> Dict:
+    """Ответ /api/withdraw/create на результат create_withdrawal (он же сохраняется с Idempotency-Key)"""
+    if result['withdrawal'] is None:
+        return {"ok": False, "error": "Insufficient balance"}
+    return {
+        "ok": True,
+        "withdrawal": _withdrawal_json(result['withdrawal']),
+        "balance": result['balance']
+    }
+
+@app.post("/api/withdraw/create")
+@idempotent("withdraw_create", render=_withdrawal_response)
+async def create_withdrawal(request: CreateWithdrawRequest, http: Request):
+    """Заявка на вывод: баланс списывается сразу, выплата — пачкой (payouts.py).
+
+    Ключ Idempotency-Key (у закешированных страниц — поле idempotency_key в теле) пишется
+    хранилищем в той же транзакции, что и списание: повтор второй раз не списывает.
+    """
+    if authorize(http, request.telegram_id) is None:
+        return _unauthorized()
+    if not STORAGE.in_sqlite:
+        return _withdrawals_unavailable()
+    try:
+        network = request.network.strip().upper()
+        address = request.address.strip()
+        amount = round(float(request.amount), 6)
+        
+        if network not in WITHDRAW_NETWORKS:
+            return {"ok": False, "error": "Invalid network"}
+        if not WITHDRAW_NETWORKS[network].match(address):
+            return {"ok": False, "error": "Invalid address"}
+        if amount < MIN_WITHDRAW:
+            return {"ok": False, "error": f"Minimum withdrawal is {MIN_WITHDRAW:g} USDT"}
+        
+        result = STORAGE.create_withdrawal(request.telegram_id, amount, network, address, request=_pending(http))
+        if result is None:
+            return {"ok": False, "error": "User not found"}
+        if result['withdrawal'] is not None:
+            invalidate_user(request.telegram_id)
+        
+        return _withdrawal_response(result)
             
-            # Получаем историю платежей
+    except idempotency.Replay:
+        raise
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"ok": False, "error": str(e), "trace": traceback.format_exc()[:2000]}
+        )
+
+@app.get("/api/withdraw/history/{telegram_id}")
+async def withdraw_history(telegram_id: int):
+    """История заявок на вывод"""
+    if not STORAGE.in_sqlite:
+        return _withdrawals_unavailable()
+    try:
+        with read_db() as conn:
+            cur = conn.cursor()
             cur.execute("""
-                SELECT p.* 
-                FROM payments p
-                WHERE p.user_id = ?
-                ORDER BY p.created_at DESC
+                SELECT w.*
+                FROM withdrawals w
+                JOIN users u ON u.id = w.user_id
+                WHERE u.telegram_id = ?
+                ORDER BY w.id DESC
                 LIMIT 20
-            """, (user_id,))
-            
-            payments = cur.fetchall()
+            """, (telegram_id,))
             
-            return {
-                "ok": True,
-                "payments": [
-                    {
-                        "id": p['id'],
-                        "package_id": p['package_id'],
-                        "amount": p['amount'],
-                        "status": p['status'],
-                        "created_at": p['created_at'],
-                        "paid_at": p['paid_at']
-                    }
-                    for p in payments
-                ]
-            }
+            return {"ok": True, "withdrawals": [_withdrawal_json(w) for w in cur.fetchall()]}
             
     except Exception as e:
         return JSONResponse(
@@ -605,6 +1218,12 @@ async def payment_history(telegram_id: int):
             content={"ok": False, "error": str(e)}
         )
 
+# ================== TELEGRAM WEBHOOK ==================
+# Бот может принимать апдейты этим же процессом (см. bot.py, BOT_MODE=webhook)
+if os.getenv("BOT_WEBHOOK_IN_API", "").strip() == "1" and os.getenv("BOT_TOKEN", "").strip():
+    from bot import attach_webhook, build_application
+    attach_webhook(app, build_application())
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
@@ -1,9 +1,12 @@
+import time
+_BOOT_T0 = time.perf_counter()
+
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import os, sqlite3, time, traceback
+import os, sys, sqlite3, traceback, asyncio
 from contextlib import closing
 from dotenv import load_dotenv
 from typing import Dict, Any
@@ -11,7 +14,7 @@ from datetime import datetime
 
 load_dotenv()
 
-app = FastAPI(title="TG Clicker", version="4.0")
+app = FastAPI(title="TG Clicker", version="5.0")
 
 BUILD = os.getenv("BUILD") or os.getenv("RENDER_GIT_COMMIT") or "clean"
 
@@ -25,6 +28,11 @@ app.add_middleware(
 
 # ---------------- PATHS ----------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Общая схема БД (schema.py) лежит в корне репозитория
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+from schema import ensure_schema
+import storage
+import activity
 WEBAPP_DIR = os.path.join(os.getcwd(), "webapp")
 INDEX_PATH = os.path.join(WEBAPP_DIR, "index.html")
 if os.path.exists(WEBAPP_DIR):
@@ -32,13 +40,28 @@ if os.path.exists(WEBAPP_DIR):
 
 # ---------------- ENV ----------------
 DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "data.db"))
+# last_active и скетчи DAU/WAU/MAU копятся в памяти и сбрасываются раз в ACTIVITY_FLUSH_SEC (как app.py)
+ACTIVITY_FLUSH_SEC = float(os.getenv("ACTIVITY_FLUSH_SEC", "300"))
+# Сколько кликов самое большее засчитывает одно сохранение прогресса (как пачка в app.py)
+TAP_BATCH_MAX = int(os.getenv("TAP_BATCH_MAX", "500"))
 
 # ---------------- ПАКЕТЫ ----------------
+# id — package_id в общей таблице payments (совпадает с PACKAGES в app.py);
+# cap прибавляется к лимиту заработка earn_cap_remaining, как при оплате в app.py;
+# энергия и дневная квота пакета — те же, что в app.py (storage.ENERGY_LIMITS / DAILY_LIMITS по имени)
 PACKAGES = {
-    "basic": {"name": "Новичок", "price": 10.0, "taps": 10000, "reward": 0.0002},
-    "pro": {"name": "Профи", "price": 50.0, "taps": 50000, "reward": 0.00025},
-    "max": {"name": "VIP", "price": 100.0, "taps": 100000, "reward": 0.0003},
+    "basic": {"id": 1, "name": "Новичок", "price": 10.0, "taps": 10000, "reward": 0.0002, "cap": 20.0,
+              "energy_cap": 2000, "energy_regen": 2.0, "daily_taps": 20000},
+    "pro": {"id": 2, "name": "Профи", "price": 50.0, "taps": 50000, "reward": 0.00025, "cap": 125.0,
+            "energy_cap": 3000, "energy_regen": 3.0, "daily_taps": 50000},
+    "max": {"id": 3, "name": "VIP", "price": 100.0, "taps": 100000, "reward": 0.0003, "cap": 300.0,
+            "energy_cap": 5000, "energy_regen": 5.0, "daily_taps": 100000},
 }
+storage.ENERGY_LIMITS.update({p["name"]: (p["energy_cap"], p["energy_regen"]) for p in PACKAGES.values()})
+storage.DAILY_LIMITS.update({p["name"]: p["daily_taps"] for p in PACKAGES.values()})
+PACKAGE_TYPES = {p["id"]: key for key, p in PACKAGES.items()}
+# Срок пакета; package_expires — epoch-секунды, в user_stats пишется имя пакета (как app.py)
+PACKAGE_DAYS = 30
 
 # ================== БАЗА ДАННЫХ ==================
 def get_db():
@@ -50,57 +73,49 @@ def get_db():
     conn.execute("PRAGMA busy_timeout=5000;")
     return conn
 
+SCHEMA_INFO: Dict[str, Any] = {}
+
 def init_db():
-    """Инициализация базы данных при запуске"""
+    """Приведение схемы к текущей версии (schema.py); если версия совпадает — без DDL"""
+    global SCHEMA_INFO
     with closing(get_db()) as conn:
-        cur = conn.cursor()
-        
-        # Создаем таблицу users если её нет
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                first_name TEXT,
-                lang TEXT DEFAULT 'ru',
-                balance REAL DEFAULT 0.0,
-                free_taps_left INTEGER DEFAULT 10000,
-                paid_taps_left INTEGER DEFAULT 0,
-                tap_value REAL DEFAULT 0.0001,
-                withdraw_address TEXT,
-                created_at INTEGER DEFAULT (strftime('%s','now')),
-                total_taps INTEGER DEFAULT 0,
-                last_active TEXT,
-                package_expires TEXT,
-                package_type TEXT,
-                daily_taps INTEGER DEFAULT 0,
-                welcome_given BOOLEAN DEFAULT 0
-            )
-        """)
-        
-        # Создаем таблицу payments если её нет
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                package_type TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP
-            )
-        """)
-        
-        # Индексы для быстрого поиска
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_telegram ON payments(telegram_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)")
-        
-        conn.commit()
-        print("✅ База данных инициализирована")
+        SCHEMA_INFO = ensure_schema(conn)
+    print(f"✅ База данных: схема v{SCHEMA_INFO['version']} ({SCHEMA_INFO['ms']} ms)")
 
 # Инициализируем базу при старте
 init_db()
 
+STORAGE = storage.SQLiteStorage(get_db)
+
+# ================== АКТИВНОСТЬ ==================
+# Не UPDATE users на каждый клик: activity.ActivityTracker, сброс — Storage.record_activity
+ACTIVITY = activity.ActivityTracker()
+_activity_task: Dict[str, Any] = {"task": None}
+
+def touch_activity(telegram_id: int):
+    if ACTIVITY_FLUSH_SEC > 0:
+        ACTIVITY.touch(telegram_id)
+
+async def flush_activity() -> int:
+    """Накопленная активность -> storage одной транзакцией; при ошибке вернётся в трекер"""
+    last_active, days = ACTIVITY.take()
+    if not last_active and not days:
+        return 0
+    try:
+        await asyncio.to_thread(STORAGE.record_activity, last_active, days)
+    except Exception:
+        ACTIVITY.restore(last_active, days)
+        raise
+    return len(last_active)
+
+async def _activity_flusher():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_SEC)
+        try:
+            await flush_activity()
+        except Exception as e:
+            print(f"⚠️ activity flush: {e}")
+
 # ================== МОДЕЛИ ==================
 class TapRequest(BaseModel):
     telegram_id: int
@@ -110,6 +125,7 @@ class BuyPackageRequest(BaseModel):
     package_type: str = "basic"
 
 class SaveProgressRequest(BaseModel):
+    # Старый клиент шлёт абсолютные значения; используется только total_taps (см. save_progress)
     telegram_id: int
     balance: float = 0.0
     free_taps_left: int = 0
@@ -117,46 +133,29 @@ class SaveProgressRequest(BaseModel):
     total_taps: int = 0
 
 # ================== ХЕЛПЕРЫ ==================
-def get_or_create_user(conn, telegram_id: int):
-    """Получить или создать пользователя"""
-    cur = conn.cursor()
-    
-    # Проверяем существующего пользователя
-    cur.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    
-    if row:
-        return telegram_id
-    
-    # Создаем нового пользователя с приветственным бонусом
-    cur.execute("""
-        INSERT INTO users (
-            telegram_id, balance, free_taps_left, tap_value, welcome_given, last_active
-        ) VALUES (?, 1.0, 10000, 0.0001, 1, datetime('now'))
-    """, (telegram_id,))
-    
-    conn.commit()
-    return telegram_id
+def get_or_create_user(conn, telegram_id: int) -> int:
+    """Получить или создать пользователя, возвращает user_id.
+
+    Создание — storage.get_or_create_user: тот же приветственный бонус и лимит заработка (WELCOME_CAP), что в app.py
+    """
+    return storage.get_or_create_user(conn, telegram_id)
 
 def get_user_stats(conn, telegram_id: int) -> Dict:
     """Получить статистику пользователя"""
     cur = conn.cursor()
     cur.execute("""
         SELECT 
-            balance,
-            free_taps_left as free_taps,
-            total_taps,
-            paid_taps_left as package_taps,
-            tap_value as tap_reward,
-            package_type,
-            CASE 
-                WHEN package_expires IS NOT NULL AND datetime(package_expires) > datetime('now') 
-                THEN 1 
-                ELSE 0 
-            END as has_package,
-            welcome_given
-        FROM users 
-        WHERE telegram_id = ?
+            us.balance,
+            us.free_taps,
+            us.total_taps,
+            us.package_taps_remaining as package_taps,
+            us.tap_reward,
+            us.package_type,
+            us.package_expires,
+            u.welcome_given
+        FROM users u
+        JOIN user_stats us ON us.user_id = u.id
+        WHERE u.telegram_id = ?
     """, (telegram_id,))
     
     row = cur.fetchone()
@@ -173,13 +172,17 @@ def get_user_stats(conn, telegram_id: int) -> Dict:
             "welcome_given": True
         }
     
-    return dict(row)
+    stats = dict(row)
+    expires = stats.pop("package_expires")
+    # Как storage.stats_json: есть клики пакета и срок (epoch) не истёк
+    stats["has_package"] = int(bool(stats["package_taps"]) and storage.package_active(expires))
+    return stats
 
 # ================== ROUTES ==================
 @app.get("/")
 async def root():
     """Корневой endpoint"""
-    return {"app": "TG Clicker", "status": "running", "version": "4.0"}
+    return {"app": "TG Clicker", "status": "running", "version": "5.0"}
 
 @app.get("/api/health")
 async def health_check():
@@ -193,6 +196,8 @@ async def health_check():
         return {
             "ok": True,
             "db": db_ok,
+            "schema_version": SCHEMA_INFO.get("version"),
+            "boot_ms": BOOT_MS,
             "timestamp": int(time.time())
         }
     except Exception as e:
@@ -216,14 +221,15 @@ async def get_user(telegram_id: int):
     try:
         with closing(get_db()) as conn:
             # Получаем или создаем пользователя
-            get_or_create_user(conn, telegram_id)
+            user_id = get_or_create_user(conn, telegram_id)
             
             # Получаем статистику
             stats = get_user_stats(conn, telegram_id)
+            touch_activity(telegram_id)
             
             return {
                 "ok": True,
-                "user_id": 1,  # Для совместимости
+                "user_id": user_id,
                 "telegram_id": telegram_id,
                 "stats": stats
             }
@@ -238,71 +244,29 @@ async def get_user(telegram_id: int):
 async def process_tap(request: TapRequest):
     """Обработка клика"""
     try:
-        with closing(get_db()) as conn:
-            conn.execute("BEGIN IMMEDIATE")
-            cur = conn.cursor()
-            
-            # Получаем текущие данные пользователя
-            cur.execute("""
-                SELECT balance, free_taps_left, paid_taps_left, tap_value, total_taps
-                FROM users 
-                WHERE telegram_id = ?
-            """, (request.telegram_id,))
-            
-            user_row = cur.fetchone()
-            if not user_row:
-                conn.rollback()
-                return {"ok": False, "error": "User not found"}
-            
-            balance = float(user_row['balance'] or 0)
-            free_taps = int(user_row['free_taps_left'] or 10000)
-            paid_taps = int(user_row['paid_taps_left'] or 0)
-            tap_reward = float(user_row['tap_value'] or 0.0001)
-            total_taps = int(user_row['total_taps'] or 0)
-            
-            earned = 0.0
-            new_free_taps = free_taps
-            new_paid_taps = paid_taps
-            
-            # Определяем тип клика и начисляем
-            if free_taps > 0:
-                # Бесплатные клики
-                earned = 0.0001
-                new_free_taps = free_taps - 1
-            elif paid_taps > 0:
-                # Клики из пакета
-                earned = tap_reward
-                new_paid_taps = paid_taps - 1
-            else:
-                # Клики после окончания пакета
-                earned = 0.0001
-            
-            new_balance = balance + earned
-            new_total_taps = total_taps + 1
-            
-            # Обновляем данные пользователя
-            cur.execute("""
-                UPDATE users 
-                SET balance = ?,
-                    free_taps_left = ?,
-                    paid_taps_left = ?,
-                    total_taps = ?,
-                    last_active = datetime('now')
-                WHERE telegram_id = ?
-            """, (new_balance, new_free_taps, new_paid_taps, new_total_taps, request.telegram_id))
-            
-            conn.commit()
-            
-            return {
-                "ok": True,
-                "earned": earned,
-                "balance": new_balance,
-                "free_taps": new_free_taps,
-                "package_taps": new_paid_taps,
-                "total_taps": new_total_taps,
-                "tap_reward": tap_reward
-            }
-            
+        # Тип клика, энергия, дневная квота и лимит заработка — storage.tap_outcome, как в app.py
+        result = STORAGE.apply_taps(request.telegram_id)
+        if result is None:
+            return {"ok": False, "error": "User not found"}
+        touch_activity(request.telegram_id)
+        if not result['taps']:
+            if result['earn_cap_remaining'] == 0:
+                return {"ok": False, "error": "Earning cap reached", "earn_cap_remaining": 0}
+            if not result['daily_taps_left']:
+                return {"ok": False, "error": "Daily tap limit reached", "daily_taps_left": 0}
+            return {"ok": False, "error": "Not enough energy", "energy": int(result['energy'])}
+        
+        return {
+            "ok": True,
+            "earned": result['earned'],
+            "balance": result['balance'],
+            "free_taps": result['free_taps'],
+            "package_taps": result['package_taps'],
+            "total_taps": result['total_taps'],
+            "tap_reward": result['tap_reward'],
+            "earn_cap_remaining": result['earn_cap_remaining']
+        }
+        
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -312,42 +276,43 @@ async def process_tap(request: TapRequest):
 @app.post("/api/buy-package")
 async def buy_package(request: BuyPackageRequest):
     """Покупка пакета тапов"""
+    # Проверяем тип пакета — до транзакции, откатывать нечего
+    if request.package_type not in PACKAGES:
+        return JSONResponse(
+            status_code=400,
+            content={"ok": False, "error": "Invalid package type"}
+        )
+    package = PACKAGES[request.package_type]
+    
     try:
         with closing(get_db()) as conn:
             conn.execute("BEGIN IMMEDIATE")
             cur = conn.cursor()
             
-            # Проверяем существование пользователя
-            get_or_create_user(conn, request.telegram_id)
-            
-            # Проверяем тип пакета
-            if request.package_type not in PACKAGES:
-                conn.rollback()
-                return JSONResponse(
-                    status_code=400,
-                    content={"ok": False, "error": "Invalid package type"}
-                )
-            
-            package = PACKAGES[request.package_type]
+            # Пользователь создаётся в той же транзакции, что и покупка (ensure_user не коммитит)
+            user_id = storage.ensure_user(conn, request.telegram_id)
             
             # Создаем запись о платеже
             cur.execute("""
-                INSERT INTO payments (telegram_id, amount, package_type, status, completed_at)
-                VALUES (?, ?, ?, 'completed', datetime('now'))
-            """, (request.telegram_id, package["price"], request.package_type))
+                INSERT INTO payments (user_id, package_id, amount, unique_amount, status, paid_at)
+                VALUES (?, ?, ?, ?, 'paid', datetime('now'))
+            """, (user_id, package["id"], package["price"], package["price"]))
             
             # Обновляем данные пользователя
             cur.execute("""
-                UPDATE users 
-                SET paid_taps_left = paid_taps_left + ?,
-                    tap_value = ?,
+                UPDATE user_stats 
+                SET package_taps_remaining = package_taps_remaining + ?,
+                    tap_reward = ?,
                     package_type = ?,
-                    package_expires = datetime('now', '+30 days'),
-                    last_active = datetime('now')
-                WHERE telegram_id = ?
-            """, (package["taps"], package["reward"], request.package_type, request.telegram_id))
+                    package_expires = ?,
+                    earn_cap_remaining = COALESCE(earn_cap_remaining, 0) + ?,
+                    version = version + 1
+                WHERE user_id = ?
+            """, (package["taps"], package["reward"], package["name"],
+                  int(time.time()) + PACKAGE_DAYS * 86400, package["cap"], user_id))
             
             conn.commit()
+            touch_activity(request.telegram_id)
             
             return {
                 "ok": True,
@@ -366,50 +331,31 @@ async def buy_package(request: BuyPackageRequest):
 
 @app.post("/api/save-progress")
 async def save_progress(request: SaveProgressRequest):
-    """Сохранение прогресса пользователя"""
+    """Сохранение прогресса пользователя.
+
+    Присланные баланс и счётчики не записываются: из total_taps берётся только прирост
+    к серверному счётчику (не больше TAP_BATCH_MAX), и он проходит путь /api/sync в app.py —
+    Storage.sync_taps, запись с проверкой версии строки.
+    """
     try:
         with closing(get_db()) as conn:
-            cur = conn.cursor()
-            
-            # Обновляем данные пользователя
-            cur.execute("""
-                UPDATE users 
-                SET balance = ?,
-                    free_taps_left = ?,
-                    paid_taps_left = ?,
-                    total_taps = ?,
-                    last_active = datetime('now')
-                WHERE telegram_id = ?
-            """, (
-                request.balance,
-                request.free_taps_left,
-                request.paid_taps_left,
-                request.total_taps,
-                request.telegram_id
-            ))
-            
-            if cur.rowcount == 0:
-                # Если пользователь не найден, создаем его
-                cur.execute("""
-                    INSERT INTO users (
-                        telegram_id, balance, free_taps_left, paid_taps_left, 
-                        total_taps, last_active, welcome_given
-                    ) VALUES (?, ?, ?, ?, ?, datetime('now'), 1)
-                """, (
-                    request.telegram_id,
-                    request.balance,
-                    request.free_taps_left,
-                    request.paid_taps_left,
-                    request.total_taps
-                ))
-            
-            conn.commit()
-            
-            return {
-                "ok": True,
-                "message": "Прогресс сохранен",
-                "timestamp": datetime.now().isoformat()
-            }
+            # Если пользователь не найден, создаем его
+            user_id = get_or_create_user(conn, request.telegram_id)
+            row = conn.execute("SELECT total_taps FROM user_stats WHERE user_id = ?", (user_id,)).fetchone()
+        
+        taps = max(0, min(request.total_taps - int(row['total_taps'] or 0), TAP_BATCH_MAX))
+        # version -1: состояние клиента неизвестно — в ответ все поля
+        result = STORAGE.sync_taps(request.telegram_id, -1, taps, user_id=user_id)
+        touch_activity(request.telegram_id)
+        
+        return {
+            "ok": True,
+            "message": "Прогресс сохранен",
+            "applied": result['taps'],
+            "version": result['version'],
+            "stats": result['changed'],
+            "timestamp": datetime.now().isoformat()
+        }
             
     except Exception as e:
         return JSONResponse(
@@ -421,13 +367,20 @@ async def save_progress(request: SaveProgressRequest):
 async def create_payment(telegram_id: int, amount: float, package_type: str = "basic"):
     """Создание платежа (для совместимости)"""
     try:
+        if package_type not in PACKAGES:
+            return JSONResponse(
+                status_code=400,
+                content={"ok": False, "error": "Invalid package type"}
+            )
+        
         with closing(get_db()) as conn:
             cur = conn.cursor()
+            user_id = get_or_create_user(conn, telegram_id)
             
             cur.execute("""
-                INSERT INTO payments (telegram_id, amount, package_type, status)
-                VALUES (?, ?, ?, 'pending')
-            """, (telegram_id, amount, package_type))
+                INSERT INTO payments (user_id, package_id, amount, unique_amount, status)
+                VALUES (?, ?, ?, ?, 'pending')
+            """, (user_id, PACKAGES[package_type]["id"], amount, amount))
             
             payment_id = cur.lastrowid
             
@@ -453,18 +406,21 @@ async def check_payment(payment_id: int):
             cur = conn.cursor()
             
             cur.execute("""
-                SELECT telegram_id, amount, package_type, status, created_at
-                FROM payments 
-                WHERE id = ?
+                SELECT u.telegram_id, p.amount, p.package_id, p.status, p.created_at
+                FROM payments p
+                JOIN users u ON u.id = p.user_id
+                WHERE p.id = ?
             """, (payment_id,))
             
             payment = cur.fetchone()
             if not payment:
                 return {"ok": False, "error": "Payment not found"}
             
+            payment = dict(payment)
+            payment["package_type"] = PACKAGE_TYPES.get(payment.pop("package_id"))
             return {
                 "ok": True,
-                "payment": dict(payment)
+                "payment": payment
             }
             
     except Exception as e:
@@ -473,6 +429,30 @@ async def check_payment(payment_id: int):
             content={"ok": False, "error": str(e)}
         )
 
+BOOT_MS = None
+
+@app.on_event("startup")
+async def report_cold_start():
+    """Время холодного старта воркера: импорт модуля + схема"""
+    global BOOT_MS
+    BOOT_MS = round((time.perf_counter() - _BOOT_T0) * 1000, 1)
+    print(f"🚀 worker {os.getpid()} ready in {BOOT_MS} ms")
+
+@app.on_event("startup")
+async def start_activity_flusher():
+    if ACTIVITY_FLUSH_SEC > 0:
+        _activity_task["task"] = asyncio.create_task(_activity_flusher())
+
+@app.on_event("shutdown")
+async def stop_activity_flusher():
+    task = _activity_task.pop("task", None)
+    if task is not None:
+        task.cancel()
+    try:
+        await flush_activity()
+    except Exception as e:
+        print(f"⚠️ activity flush: {e}")
+
 # ================== STATIC FILES ==================
 @app.get("/{full_path:path}")
 async def serve_static(full_path: str):
@@ -487,5 +467,5 @@ async def serve_static(full_path: str):
 
 if __name__ == "__main__":
     import uvicorn
-    print("🚀 Запуск TG Clicker версии 4.0")
+    print("🚀 Запуск TG Clicker версии 5.0")
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
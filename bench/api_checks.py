@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Проверки HTTP-маршрутов app.py через TestClient: сессия и Idempotency-Key.
+
+    python bench/api_checks.py
+
+app импортируется с TELEGRAM_BOT_TOKEN — как в проде, сессия обязательна
+(SESSION_REQUIRED). Проверки: запрос без токена (с Idempotency-Key и без)
+не списывает баланс и не тапает; повтор вывода и тапа с тем же ключом
+(заголовок или поле тела у закешированной страницы) не выполняется второй
+раз, ключ записан вместе с эффектом; тот же ключ с другим телом — 422, и из
+LRU воркера, и из хранилища; некорректный ключ — 400. Код выхода 1, если
+хоть одна проверка не прошла.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TG = 400_000_001
+ADDRESS = "T" + "a" * 33
+
+CHECKS = []
+
+
+def check(name: str):
+    def register(fn):
+        CHECKS.append((name, fn))
+        return fn
+    return register
+
+
+def expect(cond, message: str):
+    if not cond:
+        raise AssertionError(message)
+
+
+class Ctx:
+    def __init__(self, app, client):
+        self.app, self.client = app, client
+        self.user_id, _ = app.STORAGE.load_user(TG)
+        token, _ = app.SESSIONS.issue(self.user_id, TG)
+        self.auth = {"Authorization": f"Bearer {token}"}
+
+    def balance(self) -> float:
+        return self.app.STORAGE.load_user(TG)[1]["balance"]
+
+    def credit(self, amount: float):
+        with self.app.get_db() as conn:
+            conn.execute("UPDATE user_stats SET balance = balance + ? WHERE user_id = ?", (amount, self.user_id))
+        self.app.invalidate_user(TG)
+
+    def withdraw(self, amount: float, headers=None, **body):
+        return self.client.post("/api/withdraw/create", headers=headers or {}, json={
+            "telegram_id": TG, "amount": amount, "network": "TRC20", "address": ADDRESS, **body})
+
+
+@check("withdraw.requires_session")
+def _withdraw_requires_session(ctx):
+    ctx.credit(100)
+    before = ctx.balance()
+    r = ctx.withdraw(50)
+    expect(r.status_code == 401, f"tokenless withdrawal without Idempotency-Key: {r.status_code} {r.text}")
+    r = ctx.withdraw(50, {"Idempotency-Key": "no-session"})
+    expect(r.status_code == 401, f"tokenless withdrawal with Idempotency-Key: {r.status_code} {r.text}")
+    expect(ctx.balance() == before, f"balance {before} -> {ctx.balance()}")
+
+
+@check("tap.requires_session")
+def _tap_requires_session(ctx):
+    r = ctx.client.post("/api/tap", json={"telegram_id": TG})
+    expect(r.status_code == 401, f"tokenless tap: {r.status_code} {r.text}")
+
+
+def replayed(r) -> bool:
+    return r.headers.get("Idempotent-Replayed") == "true"
+
+
+@check("withdraw.dedupe")
+def _withdraw_dedupe(ctx):
+    ctx.credit(100)
+    before = ctx.balance()
+    first = ctx.withdraw(30, {**ctx.auth, "Idempotency-Key": "w-1"})
+    expect(first.json()["ok"] and not replayed(first), f"first: {first.text}")
+    # Ключ записан той же транзакцией, что и списание — без резерва
+    with ctx.app.get_db() as conn:
+        status = conn.execute("SELECT status FROM idempotency_keys WHERE key = ?",
+                              (f"withdraw_create:{TG}:w-1",)).fetchone()
+    expect(status is not None and status[0] == 200, f"idempotency_keys row: {status and tuple(status)}")
+    again = ctx.withdraw(30, {**ctx.auth, "Idempotency-Key": "w-1"})
+    expect(replayed(again) and again.json() == first.json(), f"retry: {again.text}")
+    # Закешированная страница шлёт ключ только в теле — та же заявка, и мимо LRU воркера
+    ctx.app.REPLAY_CACHE.items.clear()
+    cached = ctx.withdraw(30, ctx.auth, idempotency_key="w-1")
+    expect(replayed(cached) and cached.json() == first.json(), f"body key: {cached.text}")
+    expect(abs(ctx.balance() - (before - 30)) < 1e-9, f"balance {before} -> {ctx.balance()}")
+
+
+@check("withdraw.key_mismatch")
+def _withdraw_key_mismatch(ctx):
+    ctx.credit(100)
+    ctx.withdraw(25, {**ctx.auth, "Idempotency-Key": "w-2"})
+    before = ctx.balance()
+    r = ctx.withdraw(40, {**ctx.auth, "Idempotency-Key": "w-2"})
+    expect(r.status_code == 422, f"other amount, same key: {r.status_code} {r.text}")
+    expect(ctx.balance() == before, f"balance {before} -> {ctx.balance()}")
+
+
+@check("tap.dedupe")
+def _tap_dedupe(ctx):
+    headers = {**ctx.auth, "Idempotency-Key": "t-1"}
+    first = ctx.client.post("/api/tap", headers=headers, json={"telegram_id": TG})
+    expect(first.json()["ok"] and not replayed(first), f"first: {first.text}")
+    taps = ctx.app.STORAGE.load_user(TG)[1]["total_taps"]
+    ctx.app.REPLAY_CACHE.items.clear()
+    again = ctx.client.post("/api/tap", headers=headers, json={"telegram_id": TG})
+    expect(replayed(again) and again.json() == first.json(), f"retry: {again.text}")
+    expect(ctx.app.STORAGE.load_user(TG)[1]["total_taps"] == taps, "retried tap applied again")
+
+
+@check("idempotency.invalid_key")
+def _idempotency_invalid_key(ctx):
+    headers = {**ctx.auth, "Idempotency-Key": "bad key!"}
+    r = ctx.client.post("/api/tap", headers=headers, json={"telegram_id": TG})
+    expect(r.status_code == 400, f"tap: {r.status_code} {r.text}")
+    before = ctx.balance()
+    r = ctx.withdraw(25, ctx.auth, idempotency_key="bad key!")
+    expect(r.status_code == 400, f"withdraw body key: {r.status_code} {r.text}")
+    expect(ctx.balance() == before, f"balance {before} -> {ctx.balance()}")
+
+
+@check("idempotency.key_mismatch")
+def _idempotency_key_mismatch(ctx):
+    headers = {**ctx.auth, "Idempotency-Key": "p-1"}
+    first = ctx.client.post("/api/payments/create", headers=headers, json={"telegram_id": TG, "package_id": 1})
+    expect(first.status_code == 200 and first.json()["ok"], f"first: {first.text}")
+    again = ctx.client.post("/api/payments/create", headers=headers, json={"telegram_id": TG, "package_id": 1})
+    expect(again.headers.get("Idempotent-Replayed") == "true" and again.json() == first.json(), f"retry: {again.text}")
+    other = {"telegram_id": TG, "package_id": 2}
+    r = ctx.client.post("/api/payments/create", headers=headers, json=other)
+    expect(r.status_code == 422, f"worker LRU: {r.status_code} {r.text}")
+    ctx.app.REPLAY_CACHE.items.clear()
+    r = ctx.client.post("/api/payments/create", headers=headers, json=other)
+    expect(r.status_code == 422, f"storage: {r.status_code} {r.text}")
+
+
+def main():
+    data_dir = tempfile.mkdtemp()
+    os.environ.update(DB_PATH=os.path.join(data_dir, "api.db"), STORAGE_BACKEND="sqlite",
+                      TELEGRAM_BOT_TOKEN="123456:api-checks", SESSION_REQUIRED="1", TAP_RATE_LIMIT="0")
+    import app
+    from fastapi.testclient import TestClient
+
+    failures = []
+    try:
+        with TestClient(app.app) as client:
+            ctx = Ctx(app, client)
+            for name, fn in CHECKS:
+                try:
+                    fn(ctx)
+                    print(f"  ok    {name}", flush=True)
+                except Exception as e:
+                    failures.append(name)
+                    print(f"  FAIL  {name}: {e}", flush=True)
+                    if not isinstance(e, AssertionError):
+                        traceback.print_exc()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"{len(CHECKS) - len(failures)}/{len(CHECKS)} checks passed")
+    if failures:
+        print("failed: " + ", ".join(failures))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
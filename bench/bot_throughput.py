@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Пропускная способность бота: polling против webhook на фейковом Bot API.
+
+    python bench/bot_throughput.py --mode polling --concurrency 1
+    python bench/bot_throughput.py --mode polling --concurrency 64
+    python bench/bot_throughput.py --mode webhook --concurrency 64 --backend-latency-ms 50
+
+Фейковый API (fake_telegram.py) крутится в отдельном потоке, бот — в основном
+event loop. Меряем время от инъекции апдейтов до последнего sendMessage.
+
+Заодно проверяется главное обещание PerUserUpdateProcessor: апдейты одного
+пользователя (--per-user штук) обрабатываются по порядку прихода и не
+пересекаются. Обработчики в группах -1 и 1 отмечают начало и конец обработки;
+нарушения — в order_violations, код выхода 1.
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    p.add_argument("--concurrency", type=int, default=64)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--per-user", type=int, default=3)
+    p.add_argument("--backend-latency-ms", type=int, default=20)
+    p.add_argument("--tg-latency-ms", type=int, default=5)
+    p.add_argument("--fake-port", type=int, default=8081)
+    p.add_argument("--webhook-port", type=int, default=8082)
+    p.add_argument("--timeout", type=float, default=300)
+    return p.parse_args()
+
+
+def start_server(app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def track(events: list, kind: str):
+    """Обработчик-отметка: (user_id, update_id, begin|end) в порядке выполнения"""
+    async def callback(update, context):
+        events.append((update.effective_user.id, update.update_id, kind))
+    return callback
+
+
+def order_violations(events: list) -> int:
+    """Пользователи, у которых обработка шла не строго begin/end по возрастанию update_id"""
+    per_user = {}
+    for user_id, update_id, kind in events:
+        per_user.setdefault(user_id, []).append((update_id, kind))
+    return sum(seq != [(u, k) for u in sorted({u for u, _ in seq}) for k in ("begin", "end")]
+               for seq in per_user.values())
+
+
+async def run(args):
+    import httpx
+    import bot
+    from fake_telegram import create_fake_app
+
+    fake_base = f"http://127.0.0.1:{args.fake_port}"
+    fake_server = start_server(create_fake_app(args.tg_latency_ms, args.backend_latency_ms), args.fake_port)
+
+    # Модульные константы bot.py читаются при импорте — подменяем напрямую
+    bot.BACKEND_URL = fake_base
+    bot.BOT_CONCURRENCY = args.concurrency
+    application = bot.build_application(token="123:FAKE", base_url=f"{fake_base}/bot")
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    events = []
+    application.add_handler(TypeHandler(Update, track(events, "begin")), group=-1)
+    application.add_handler(TypeHandler(Update, track(events, "end")), group=1)
+
+    webhook_server = None
+    if args.mode == "webhook":
+        from fastapi import FastAPI
+
+        # Публичный адрес = локальный порт, set_webhook уйдёт в фейк
+        api = FastAPI()
+        bot.attach_webhook(api, application, path="/hook", secret="bench",
+                           public_url=f"http://127.0.0.1:{args.webhook_port}")
+        webhook_server = start_server(api, args.webhook_port)
+    else:
+        await application.initialize()
+        await application.post_init(application)
+        await application.updater.start_polling(poll_interval=0, timeout=10)
+        await application.start()
+
+    expected = args.users * args.per_user
+    async with httpx.AsyncClient(base_url=fake_base, timeout=30) as client:
+        await client.post("/fake/inject", json={"users": args.users, "per_user": args.per_user})
+        deadline = time.monotonic() + args.timeout
+        stats = {}
+        while time.monotonic() < deadline:
+            stats = (await client.get("/fake/stats")).json()
+            # Отметка end идёт после sendMessage — ждём и её
+            if stats["sent"] >= expected and len(events) >= 2 * expected:
+                break
+            await asyncio.sleep(0.05)
+
+    if webhook_server is not None:
+        webhook_server.should_exit = True
+    else:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+    fake_server.should_exit = True
+
+    return {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "updates": expected,
+        "sent": stats.get("sent"),
+        "elapsed_sec": stats.get("elapsed_sec"),
+        "updates_per_sec": stats.get("rate_per_sec"),
+        "webhook_errors": stats.get("webhook_errors"),
+        "order_violations": order_violations(events),
+        "backend_latency_ms": args.backend_latency_ms,
+        "tg_latency_ms": args.tg_latency_ms,
+    }
+
+
+def main():
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result["order_violations"] else 0)
+
+
+if __name__ == "__main__":
+    main()
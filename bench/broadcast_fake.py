@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Сквозная проверка рассылки на фейковом Bot API.
+
+    python bench/broadcast_fake.py --users 600 --rate 25 --fake-limit 30 --interrupt-after 5
+
+Создаёт временную БД с N пользователями, включает в фейке лимит 30 msg/s
+и несколько заблокировавших бота юзеров, прерывает рассылку на середине,
+затем возобновляет её и сверяет, что каждый доступный юзер получил сообщение.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=600)
+    p.add_argument("--blocked", type=int, default=10)
+    p.add_argument("--rate", type=float, default=25)
+    p.add_argument("--fake-limit", type=int, default=30)
+    p.add_argument("--chunk", type=int, default=100)
+    p.add_argument("--interrupt-after", type=float, default=5)
+    p.add_argument("--fake-port", type=int, default=8083)
+    return p.parse_args()
+
+
+def seed_db(path: str, users: int):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER UNIQUE NOT NULL)")
+    conn.executemany("INSERT INTO users (telegram_id) VALUES (?)", ((10_000 + i,) for i in range(users)))
+    conn.commit()
+    conn.close()
+
+
+async def run(args):
+    import httpx
+    import broadcast
+    from bot_throughput import start_server
+    from fake_telegram import create_fake_app
+
+    fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    seed_db(db_path, args.users)
+
+    fake_base = f"http://127.0.0.1:{args.fake_port}"
+    fake_server = start_server(create_fake_app(rate_limit=args.fake_limit), args.fake_port)
+    blocked = [10_000 + i for i in range(0, args.users, max(1, args.users // max(1, args.blocked)))][:args.blocked]
+    async with httpx.AsyncClient(base_url=fake_base) as client:
+        await client.post("/fake/config", json={"blocked": blocked})
+
+    bot = broadcast.make_bot(token="123:FAKE", base_url=f"{fake_base}/bot")
+    broadcaster = broadcast.Broadcaster(bot, db_path=db_path, rate=args.rate, chunk_size=args.chunk)
+    broadcast_id = broadcaster.create("🎉 Новые пакеты уже в приложении!")
+
+    async with bot:
+        # 1) Прерываем рассылку посередине — как если бы процесс убили
+        task = asyncio.create_task(broadcaster.run(broadcast_id))
+        await asyncio.sleep(args.interrupt_after)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        interrupted = broadcaster.get(broadcast_id)
+
+        # 2) Возобновляем с сохранённого курсора
+        started = time.monotonic()
+        report = await broadcaster.run(broadcast_id)
+        resumed_sec = time.monotonic() - started
+
+    async with httpx.AsyncClient(base_url=fake_base) as client:
+        stats = (await client.get("/fake/stats")).json()
+    fake_server.should_exit = True
+    os.unlink(db_path)
+
+    delivered_chats = args.users - len(blocked)
+    return {
+        "ok": report["status"] == "done" and report["sent"] >= delivered_chats and stats["duplicates"] <= args.chunk,
+        "users": args.users,
+        "blocked": len(blocked),
+        "interrupted_at_user_id": interrupted["last_user_id"],
+        "interrupted_status": interrupted["status"],
+        "report": report,
+        "resume_rate_per_sec": round(report["sent_this_run"] / resumed_sec, 2),
+        "fake": {k: stats[k] for k in ("sent", "rejected_429", "rejected_403", "duplicates")},
+    }
+
+
+def main():
+    result = asyncio.run(run(parse_args()))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    sys.exit(0 if result["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
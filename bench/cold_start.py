@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Холодный старт воркера: импорт app.py + приведение схемы.
+
+    python bench/cold_start.py                      # app.py, 5 запусков
+    python bench/cold_start.py --module backend.app --runs 10
+    python bench/cold_start.py --importtime         # топ медленных импортов
+
+Каждый запуск — отдельный процесс `python -c "import app"` (как воркер
+uvicorn/gunicorn). Сравниваются два случая: пустая БД (применяются все
+шаги schema.py) и БД, уже приведённая к SCHEMA_VERSION (никакого DDL).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import time, json
+t0 = time.perf_counter()
+import {module} as m
+print(json.dumps({{"import_ms": (time.perf_counter() - t0) * 1000, "schema": m.SCHEMA_INFO}}))
+"""
+
+
+def run_once(module: str, db_path: str, extra_args=()) -> subprocess.CompletedProcess:
+    env = dict(os.environ, DB_PATH=db_path, PYTHONDONTWRITEBYTECODE="0")
+    cmd = [sys.executable, *extra_args, "-c", PROBE.format(module=module)]
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=ROOT, env=env, capture_output=True, text=True)
+    proc.wall_ms = (time.perf_counter() - t0) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return proc
+
+
+def measure(module: str, runs: int, fresh: bool) -> dict:
+    tmp = tempfile.mkdtemp()
+    walls, imports, schema_ms, applied = [], [], [], []
+    for i in range(runs):
+        path = os.path.join(tmp, f"fresh{i}.db" if fresh else "warm.db")
+        if not fresh and i == 0:
+            run_once(module, path)  # первый запуск приводит схему, дальше меряем уже «тёплую» БД
+        proc = run_once(module, path)
+        probe = json.loads(proc.stdout.strip().splitlines()[-1])
+        walls.append(proc.wall_ms)
+        imports.append(probe["import_ms"])
+        schema_ms.append(probe["schema"]["ms"])
+        applied.append(len(probe["schema"]["applied"]))
+    return {
+        "db": "fresh" if fresh else "versioned",
+        "runs": runs,
+        "process_ms_p50": round(statistics.median(walls), 1),
+        "import_ms_p50": round(statistics.median(imports), 1),
+        "schema_ms_p50": round(statistics.median(schema_ms), 3),
+        "steps_applied": max(applied),
+    }
+
+
+def importtime(module: str, top: int) -> list:
+    """Топ модулей по собственному времени импорта (-X importtime)"""
+    proc = run_once(module, os.path.join(tempfile.mkdtemp(), "it.db"), ("-X", "importtime"))
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = [p.strip() for p in line[len("import time:"):].split("|")]
+        rows.append((int(self_us), int(cumulative_us), name.strip()))
+    rows.sort(reverse=True)
+    return [{"module": n, "self_ms": round(s / 1000, 1), "cumulative_ms": round(c / 1000, 1)}
+            for s, c, n in rows[:top]]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--module", default="app")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--importtime", action="store_true")
+    p.add_argument("--top", type=int, default=15)
+    args = p.parse_args()
+
+    result = {
+        "module": args.module,
+        "fresh": measure(args.module, args.runs, fresh=True),
+        "versioned": measure(args.module, args.runs, fresh=False),
+    }
+    if args.importtime:
+        result["importtime_top"] = importtime(args.module, args.top)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
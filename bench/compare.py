@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Сравнение двух результатов бенчмарков и поиск регрессий.
+
+    python bench/compare.py bench/results/micro-abc123.json bench/results/micro-def456.json
+    python bench/compare.py old-loadgen.json new-loadgen.json --threshold 0.2
+
+Понимает JSON из bench/micro.py (median_us по каждому бенчмарку) и
+bench/loadgen.py (p50/p95/p99 и rps по маршрутам, доли ошибок и
+«database is locked»). Регрессия — ухудшение больше чем на --threshold
+(доля, 0.1 = 10%); для долей ошибок — рост больше чем на --rate-floor
+в абсолютных единицах. Код выхода 1, если есть хоть одна регрессия.
+"""
+import sys
+import json
+import argparse
+
+LOWER, HIGHER = "lower", "higher"
+
+
+def flatten(doc: dict) -> dict:
+    """{метрика: (значение, что лучше)}"""
+    metrics = {}
+    if doc.get("kind") == "micro":
+        for name, r in doc["results"].items():
+            metrics[f"{name} median_us"] = (r["median_us"], LOWER)
+        return metrics
+
+    # loadgen
+    metrics["total rps"] = (doc["rps"], HIGHER)
+    metrics["total error_rate"] = (doc["error_rate"], LOWER)
+    metrics["total locked_rate"] = (doc["locked_rate"], LOWER)
+    for route, r in doc["routes"].items():
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            metrics[f"{route} {key}"] = (r[key], LOWER)
+        metrics[f"{route} rps"] = (r["rps"], HIGHER)
+        metrics[f"{route} error_rate"] = (r["error_rate"], LOWER)
+        metrics[f"{route} locked_rate"] = (r["locked_rate"], LOWER)
+    return metrics
+
+
+def compare(base: dict, new: dict, threshold: float, rate_floor: float) -> list:
+    rows = []
+    a, b = flatten(base), flatten(new)
+    for name in sorted(set(a) | set(b)):
+        if name not in a or name not in b or a[name][0] is None or b[name][0] is None:
+            rows.append((name, a.get(name, (None,))[0], b.get(name, (None,))[0], None, "missing"))
+            continue
+        old, better = a[name]
+        cur = b[name][0]
+        worse = cur - old if better == LOWER else old - cur
+        if name.endswith("_rate"):
+            change = cur - old
+            flag = "REGRESSION" if worse > rate_floor else ("improved" if -worse > rate_floor else "")
+        else:
+            change = (cur - old) / old if old else 0.0
+            rel = worse / old if old else 0.0
+            flag = "REGRESSION" if rel > threshold else ("improved" if -rel > threshold else "")
+        rows.append((name, old, cur, change, flag))
+    return rows
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.10)
+    p.add_argument("--rate-floor", type=float, default=0.005)
+    p.add_argument("--all", action="store_true", help="показывать и метрики без изменений / только в одном файле")
+    args = p.parse_args(argv)
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+
+    rows = compare(base, new, args.threshold, args.rate_floor)
+    print(f"{base.get('commit')} -> {new.get('commit')} (threshold {args.threshold:.0%})")
+    print(f"{'metric':<52} {'base':>12} {'new':>12} {'change':>9}")
+    for name, old, cur, change, flag in rows:
+        if flag in ("", "missing") and not args.all:
+            continue
+        if change is None:
+            shown = ""
+        elif name.endswith("_rate"):
+            shown = f"{change * 100:+.2f}pp"
+        else:
+            shown = f"{change:+.1%}"
+        print(f"{name:<52} {old if old is not None else '-':>12} {cur if cur is not None else '-':>12} "
+              f"{shown:>9}  {flag}")
+
+    regressions = [r for r in rows if r[4] == "REGRESSION"]
+    print(f"{len(regressions)} regression(s), {sum(r[4] == 'improved' for r in rows)} improvement(s)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
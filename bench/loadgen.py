@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""Нагрузочный генератор: N синтетических пользователей Telegram тапают app.py.
+
+    python bench/loadgen.py --users 200 --duration 60
+    python bench/loadgen.py --users 500 --workers 4 --out bench/results/w4.json
+    python bench/loadgen.py --target http://127.0.0.1:8000 --tron http://127.0.0.1:8091
+
+Без --target поднимает app.py (serve.py, отдельный процесс, временная БД)
+и fake_trongrid.py. Каждый виртуальный пользователь ведёт себя как webapp:
+GET /api/user/{id} при входе, затем сессии тапов — не больше одного
+/api/tap в полёте и не чаще раза в 120 мс (кулдаун клиента), между
+сессиями пауза. Часть сессий заканчивается покупкой: /api/payments/create,
+«оплата» в фейковом TronGrid и опрос /api/payments/check.
+
+Результат (JSON, по умолчанию bench/results/loadgen-<commit>.json):
+пропускная способность, p50/p95/p99 по маршрутам, доля ошибок и
+«database is locked». Латентность меряется от отправки до ответа,
+генератор замкнутый (закрытая модель), поэтому при перегрузке падает
+rps, а не растёт очередь.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FAKE_RECEIVE_ADDRESS = "TFakeReceiveAddressForLoadTests00"
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--duration", type=float, default=60, help="секунд нагрузки после разгона")
+    p.add_argument("--ramp", type=float, default=5, help="секунд на подключение всех пользователей")
+    p.add_argument("--first-id", type=int, default=700_000_000)
+    p.add_argument("--cooldown-ms", type=int, default=120, help="кулдаун тапа в webapp")
+    p.add_argument("--tap-jitter-ms", type=int, default=60, help="средняя добавка к кулдауну (экспонента)")
+    p.add_argument("--session-taps", type=int, default=40, help="среднее число тапов в сессии")
+    p.add_argument("--think-sec", type=float, default=3.0, help="средняя пауза между сессиями")
+    p.add_argument("--pay-ratio", type=float, default=0.05, help="доля сессий с покупкой")
+    p.add_argument("--pay-success", type=float, default=0.5, help="доля счетов, которые «оплачиваются»")
+    p.add_argument("--check-polls", type=int, default=3)
+    p.add_argument("--check-interval", type=float, default=1.0)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--target", help="URL уже запущенного app.py; без него поднимаем свой")
+    p.add_argument("--tron", help="URL фейкового TronGrid (с --target)")
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--tron-port", type=int, default=8091)
+    p.add_argument("--tron-latency-ms", type=int, default=150)
+    p.add_argument("--workers", type=int, default=1, help="serve.py --workers для поднимаемого app.py")
+    p.add_argument("--db", help="файл БД для поднимаемого app.py (по умолчанию временный)")
+    p.add_argument("--out", help="куда записать JSON (по умолчанию bench/results/loadgen-<commit>.json)")
+    return p.parse_args(argv)
+
+
+# ================== СТАТИСТИКА ==================
+def percentile(sorted_values: list, q: float):
+    """Перцентиль по ближайшему рангу; sorted_values уже отсортирован"""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+class Recorder:
+    """Латентности и ошибки по маршрутам (шаблон пути, а не конкретный id)"""
+
+    def __init__(self):
+        self.routes = {}
+        self.started = None
+        self.finished = None
+
+    def add(self, route: str, ms: float, error: str = None, locked: bool = False):
+        r = self.routes.setdefault(route, {"lat": [], "errors": 0, "locked": 0, "error_samples": {}})
+        r["lat"].append(ms)
+        if error:
+            r["errors"] += 1
+            if len(r["error_samples"]) < 5:
+                r["error_samples"][error[:120]] = r["error_samples"].get(error[:120], 0) + 1
+        if locked:
+            r["locked"] += 1
+
+    def summary(self) -> dict:
+        elapsed = max(1e-9, (self.finished or time.monotonic()) - self.started)
+        routes, total, errors, locked = {}, 0, 0, 0
+        for name, r in sorted(self.routes.items()):
+            lat = sorted(r["lat"])
+            n = len(lat)
+            total += n
+            errors += r["errors"]
+            locked += r["locked"]
+            routes[name] = {
+                "count": n,
+                "rps": round(n / elapsed, 2),
+                "mean_ms": round(sum(lat) / n, 2) if n else None,
+                "p50_ms": round(percentile(lat, 50), 2) if n else None,
+                "p95_ms": round(percentile(lat, 95), 2) if n else None,
+                "p99_ms": round(percentile(lat, 99), 2) if n else None,
+                "max_ms": round(lat[-1], 2) if n else None,
+                "errors": r["errors"],
+                "error_rate": round(r["errors"] / n, 5) if n else 0,
+                "locked": r["locked"],
+                "locked_rate": round(r["locked"] / n, 5) if n else 0,
+                "error_samples": r["error_samples"],
+            }
+        return {
+            "elapsed_sec": round(elapsed, 2),
+            "requests": total,
+            "rps": round(total / elapsed, 2),
+            "errors": errors,
+            "error_rate": round(errors / total, 5) if total else 0,
+            "locked": locked,
+            "locked_rate": round(locked / total, 5) if total else 0,
+            "routes": routes,
+        }
+
+
+# ================== ВИРТУАЛЬНЫЙ ПОЛЬЗОВАТЕЛЬ ==================
+class VirtualUser:
+    def __init__(self, client, tron, telegram_id: int, rec: Recorder, args, rnd: random.Random):
+        self.client = client
+        self.tron = tron
+        self.telegram_id = telegram_id
+        self.rec = rec
+        self.args = args
+        self.rnd = rnd
+
+    async def call(self, route: str, method: str, url: str, **kwargs):
+        t0 = time.perf_counter()
+        error, locked, data = None, False, None
+        try:
+            resp = await self.client.request(method, url, **kwargs)
+            text = resp.text
+            locked = "database is locked" in text
+            try:
+                data = resp.json()
+            except ValueError:
+                data = None
+            if resp.status_code >= 400:
+                error = f"HTTP {resp.status_code}: {(data or {}).get('error') if isinstance(data, dict) else text[:80]}"
+            elif isinstance(data, dict) and data.get("ok") is False:
+                error = f"ok=false: {data.get('error')}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        self.rec.add(route, (time.perf_counter() - t0) * 1000, error, locked)
+        return data if error is None else None
+
+    async def tap_session(self, deadline: float):
+        a = self.args
+        taps = max(1, int(self.rnd.expovariate(1 / a.session_taps)))
+        for _ in range(taps):
+            if time.monotonic() >= deadline:
+                return
+            t0 = time.monotonic()
+            await self.call("POST /api/tap", "POST", "/api/tap", json={"telegram_id": self.telegram_id})
+            # webapp держит один запрос в полёте и кулдаун 120 мс между тапами
+            gap = (a.cooldown_ms + self.rnd.expovariate(1 / a.tap_jitter_ms)) / 1000 if a.tap_jitter_ms else a.cooldown_ms / 1000
+            await asyncio.sleep(max(0.0, gap - (time.monotonic() - t0)))
+
+    async def purchase(self, deadline: float):
+        a = self.args
+        invoice = await self.call("POST /api/payments/create", "POST", "/api/payments/create",
+                                  json={"telegram_id": self.telegram_id, "package_id": self.rnd.randint(1, 3)})
+        if not invoice:
+            return
+        if self.rnd.random() < a.pay_success:
+            await self.tron.post("/fake/pay", json={"amount": invoice["unique_amount"]})
+        for _ in range(a.check_polls):
+            if time.monotonic() >= deadline:
+                return
+            await asyncio.sleep(a.check_interval)
+            res = await self.call("POST /api/payments/check", "POST", "/api/payments/check",
+                                  json={"telegram_id": self.telegram_id, "invoice_id": invoice["payment_id"]})
+            if res and res.get("paid"):
+                return
+
+    async def run(self, start_at: float, deadline: float):
+        await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+        await self.call("GET /api/user/{id}", "GET", f"/api/user/{self.telegram_id}")
+        while time.monotonic() < deadline:
+            await self.tap_session(deadline)
+            if self.rnd.random() < self.args.pay_ratio:
+                await self.purchase(deadline)
+            await asyncio.sleep(min(max(0.0, deadline - time.monotonic()),
+                                    self.rnd.expovariate(1 / self.args.think_sec)))
+
+
+async def drive(args, base_url: str, tron_url: str) -> dict:
+    import httpx
+
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=args.users + 10, max_keepalive_connections=args.users + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits) as client, \
+            httpx.AsyncClient(base_url=tron_url, timeout=30) as tron:
+        now = time.monotonic()
+        rec.started = now
+        deadline = now + args.ramp + args.duration
+        users = [VirtualUser(client, tron, args.first_id + i, rec, args, random.Random(args.seed * 1_000_003 + i))
+                 for i in range(args.users)]
+        await asyncio.gather(*(u.run(now + args.ramp * i / max(1, args.users), deadline)
+                               for i, u in enumerate(users)))
+        rec.finished = time.monotonic()
+        try:
+            tron_stats = (await tron.get("/fake/stats")).json()
+        except Exception:
+            tron_stats = None
+    result = rec.summary()
+    result["trongrid"] = tron_stats
+    return result
+
+
+# ================== ЗАПУСК СЕРВЕРОВ ==================
+def _wait_http(url: str, proc: subprocess.Popen, timeout: float = 30):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args} exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+def start_stack(args):
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "loadgen.db")
+    tron_url = f"http://127.0.0.1:{args.tron_port}"
+    env = dict(os.environ, DB_PATH=db_path, TRONGRID_BASE=tron_url, TRON_RECEIVE_ADDRESS=FAKE_RECEIVE_ADDRESS,
+               FAKE_TRON_PORT=str(args.tron_port), FAKE_TRON_LATENCY_MS=str(args.tron_latency_ms))
+    tron = subprocess.Popen([sys.executable, "fake_trongrid.py"], cwd=ROOT, env=env)
+    # serve.py: при --workers > 1 ещё и брокер общего состояния
+    app = subprocess.Popen([sys.executable, "serve.py", "--host", "127.0.0.1",
+                            "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+                           cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    procs = [app, tron]
+    try:
+        _wait_http(f"{tron_url}/fake/stats", tron)
+        _wait_http(f"http://127.0.0.1:{args.port}/api/health", app)
+    except Exception:
+        stop_stack(procs)
+        raise
+    return f"http://127.0.0.1:{args.port}", tron_url, procs, db_path
+
+
+def stop_stack(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD", "--", "*.py"], cwd=ROOT).returncode != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    procs, db_path = [], None
+    if args.target:
+        base_url, tron_url = args.target.rstrip("/"), (args.tron or f"http://127.0.0.1:{args.tron_port}")
+    else:
+        base_url, tron_url, procs, db_path = start_stack(args)
+
+    try:
+        result = asyncio.run(drive(args, base_url, tron_url))
+    finally:
+        stop_stack(procs)
+        if db_path and not args.db:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.unlink(db_path + suffix)
+
+    commit = git_commit()
+    result = {"commit": commit, "ts": int(time.time()), "config": vars(args), **result}
+    out = args.out or os.path.join(ROOT, "bench", "results", f"loadgen-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+
+    print(f"{'route':<28} {'count':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err%':>7} {'locked%':>8}")
+    for name, r in result["routes"].items():
+        print(f"{name:<28} {r['count']:>7} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+              f"{r['error_rate'] * 100:>7.2f} {r['locked_rate'] * 100:>8.2f}")
+    print(f"total: {result['requests']} req, {result['rps']} req/s, "
+          f"errors {result['error_rate'] * 100:.2f}%, locked {result['locked_rate'] * 100:.2f}% -> {out}")
+    return 1 if result["requests"] == 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
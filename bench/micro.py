@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""Микробенчмарки горячих функций app.py на SQLite разного размера.
+
+    python bench/micro.py                                   # 1k, 100k, 1M × disk, memory
+    python bench/micro.py --sizes 1000,100000 --backends disk --number 500
+    python bench/micro.py --only tap. --out /tmp/tap.json
+    python bench/compare.py bench/results/micro-<old>.json bench/results/micro-<new>.json
+
+База заполняется синтетическими пользователями (users + user_stats одним
+INSERT ... SELECT), плюс три служебных: с бесплатными кликами, с активным
+пакетом и с закончившимся пакетом — чтобы process_tap шёл по нужной ветке.
+memory — общая in-memory БД (file:...?mode=memory&cache=shared), тот же
+get_db() с теми же PRAGMA, только без диска.
+
+Каждый бенчмарк: разогрев, затем --repeat раундов по --number вызовов;
+в JSON — время одного вызова (min / median / max по раундам, мкс).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import argparse
+import platform
+import tempfile
+import statistics
+from contextlib import closing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loadgen import git_commit  # noqa: E402
+import storage  # noqa: E402
+
+BASE_TG_ID = 100_000_000
+
+# (имя, нужна ли БД, setup(ctx) -> callable)
+BENCHES = []
+
+
+def bench(name: str, db: bool = True):
+    def register(setup):
+        BENCHES.append((name, db, setup))
+        return setup
+    return register
+
+
+class Ctx:
+    def __init__(self, app, loop, size: int):
+        self.app = app
+        self.loop = loop
+        self.size = size
+        # служебные пользователи идут сразу после синтетических
+        self.free_tg = BASE_TG_ID + size + 1
+        self.package_tg = BASE_TG_ID + size + 2
+        self.post_package_tg = BASE_TG_ID + size + 3
+        self.existing_tg = BASE_TG_ID + size // 2 + 1
+        self.next_new_tg = BASE_TG_ID + size + 1_000_000
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+# ================== ДАННЫЕ ==================
+def populate(conn, size: int):
+    from schema import ensure_schema
+
+    ensure_schema(conn)
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute("""
+        INSERT INTO users (id, telegram_id, welcome_given)
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        SELECT i, ? + i, 1 FROM n
+    """, (size, BASE_TG_ID))
+    conn.execute("""
+        INSERT INTO user_stats (user_id, balance, free_taps, total_taps, package_taps_remaining,
+                                tap_reward, package_type, package_expires)
+        SELECT id, (id % 5000) / 100.0, 10000 - (id % 10000), id % 20000,
+               CASE WHEN id % 7 = 0 THEN 100000 ELSE 0 END,
+               CASE WHEN id % 7 = 0 THEN 0.0002 ELSE 0.0001 END,
+               CASE WHEN id % 7 = 0 THEN 'Новичок' END,
+               CASE WHEN id % 7 = 0 THEN CAST(strftime('%s', 'now', '+30 days') AS INTEGER) END
+        FROM users
+    """)
+    future = conn.execute("SELECT CAST(strftime('%s', 'now', '+30 days') AS INTEGER)").fetchone()[0]
+    special = [
+        # (смещение, free_taps, package_taps, tap_reward, package_type, expires)
+        (1, 10 ** 9, 0, 0.0001, None, None),
+        (2, 0, 10 ** 9, 0.0003, "VIP", future),
+        (3, 0, 0, 0.0003, "VIP", future),
+    ]
+    for offset, free, pkg, reward, ptype, expires in special:
+        uid = size + offset
+        conn.execute("INSERT INTO users (id, telegram_id, welcome_given) VALUES (?, ?, 1)", (uid, BASE_TG_ID + uid))
+        conn.execute("""
+            INSERT INTO user_stats (user_id, balance, free_taps, package_taps_remaining, tap_reward,
+                                    package_type, package_expires)
+            VALUES (?, 1.0, ?, ?, ?, ?, ?)
+        """, (uid, free, pkg, reward, ptype, expires))
+    conn.commit()
+    conn.execute("PRAGMA synchronous=NORMAL;")
+
+
+def open_backend(backend: str, size: int, data_dir: str):
+    """Возвращает (DB_PATH для app, якорное соединение или None)"""
+    if backend == "memory":
+        path = f"file:micro{size}?mode=memory&cache=shared"
+        anchor = sqlite3.connect(path, uri=True, check_same_thread=False)
+        populate(anchor, size)
+        return path, anchor
+
+    path = os.path.join(data_dir, f"micro-{size}.db")
+    if not os.path.exists(path):
+        with closing(sqlite3.connect(path)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            populate(conn, size)
+    return path, None
+
+
+# ================== БЕНЧМАРКИ ==================
+def _http(ctx, telegram_id: int):
+    """Запрос для хендлера: с токеном сессии, если app их требует (задан TELEGRAM_BOT_TOKEN)"""
+    from starlette.requests import Request
+    headers = []
+    if ctx.app.SESSION_REQUIRED:
+        with closing(ctx.app.get_db()) as conn:
+            user_id = storage.get_or_create_user(conn, telegram_id)
+        token, _ = ctx.app.SESSIONS.issue(user_id, telegram_id)
+        headers.append((b"authorization", f"Bearer {token}".encode()))
+    return Request({"type": "http", "method": "POST", "path": "/", "headers": headers})
+
+
+def _tap(ctx, telegram_id: int, expect: str):
+    app = ctx.app
+    req = app.TapRequest(telegram_id=telegram_id)
+    http = _http(ctx, telegram_id)
+    first = ctx.run(app.process_tap(req, http))
+    # Ветка видна по тому, какой счётчик уменьшился
+    if first["free_taps"] == 10 ** 9 - 1:
+        branch = "free"
+    elif first["package_taps"] == 10 ** 9 - 1:
+        branch = "package"
+    else:
+        branch = "post_package"
+    if branch != expect:
+        raise AssertionError(f"process_tap went to {branch!r}, expected {expect!r}: {first}")
+
+    def call():
+        # Отказ (429, лимиты) — JSONResponse или ok: False: такой замер ничего не стоит
+        result = ctx.run(app.process_tap(req, http))
+        if not isinstance(result, dict) or not result.get("ok"):
+            raise AssertionError(f"process_tap rejected: {getattr(result, 'body', result)}")
+    return call
+
+
+@bench("tap.free")
+def _tap_free(ctx):
+    return _tap(ctx, ctx.free_tg, "free")
+
+
+@bench("tap.package")
+def _tap_package(ctx):
+    return _tap(ctx, ctx.package_tg, "package")
+
+
+@bench("tap.post_package")
+def _tap_post_package(ctx):
+    return _tap(ctx, ctx.post_package_tg, "post_package")
+
+
+@bench("user.get_or_create.existing")
+def _get_or_create_existing(ctx):
+    conn = ctx.conn = ctx.app.get_db()
+    return lambda: storage.get_or_create_user(conn, ctx.existing_tg)
+
+
+@bench("user.get_or_create.new")
+def _get_or_create_new(ctx):
+    conn = ctx.conn = ctx.app.get_db()
+
+    def call():
+        ctx.next_new_tg += 1
+        storage.get_or_create_user(conn, ctx.next_new_tg)
+    return call
+
+
+@bench("user.get_user_stats.package")
+def _get_user_stats_package(ctx):
+    conn = ctx.conn = ctx.app.get_db()
+    user_id = ctx.size + 2
+    if not storage.get_user_stats(conn, user_id)["has_package"]:
+        raise AssertionError("package user has no active package")
+    return lambda: storage.get_user_stats(conn, user_id)
+
+
+@bench("payment.create")
+def _payment_create(ctx):
+    # 999 сумм на пакет кончились бы за один прогон
+    ctx.app.PAYMENT_AMOUNT_SLOTS = 10 ** 6
+    req = ctx.app.CreateInvoiceRequest(telegram_id=ctx.existing_tg, package_id=1)
+    http = _http(ctx, ctx.existing_tg)
+    return lambda: ctx.run(ctx.app.create_payment(req, http))
+
+
+class _FakeResponse:
+    # check_tron_transaction пишет статус в метрики; без него замер мерил бы ветку исключения
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+class _FakeSession:
+    """Вместо requests.Session: отдаёт заранее собранный ответ TronGrid"""
+
+    def __init__(self, payload):
+        self.response = _FakeResponse(payload)
+
+    def get(self, url, params=None, timeout=None):
+        return self.response
+
+
+@bench("tron.parse50", db=False)
+def _tron_parse50(ctx):
+    app = ctx.app
+    now = int(time.time())
+    payload = {"data": [{
+        "transaction_id": f"{i:064x}",
+        "value": str(10_000_000 + i * 1000),
+        "block_timestamp": (now - i) * 1000,
+        "token_info": {"symbol": "USDT", "decimals": 6},
+    } for i in range(50)]}
+    app.TRON_RECEIVE_ADDRESS = app.TRON_RECEIVE_ADDRESS or "TFakeReceiveAddressForLoadTests00"
+    app._tron_session = _FakeSession(payload)
+    # Ошибка запроса тоже даёт None — убеждаемся, что ответ действительно разбирается
+    if app.check_tron_transaction(10.0, now) is None:
+        raise AssertionError("TronGrid response was not parsed")
+    # Ни одна сумма не подходит — разбираются все 50 транзакций
+    if app.check_tron_transaction(5000.0, now) is not None:
+        raise AssertionError("unexpected match")
+    return lambda: app.check_tron_transaction(5000.0, now)
+
+
+# ================== ЗАМЕР ==================
+def measure(fn, number: int, repeat: int) -> dict:
+    for _ in range(max(1, number // 10)):
+        fn()
+    rounds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - t0) / number * 1e6)
+    median = statistics.median(rounds)
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min_us": round(min(rounds), 2),
+        "median_us": round(median, 2),
+        "max_us": round(max(rounds), 2),
+        "ops_per_sec": round(1e6 / median, 1),
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", default="1000,100000,1000000")
+    p.add_argument("--backends", default="disk,memory")
+    p.add_argument("--number", type=int, default=1000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--only", default="", help="префикс имени бенчмарка")
+    p.add_argument("--data-dir", help="где держать файлы БД (по умолчанию временный каталог)")
+    p.add_argument("--out", help="JSON (по умолчанию bench/results/micro-<commit>.json)")
+    args = p.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    backends = [b for b in args.backends.split(",") if b]
+    data_dir = args.data_dir or tempfile.mkdtemp()
+
+    # app.py приводит схему при импорте — даём ему пустую временную БД
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "import.db")
+    import app
+    # Энергия, дневная квота, лимит заработка и TAP_RATE_LIMIT (тапов в секунду на пользователя)
+    # кончились бы за первые тысячи тапов, и бенчмарк мерил бы отказ, а не запись
+    app.TAP_RATE_LIMIT = 0
+    storage.FREE_ENERGY_CAP = storage.FREE_DAILY_TAPS = 10 ** 12
+    storage.WELCOME_CAP = None
+    storage.ENERGY_LIMITS.clear()
+    storage.DAILY_LIMITS.clear()
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    selected = [b for b in BENCHES if b[0].startswith(args.only)]
+
+    for name, needs_db, setup in selected:
+        if needs_db:
+            continue
+        ctx = Ctx(app, loop, 0)
+        results[name] = measure(setup(ctx), args.number, args.repeat)
+        print(f"{name:<40} {results[name]['median_us']:>10.1f} us", flush=True)
+
+    for backend in backends:
+        for size in sizes:
+            t0 = time.monotonic()
+            app.DB_PATH, anchor = open_backend(backend, size, data_dir)
+            print(f"-- {backend} {size} users ({time.monotonic() - t0:.1f}s to prepare)", flush=True)
+            for name, needs_db, setup in selected:
+                if not needs_db:
+                    continue
+                ctx = Ctx(app, loop, size)
+                key = f"{name}/{backend}/{size}"
+                try:
+                    results[key] = measure(setup(ctx), args.number, args.repeat)
+                finally:
+                    if getattr(ctx, "conn", None) is not None:
+                        ctx.conn.close()
+                print(f"{key:<40} {results[key]['median_us']:>10.1f} us", flush=True)
+            if anchor is not None:
+                anchor.close()
+
+    loop.close()
+    if not args.data_dir:
+        for f in os.listdir(data_dir):
+            os.unlink(os.path.join(data_dir, f))
+
+    commit = git_commit()
+    out = args.out or os.path.join(ROOT, "bench", "results", f"micro-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "kind": "micro",
+            "commit": commit,
+            "ts": int(time.time()),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "config": vars(args),
+            "results": results,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"-> {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Бенчмарк migrate_db.py на синтетической базе старого формата.
+
+    python bench/migrate_5m.py                       # 5M пользователей, офлайн
+    python bench/migrate_5m.py --users 500000 --online --writer-rps 200
+
+Генерирует «широкую» таблицу users и payments по telegram_id (как в
+backend/app.py), мигрирует их и сверяет результат со старыми таблицами
+(количество, суммы, поштучно баланс, тапы и last_active; платежи по
+user_id, package_id, статусу и paid_at). Старт приложения (schema.ensure_schema)
+проверяется на той же базе: до миграции — LegacySchemaError, после — схема
+приводится к SCHEMA_VERSION; отдельно — база, где старого формата только payments. В --online режиме параллельный поток изображает живое
+приложение: обновляет и добавляет пользователей, пока идёт копирование.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrate_db  # noqa: E402
+import schema  # noqa: E402
+
+
+def generate(path: str, users: int):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute("""
+        CREATE TABLE users (
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            lang TEXT DEFAULT 'ru',
+            balance REAL DEFAULT 0.0,
+            free_taps_left INTEGER DEFAULT 10000,
+            paid_taps_left INTEGER DEFAULT 0,
+            tap_value REAL DEFAULT 0.0001,
+            withdraw_address TEXT,
+            created_at INTEGER DEFAULT (strftime('%s','now')),
+            total_taps INTEGER DEFAULT 0,
+            last_active TEXT,
+            package_expires TEXT,
+            package_type TEXT,
+            daily_taps INTEGER DEFAULT 0,
+            welcome_given BOOLEAN DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        INSERT INTO users (telegram_id, username, first_name, balance, free_taps_left, paid_taps_left,
+                           tap_value, created_at, total_taps, last_active, package_type, welcome_given)
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        SELECT 100000000 + i, 'user' || i, 'Name' || (i % 1000),
+               (i % 5000) / 100.0, 10000 - (i % 10000), (i % 7) * 1000,
+               CASE WHEN i % 7 = 0 THEN 0.0001 ELSE 0.0002 END,
+               1700000000 + i, i % 20000, datetime('now'),
+               CASE WHEN i % 7 = 0 THEN NULL ELSE 'basic' END, 1
+        FROM n
+    """, (users,))
+    conn.execute("""
+        CREATE TABLE payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            package_type TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        )
+    """)
+    # Покупка у каждого седьмого (buy_package — сразу completed), неоплаченный счёт у каждого одиннадцатого
+    conn.execute("""
+        INSERT INTO payments (telegram_id, amount, package_type, status, completed_at)
+        SELECT telegram_id, 10.0, 'basic', 'completed', datetime('now') FROM users WHERE rowid % 7 = 1
+        UNION ALL
+        SELECT telegram_id, 50.0, 'pro', 'pending', NULL FROM users WHERE rowid % 11 = 1
+    """)
+    conn.execute("CREATE INDEX idx_users_telegram ON users(telegram_id)")
+    conn.execute("CREATE INDEX idx_payments_telegram ON payments(telegram_id)")
+    conn.execute("CREATE INDEX idx_users_last_active ON users(last_active)")
+    conn.commit()
+    conn.close()
+
+
+def writer(path: str, stop: threading.Event, rps: int, stats: dict):
+    """Имитация старого приложения: тапы (UPDATE) и регистрации (INSERT)"""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA busy_timeout=5000;")
+    max_id = conn.execute("SELECT MAX(telegram_id) FROM users").fetchone()[0]
+    next_id = max_id + 1
+    while not stop.is_set():
+        try:
+            if random.random() < 0.1:
+                conn.execute("INSERT INTO users (telegram_id, balance, welcome_given) VALUES (?, 1.0, 1)", (next_id,))
+                next_id += 1
+            else:
+                conn.execute("UPDATE users SET balance = balance + 0.0001, total_taps = total_taps + 1 "
+                             "WHERE telegram_id = ?", (random.randint(100000001, max_id),))
+            conn.commit()
+            stats["writes"] += 1
+        except sqlite3.OperationalError:
+            # После переключения старой таблицы с такими колонками уже нет — приложение «переехало»
+            break
+        time.sleep(1 / rps)
+    conn.close()
+
+
+def verify(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    q = lambda sql: conn.execute(sql).fetchone()[0]  # noqa: E731
+    result = {
+        "legacy_rows": q("SELECT COUNT(*) FROM users_legacy"),
+        "users_rows": q("SELECT COUNT(*) FROM users"),
+        "stats_rows": q("SELECT COUNT(*) FROM user_stats"),
+        "balance_diff": q("SELECT ROUND((SELECT SUM(balance) FROM users_legacy) - "
+                          "(SELECT SUM(balance) FROM user_stats), 6)"),
+        "mismatched_rows": q("""
+            SELECT COUNT(*) FROM users_legacy l
+            LEFT JOIN users u ON u.id = l.rowid
+            LEFT JOIN user_stats s ON s.user_id = l.rowid
+            WHERE u.telegram_id IS NOT l.telegram_id
+               OR s.balance IS NOT l.balance
+               OR s.total_taps IS NOT l.total_taps
+               OR u.last_active IS NOT l.last_active
+        """),
+        "legacy_payments": q("SELECT COUNT(*) FROM payments_legacy"),
+        "payments_rows": q("SELECT COUNT(*) FROM payments"),
+        "mismatched_payments": q("""
+            SELECT COUNT(*) FROM payments_legacy l
+            LEFT JOIN payments p ON p.id = l.id
+            LEFT JOIN users u ON u.id = p.user_id
+            WHERE u.telegram_id IS NOT l.telegram_id
+               OR p.package_id IS NOT (CASE l.package_type WHEN 'basic' THEN 1 WHEN 'pro' THEN 2 END)
+               OR p.status IS NOT (CASE l.status WHEN 'completed' THEN 'paid' ELSE 'expired' END)
+               OR p.paid_at IS NOT l.completed_at
+        """),
+    }
+    conn.close()
+    result["ok"] = (result["legacy_rows"] == result["users_rows"] == result["stats_rows"]
+                    and result["legacy_payments"] == result["payments_rows"]
+                    and not result["mismatched_rows"] and not result["mismatched_payments"]
+                    and not result["balance_diff"])
+    return result
+
+
+def startup(path: str) -> str:
+    """Что сделает ensure_schema при старте app.py / backend/app.py: версия схемы или имя исключения"""
+    conn = sqlite3.connect(path)
+    try:
+        return f"v{schema.ensure_schema(conn)['version']}"
+    except Exception as e:
+        return type(e).__name__
+    finally:
+        conn.close()
+
+
+def legacy_payments_guard(data_dir: str) -> bool:
+    """Новая users, но payments по telegram_id: с данными — LegacySchemaError, пустая — пересоздаётся"""
+    path = os.path.join(data_dir, "payments-only.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE payments (id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER NOT NULL, "
+                 "amount REAL NOT NULL, package_type TEXT NOT NULL, status TEXT DEFAULT 'pending', "
+                 "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, completed_at TIMESTAMP)")
+    conn.execute("CREATE INDEX idx_payments_telegram ON payments(telegram_id)")
+    conn.execute("INSERT INTO payments (telegram_id, amount, package_type) VALUES (1, 10.0, 'basic')")
+    conn.commit()
+    with_rows = startup(path)
+    conn.execute("DELETE FROM payments")
+    conn.commit()
+    conn.close()
+    empty = startup(path)
+    os.unlink(path)
+    return with_rows == "LegacySchemaError" and empty == f"v{schema.SCHEMA_VERSION}"
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=5_000_000)
+    p.add_argument("--chunk", type=int, default=50_000)
+    p.add_argument("--online", action="store_true")
+    p.add_argument("--writer-rps", type=int, default=200)
+    p.add_argument("--db", help="путь к файлу БД (по умолчанию временный)")
+    args = p.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "legacy.db")
+    t0 = time.monotonic()
+    generate(path, args.users)
+    gen_sec = time.monotonic() - t0
+    print(f"сгенерировано {args.users} пользователей за {gen_sec:.1f}s: {path}", flush=True)
+
+    before = startup(path)
+    stop, wstats, thread = threading.Event(), {"writes": 0}, None
+    if args.online:
+        thread = threading.Thread(target=writer, args=(path, stop, args.writer_rps, wstats), daemon=True)
+        thread.start()
+
+    t0 = time.monotonic()
+    migrate_db.MigrationRunner(path, chunk_size=args.chunk, online=args.online, verbose=False).run()
+    migrate_sec = time.monotonic() - t0
+    stop.set()
+    if thread:
+        thread.join()
+
+    result = {
+        "users": args.users,
+        "online": args.online,
+        "chunk": args.chunk,
+        "generate_sec": round(gen_sec, 2),
+        "migrate_sec": round(migrate_sec, 2),
+        "rows_per_sec": round(args.users / migrate_sec),
+        "concurrent_writes": wstats["writes"],
+        "verify": verify(path),
+        "startup_before": before,
+        "startup_after": startup(path),
+        "legacy_payments_guard": legacy_payments_guard(os.path.dirname(path)),
+    }
+    result["verify"]["ok"] = (result["verify"]["ok"] and before == "LegacySchemaError"
+                              and result["startup_after"] == f"v{schema.SCHEMA_VERSION}"
+                              and result["legacy_payments_guard"])
+    print(json.dumps(result, indent=2))
+    if not args.db:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    sys.exit(0 if result["verify"]["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
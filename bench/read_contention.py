@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Латентность чтений GET-маршрутов при насыщенных писателях.
+
+    python bench/read_contention.py                          # 20k пользователей, 0 и 4 писателя
+    python bench/read_contention.py --writers 0,2,8 --seconds 5
+
+Писатели — потоки, которые без пауз делают apply_taps (BEGIN IMMEDIATE,
+как /api/tap). Читатель — отдельный поток, по кругу load_user и
+payment_history существующих пользователей. Два режима чтения:
+  pool   — app.read_db(): пул read-only соединений (mode=ro, query_only);
+  writer — прежний путь: новое соединение get_db() с PRAGMA писателя на
+           каждый вызов.
+Ожидание: в WAL читатель не ждёт писателей, и p95/p99 чтения в режиме
+pool при писателях остаются около значений без них.
+
+В конце — проверка долгого чтения: запрос дольше DB_READ_TIMEOUT_MS
+прерывается, а не держит снимок (и чекпоинт) бесконечно.
+JSON (kind "micro", median_us = p50) понимает bench/compare.py.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+from contextlib import closing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loadgen import git_commit, percentile  # noqa: E402
+from micro import populate, BASE_TG_ID  # noqa: E402
+import storage  # noqa: E402
+
+
+def writer_loop(store, users: int, stop: threading.Event, counter: list, seed: int):
+    rnd = random.Random(seed)
+    while not stop.is_set():
+        try:
+            store.apply_taps(BASE_TG_ID + rnd.randint(1, users))
+            counter[0] += 1
+        except sqlite3.OperationalError:
+            counter[1] += 1
+
+
+def read_phase(store, users: int, seconds: float, seed: int) -> dict:
+    rnd = random.Random(seed)
+    lat = {"load_user": [], "payment_history": []}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        tg = BASE_TG_ID + rnd.randint(1, users)
+        t0 = time.perf_counter()
+        store.load_user(tg)
+        t1 = time.perf_counter()
+        store.payment_history(tg)
+        t2 = time.perf_counter()
+        lat["load_user"].append((t1 - t0) * 1e6)
+        lat["payment_history"].append((t2 - t1) * 1e6)
+    return lat
+
+
+def run(app, mode: str, writers: int, args) -> dict:
+    reader = app.STORAGE if mode == "pool" else storage.SQLiteStorage(app.get_db)
+    writer = storage.SQLiteStorage(app.get_db)
+    stop = threading.Event()
+    counters = [[0, 0] for _ in range(writers)]
+    threads = [threading.Thread(target=writer_loop, args=(writer, args.users, stop, counters[i], i), daemon=True)
+               for i in range(writers)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2 if writers else 0)
+    try:
+        lat = read_phase(reader, args.users, args.seconds, seed=writers)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    out = {}
+    for op, values in lat.items():
+        values.sort()
+        out[op] = {
+            "number": len(values),
+            "repeat": 1,
+            "median_us": round(percentile(values, 50), 1),
+            "p95_us": round(percentile(values, 95), 1),
+            "p99_us": round(percentile(values, 99), 1),
+            "max_us": round(values[-1], 1) if values else None,
+        }
+    writes = sum(c[0] for c in counters)
+    out["writer_tps"] = round(writes / args.seconds, 1)
+    out["writer_errors"] = sum(c[1] for c in counters)
+    return out
+
+
+def long_read_probe(app) -> dict:
+    """Бесконечный рекурсивный запрос через пул: должен прерваться по DB_READ_TIMEOUT_MS"""
+    started = time.perf_counter()
+    try:
+        with app.read_db() as conn:
+            conn.execute("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+                         "SELECT count(*) FROM c").fetchone()
+        outcome = "completed"
+    except sqlite3.OperationalError as e:
+        outcome = str(e)
+    return {"outcome": outcome, "ms": round((time.perf_counter() - started) * 1000, 1),
+            "timeout_ms": app.DB_READ_TIMEOUT_MS}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=20000)
+    p.add_argument("--writers", default="0,4")
+    p.add_argument("--seconds", type=float, default=5)
+    p.add_argument("--modes", default="pool,writer")
+    p.add_argument("--out", help="JSON (по умолчанию bench/results/reads-<commit>.json)")
+    args = p.parse_args(argv)
+
+    data_dir = tempfile.mkdtemp()
+    os.environ["DB_PATH"] = os.path.join(data_dir, "reads.db")
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    import app
+
+    with closing(sqlite3.connect(app.DB_PATH)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        populate(conn, args.users)
+    # у трети пользователей по нескольку платежей — чтобы история была не пустой
+    with closing(app.get_db()) as conn:
+        conn.execute("""
+            INSERT INTO payments (user_id, package_id, amount, unique_amount, status, created_at)
+            SELECT u.id, 1, 10.0, 10.0001, 'paid', datetime('now', '-' || (u.id % 90) || ' days')
+            FROM users u, (SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3)
+            WHERE u.id % 3 = 0
+        """)
+        conn.commit()
+
+    results = {}
+    print(f"{'mode':<7} {'writers':>7} {'op':<16} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9} {'writes/s':>9}")
+    for mode in args.modes.split(","):
+        for writers in [int(w) for w in args.writers.split(",")]:
+            r = run(app, mode, writers, args)
+            for op in ("load_user", "payment_history"):
+                results[f"read.{op}/{mode}/w{writers}"] = r[op]
+                print(f"{mode:<7} {writers:>7} {op:<16} {r[op]['median_us']:>9} {r[op]['p95_us']:>9} "
+                      f"{r[op]['p99_us']:>9} {r['writer_tps']:>9}", flush=True)
+
+    probe = long_read_probe(app)
+    wal = app.DB_PATH + "-wal"
+    wal_mb = round(os.path.getsize(wal) / 2 ** 20, 2) if os.path.exists(wal) else 0
+    print(f"long read: {probe['outcome']} after {probe['ms']} ms (limit {probe['timeout_ms']} ms); "
+          f"WAL {wal_mb} MB; read pool {app.READ_POOL.stats()}")
+
+    app.READ_POOL.reset()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(app.DB_PATH + suffix):
+            os.unlink(app.DB_PATH + suffix)
+
+    commit = git_commit()
+    out = args.out or os.path.join(ROOT, "bench", "results", f"reads-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({
+            "kind": "micro",
+            "commit": commit,
+            "ts": int(time.time()),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "config": vars(args),
+            "long_read": probe,
+            "results": results,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"-> {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
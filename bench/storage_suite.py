@@ -0,0 +1,697 @@
+#!/usr/bin/env python3
+"""Общие проверки и бенчмарки движков storage.py (sqlite, memory).
+
+    python bench/storage_suite.py                       # проверки + бенчмарки обоих движков
+    python bench/storage_suite.py --engines memory --checks-only
+    python bench/compare.py bench/results/storage-<old>.json bench/results/storage-<new>.json
+
+Проверки — одно и то же поведение через интерфейс Storage: приветственный
+бонус, переходы бесплатные -> пакет -> «после пакета», пачка кликов равна
+стольким же одиночным, повтор пачки с тем же id не начисляется, платёж
+подтверждается ровно один раз, истёкший счёт освобождает сумму и не
+подтверждается, история (новые первыми, limit), данные переживают переоткрытие (SQLite — новое
+соединение, memory — снимок и загрузка). Каждая проверка получает чистое
+хранилище. Код выхода 1, если хоть одна проверка не прошла.
+
+Бенчмарки — те же операции на --users пользователях, замер как в
+bench/micro.py; JSON (kind "micro") понимает bench/compare.py.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import itertools
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loadgen import git_commit  # noqa: E402
+from micro import measure  # noqa: E402
+import storage  # noqa: E402
+import activity  # noqa: E402
+import idempotency  # noqa: E402
+from schema import ensure_schema  # noqa: E402
+
+BASE_TG_ID = 300_000_000
+PACKAGE = {"name": "Новичок", "price": 10.0, "taps": 100000, "reward": 0.0002, "cap": 20.0}
+EXPIRES = 32503680000  # 3000-01-01, epoch
+
+
+def _tx(n: int) -> dict:
+    return {"tx_hash": f"{n:064x}", "amount": 10.0001, "timestamp": 1_700_000_000_000 + n}
+
+
+def _amounts(price: float):
+    """Кандидаты уникальной суммы, как в app._amount_candidates, но по порядку"""
+    return (round(price + k / 10000, 6) for k in range(1, 10000))
+
+
+def _pay(store, tg: int, price: float = PACKAGE["price"], package_id: int = 1) -> int:
+    return store.create_payment(tg, package_id, price, _amounts(price))[0]
+
+
+# ================== ДВИЖКИ ==================
+class SQLiteEngine:
+    """SQLiteStorage поверх app.get_db / app.read_db — те же PRAGMA, пул чтения и метрики, что в проде"""
+    name = "sqlite"
+
+    def __init__(self, app, data_dir: str):
+        self.app, self.data_dir, self.n = app, data_dir, 0
+
+    def fresh(self):
+        self.n += 1
+        self.app.DB_PATH = os.path.join(self.data_dir, f"storage-{self.n}.db")
+        conn = self.app.get_db()
+        ensure_schema(conn)
+        conn.close()
+        return storage.SQLiteStorage(self.app.get_db, self.app.read_db)
+
+    def reopen(self, store):
+        store.close()
+        self.app.READ_POOL.reset()
+        return storage.SQLiteStorage(self.app.get_db, self.app.read_db)
+
+
+class MemoryEngine:
+    name = "memory"
+
+    def __init__(self, app, data_dir: str):
+        self.data_dir, self.n = data_dir, 0
+
+    def fresh(self):
+        self.n += 1
+        # Снимки вручную (snapshot / close), без фонового потока
+        return storage.MemoryStorage(os.path.join(self.data_dir, f"snapshot-{self.n}.json"), snapshot_sec=0)
+
+    def reopen(self, store):
+        store.close()
+        return storage.MemoryStorage(store.snapshot_path, snapshot_sec=0)
+
+
+ENGINES = {"sqlite": SQLiteEngine, "memory": MemoryEngine}
+
+
+# ================== ПРОВЕРКИ ==================
+CHECKS = []
+
+
+def check(name: str):
+    def register(fn):
+        CHECKS.append((name, fn))
+        return fn
+    return register
+
+
+def expect(cond, message: str):
+    if not cond:
+        raise AssertionError(message)
+
+
+def close_to(a: float, b: float, eps: float = 1e-9) -> bool:
+    return abs(a - b) <= eps
+
+
+@check("user.welcome")
+def _welcome(engine, store):
+    user_id, stats = store.load_user(BASE_TG_ID + 1)
+    expect(user_id > 0, f"user_id {user_id}")
+    expect(stats["balance"] == storage.WELCOME_BALANCE, f"balance {stats['balance']}")
+    expect(stats["free_taps"] == storage.WELCOME_TAPS, f"free_taps {stats['free_taps']}")
+    expect(stats["total_taps"] == 0 and stats["package_taps"] == 0, f"counters {stats}")
+    expect(stats["welcome_given"] and not stats["has_package"], f"flags {stats}")
+
+
+@check("user.provision_idempotent")
+def _provision_idempotent(engine, store):
+    a = store.provision_user(BASE_TG_ID + 1)
+    expect(store.provision_user(BASE_TG_ID + 1) == a, "second provision returned another id")
+    b = store.provision_user(BASE_TG_ID + 2)
+    expect(b != a, "two users share an id")
+    expect(store.find_user(BASE_TG_ID + 2) == b, "find_user does not see provisioned user")
+    expect(store.find_user(BASE_TG_ID + 3) is None, "find_user invents users")
+
+
+@check("tap.unknown_user")
+def _tap_unknown(engine, store):
+    expect(store.apply_taps(BASE_TG_ID + 9) is None, "taps applied to a missing user")
+    expect(store.find_user(BASE_TG_ID + 9) is None, "apply_taps created a user")
+
+
+@check("tap.single_free")
+def _tap_single(engine, store):
+    tg = BASE_TG_ID + 1
+    user_id = store.provision_user(tg)
+    r = store.apply_taps(tg)
+    expect(close_to(r["earned"], storage.FREE_TAP_REWARD), f"earned {r['earned']}")
+    expect(r["free_taps"] == storage.WELCOME_TAPS - 1 and r["total_taps"] == 1, f"counters {r}")
+    expect(r["types"] == {"free": 1}, f"types {r['types']}")
+    stats = store.user_stats(user_id)
+    expect(close_to(stats["balance"], r["balance"]) and stats["free_taps"] == r["free_taps"],
+           f"stats {stats} != result {r}")
+
+
+@check("tap.batch_equals_singles")
+def _tap_batch(engine, store):
+    single, batch = BASE_TG_ID + 1, BASE_TG_ID + 2
+    store.provision_user(single)
+    store.provision_user(batch)
+    for _ in range(25):
+        a = store.apply_taps(single)
+    b = store.apply_taps(batch, 25)
+    for key in ("free_taps", "package_taps", "total_taps"):
+        expect(a[key] == b[key], f"{key}: singles {a[key]} != batch {b[key]}")
+    expect(close_to(a["balance"], b["balance"]), f"balance: singles {a['balance']} != batch {b['balance']}")
+
+
+@check("tap.batch_idempotent")
+def _tap_batch_idempotent(engine, store):
+    tg = BASE_TG_ID + 1
+    store.provision_user(tg)
+    expect(store.apply_tap_batch(BASE_TG_ID + 2, "a", 5) is None, "batch for a missing user")
+    first = store.apply_tap_batch(tg, "a", 5)
+    expect(not first["duplicate"] and first["total_taps"] == 5, f"first {first}")
+    again = store.apply_tap_batch(tg, "a", 5)
+    expect(again["duplicate"] and again["earned"] == 0 and again["types"] == {}, f"retry {again}")
+    expect(again["total_taps"] == 5 and close_to(again["balance"], first["balance"]), f"retry applied {again}")
+    expect(store.apply_tap_batch(tg, "b", 3)["total_taps"] == 8, "next batch")
+
+    expect(store.prune_tap_batches("2000-01-01 00:00:00") == 0, "fresh batch ids pruned")
+    expect(store.prune_tap_batches("9999-01-01 00:00:00", limit=1) == 1, "prune limit")
+    expect(store.prune_tap_batches("9999-01-01 00:00:00") == 1, "prune rest")
+
+
+@check("package.expiry")
+def _package_expiry(engine, store):
+    now = int(time.time())
+    tg, idle = BASE_TG_ID + 1, BASE_TG_ID + 2
+    user_id, idle_id = store.provision_user(tg), store.provision_user(idle)
+    keep = store.provision_user(BASE_TG_ID + 3)
+    for n, (who, expires) in enumerate(((tg, now - 1), (idle, now - 10), (BASE_TG_ID + 3, now + 3600))):
+        store.confirm_payment(_pay(store, who), _tx(n), PACKAGE, expires)
+
+    # Клик сам видит истёкший срок, не дожидаясь фонового истечения
+    r = store.apply_taps(tg, 2)
+    expect(r["package_expired"] and "package" not in r["types"], f"expired package paid: {r['types']}")
+    expect(r["tap_reward"] == storage.FREE_TAP_REWARD and r["package_taps"] == 0, f"tap {r}")
+    stats = store.user_stats(user_id)
+    expect(not stats["has_package"] and stats["package_type"] is None, f"not reset by tap: {stats}")
+
+    expect(store.user_stats(idle_id)["package_type"] == PACKAGE["name"], "idle user reset too early")
+    expect(store.expire_packages(now, limit=10) == [idle], "background expiry")
+    stats = store.user_stats(idle_id)
+    expect(not stats["has_package"] and stats["tap_reward"] == storage.FREE_TAP_REWARD, f"idle {stats}")
+    expect(store.expire_packages(now) == [], "expired twice")
+    expect(store.user_stats(keep)["has_package"], "live package expired")
+
+
+@check("energy.regen")
+def _energy_regen(engine, store):
+    tg = BASE_TG_ID + 1
+    store.provision_user(tg)
+    saved = storage.FREE_ENERGY_CAP, storage.FREE_ENERGY_REGEN
+    storage.FREE_ENERGY_CAP, storage.FREE_ENERGY_REGEN = 10, 0.0
+    try:
+        expect(store.user_stats(store.find_user(tg))["energy"] == 10, "new user starts with a full cap")
+        r = store.apply_taps(tg, 15)
+        expect(r["taps"] == 10 and r["total_taps"] == 10 and r["energy"] == 0, f"clamped to energy: {r}")
+        r = store.apply_taps(tg)
+        expect(r["taps"] == 0 and r["earned"] == 0 and r["total_taps"] == 10, f"no energy left: {r}")
+        b = store.apply_tap_batch(tg, "e1", 3)
+        expect(b["taps"] == 0 and not b["duplicate"], f"batch without energy: {b}")
+
+        storage.FREE_ENERGY_REGEN = 1000.0
+        time.sleep(0.05)
+        r = store.apply_taps(tg, 15)
+        expect(r["taps"] == 10, f"regenerated up to the cap only: {r}")
+    finally:
+        storage.FREE_ENERGY_CAP, storage.FREE_ENERGY_REGEN = saved
+
+
+@check("tap.daily_quota")
+def _daily_quota(engine, store):
+    tg = BASE_TG_ID + 1
+    store.provision_user(tg)
+    saved = storage.FREE_DAILY_TAPS, storage.day_stamp
+    storage.FREE_DAILY_TAPS = 10
+    try:
+        expect(store.user_stats(store.find_user(tg))["daily_taps_left"] == 10, "new user has the full quota")
+        r = store.apply_taps(tg, 7)
+        expect(r["taps"] == 7 and r["daily_taps_left"] == 3, f"within quota: {r}")
+        b = store.apply_tap_batch(tg, "d1", 5)
+        expect(b["taps"] == 3 and b["daily_taps_left"] == 0, f"batch clamped to quota: {b}")
+        r = store.apply_taps(tg)
+        expect(r["taps"] == 0 and r["earned"] == 0 and r["total_taps"] == 10, f"quota exhausted: {r}")
+
+        # Следующий день: счётчик прошлого дня не действует, записи для сброса не нужно
+        storage.day_stamp = lambda now: "2999-01-01"
+        expect(store.user_stats(store.find_user(tg))["daily_taps_left"] == 10, "quota not renewed")
+        r = store.apply_taps(tg, 4)
+        expect(r["taps"] == 4 and r["daily_taps_left"] == 6, f"new day: {r}")
+    finally:
+        storage.FREE_DAILY_TAPS, storage.day_stamp = saved
+
+
+@check("tap.earn_cap")
+def _earn_cap(engine, store):
+    tg = BASE_TG_ID + 1
+    saved = storage.WELCOME_CAP
+    storage.WELCOME_CAP = 5 * storage.FREE_TAP_REWARD
+    try:
+        user_id = store.provision_user(tg)
+    finally:
+        storage.WELCOME_CAP = saved
+    r = store.apply_taps(tg, 3)
+    expect(abs(r["earn_cap_remaining"] - 2 * storage.FREE_TAP_REWARD) < 1e-12, f"cap after 3 taps: {r}")
+    balance = r["balance"]
+    b = store.apply_tap_batch(tg, "c1", 5)
+    expect(b["taps"] == 5 and abs(b["earned"] - 2 * storage.FREE_TAP_REWARD) < 1e-12, f"clamped at the cap: {b}")
+    expect(b["earn_cap_remaining"] == 0 and abs(b["balance"] - balance - b["earned"]) < 1e-12, f"{b}")
+    r = store.apply_taps(tg)
+    expect(r["taps"] == 0 and r["earned"] == 0 and r["total_taps"] == 8, f"cap exhausted: {r}")
+
+    store.confirm_payment(_pay(store, tg), _tx(1), PACKAGE, EXPIRES)
+    store.confirm_payment(_pay(store, tg), _tx(2), PACKAGE, EXPIRES)
+    expect(store.user_stats(user_id)["earn_cap_remaining"] == 2 * PACKAGE["cap"], "package caps must stack")
+    r = store.apply_taps(tg)
+    expect(r["taps"] == 1 and r["earned"] > 0 and r["earn_cap_remaining"] < 2 * PACKAGE["cap"],
+           f"paying again after purchase: {r}")
+
+
+@check("tap.sync_version")
+def _sync_version(engine, store):
+    tg = BASE_TG_ID + 1
+    user_id = store.provision_user(tg)
+    expect(store.sync_taps(tg + 1, 0, 1) is None, "unknown user must give None")
+    v0 = store.user_stats(user_id)["version"]
+    r = store.sync_taps(tg, v0, 3)
+    expect(r["taps"] == 3 and r["version"] == v0 + 1 and not r["stale"], f"fresh sync: {r}")
+    expect(set(r["changed"]) >= {"balance", "free_taps", "total_taps"} and "tap_reward" not in r["changed"],
+           f"only changed fields: {r['changed']}")
+    r = store.sync_taps(tg, r["version"], 0)
+    expect(r["taps"] == 0 and r["changed"] == {} and r["version"] == v0 + 1, f"empty sync is a no-op: {r}")
+
+    store.apply_taps(tg)
+    r = store.sync_taps(tg, v0 + 1, 1)
+    expect(r["stale"] and r["changed"]["total_taps"] == 5 and "tap_reward" in r["changed"], f"stale client: {r}")
+
+    b = store.sync_taps(tg, r["version"], 2, batch_id="s1")
+    again = store.sync_taps(tg, r["version"], 2, batch_id="s1")
+    expect(b["taps"] == 2 and not b["duplicate"], f"first batch: {b}")
+    expect(again["duplicate"] and again["taps"] == 0 and again["version"] == b["version"] and again["stale"],
+           f"repeated batch must not apply again: {again}")
+    expect(store.user_stats(user_id)["total_taps"] == 7, "batch counted once")
+    r = b
+
+    if engine.name == "sqlite":
+        # Другой писатель между чтением и записью: UPDATE ... WHERE version не проходит, дельта применяется заново
+        outcome, raced = storage.tap_outcome, []
+
+        def racing_outcome(*args, **kwargs):
+            if not raced:
+                raced.append(tg)
+                store.apply_taps(tg)
+            return outcome(*args, **kwargs)
+
+        storage.tap_outcome = racing_outcome
+        try:
+            r = store.sync_taps(tg, r["version"], 2)
+        finally:
+            storage.tap_outcome = outcome
+        expect(raced and r["taps"] == 2 and r["stale"], f"conflict retried: {r}")
+        expect(store.user_stats(user_id)["total_taps"] == 10, "racing tap and retried delta must both count")
+
+
+@check("request.idempotency")
+def _request_idempotency(engine, store):
+    long_ago, now = "2000-01-01 00:00:00", storage._now_sql()
+    expect(store.claim_request("tap:1:a", long_ago, "fp-a") is None, "first claim must reserve the key")
+    expect(store.claim_request("tap:1:a", long_ago, "fp-x") == (None, None, "fp-a"),
+           "second claim must see it in progress with the first fingerprint")
+    store.finish_request("tap:1:a", 200, '{"ok":true}')
+    expect(store.claim_request("tap:1:a", "2999-01-01 00:00:00") == (200, '{"ok":true}', "fp-a"),
+           "finished response or fingerprint lost")
+
+    expect(store.claim_request("tap:1:b", long_ago) is None, "claim b")
+    store.release_request("tap:1:b")
+    expect(store.claim_request("tap:1:b", long_ago) is None, "released key must be claimable again")
+    expect(store.claim_request("tap:1:b", "2999-01-01 00:00:00") is None, "abandoned claim must be taken over")
+
+    time.sleep(1.1)
+    expect(store.prune_requests(storage._now_sql()) == 2, "prune both keys")
+    expect(store.claim_request("tap:1:a", now) is None, "pruned key is new again")
+
+
+@check("request.with_taps")
+def _request_with_taps(engine, store):
+    tg = BASE_TG_ID + 1
+    store.provision_user(tg)
+    render = lambda r: (200, json.dumps({"total_taps": r["total_taps"]}))
+    first = idempotency.Pending("tap:1:c", "fp-c", render)
+    r = store.apply_taps(tg, request=first)
+    expect(first.response == (200, '{"total_taps": 1}'), f"response not rendered: {first.response}")
+    expect(store.find_request("tap:1:c") == (200, '{"total_taps": 1}', "fp-c"), "key not written with the taps")
+    # Повтор, прошедший find_request до записи ключа, — Replay внутри транзакции, клик не применяется
+    try:
+        store.apply_taps(tg, request=idempotency.Pending("tap:1:c", "fp-c", render))
+        expect(False, "second apply with the same key must raise Replay")
+    except idempotency.Replay as e:
+        expect(e.stored == (200, '{"total_taps": 1}', "fp-c"), f"replayed {e.stored}")
+    expect(store.load_user(tg)[1]["total_taps"] == r["total_taps"] == 1, "replayed key applied taps again")
+    # Неповторяемый ответ не сохраняется
+    skipped = idempotency.Pending("tap:1:d", "fp-d", lambda r: (429, "{}"))
+    store.apply_taps(tg, request=skipped)
+    expect(skipped.response is None and store.find_request("tap:1:d") is None, "429 response stored")
+
+
+@check("activity.merge")
+def _activity_merge(engine, store):
+    tg = BASE_TG_ID + 1
+    store.provision_user(tg)
+    first, second = activity.HyperLogLog(), activity.HyperLogLog()
+    for i in range(3000):
+        first.add(i)
+    for i in range(2000, 5000):
+        second.add(i)
+    store.record_activity({tg: "2026-01-02 03:04:05"}, {"2026-01-02": first.to_bytes()})
+    store.record_activity({}, {"2026-01-02": second.to_bytes(), "2026-01-01": second.to_bytes()})
+    days = store.activity_days("2026-01-01", "2026-01-02")
+    expect(sorted(days) == ["2026-01-01", "2026-01-02"], f"days {sorted(days)}")
+    n = activity.HyperLogLog(days["2026-01-02"]).count()
+    expect(abs(n - 5000) < 250, f"merged sketch estimates {n}, expected ~5000")
+    expect(store.activity_days("2026-01-03", "2026-01-31") == {}, "days outside the range")
+
+
+@check("tap.branches")
+def _tap_branches(engine, store):
+    tg = BASE_TG_ID + 1
+    store.provision_user(tg)
+    r = store.apply_taps(tg, storage.WELCOME_TAPS + 2)
+    expect(r["types"] == {"free": storage.WELCOME_TAPS, "post_package": 2}, f"types {r['types']}")
+    expect(r["free_taps"] == 0, f"free_taps {r['free_taps']}")
+    r = store.apply_taps(tg)
+    expect(r["types"] == {"post_package": 1} and r["free_taps"] == 0, f"free_taps 0 must stay 0: {r}")
+
+    payment_id = _pay(store, tg)
+    expect(store.confirm_payment(payment_id, _tx(1), PACKAGE, EXPIRES), "confirm failed")
+    r = store.apply_taps(tg, 3)
+    expect(r["types"] == {"package": 3}, f"types {r['types']}")
+    expect(close_to(r["earned"], 3 * PACKAGE["reward"]), f"earned {r['earned']}")
+    expect(r["tap_reward"] == PACKAGE["reward"], f"tap_reward {r['tap_reward']}")
+    expect(r["package_taps"] == PACKAGE["taps"] - 3, f"package_taps {r['package_taps']}")
+
+
+@check("payment.create_get")
+def _payment_create(engine, store):
+    tg = BASE_TG_ID + 1
+    created = store.create_payment(tg, 1, PACKAGE["price"], [10.0042])
+    expect(created is not None and close_to(created[1], 10.0042), f"created {created}")
+    payment_id = created[0]
+    expect(store.find_user(tg) is not None, "create_payment did not provision the user")
+    p = store.get_payment(tg, payment_id)
+    expect(p is not None, "own payment not found")
+    expect(p["status"] == "pending" and p["tx_hash"] is None and p["paid_at"] is None, f"payment {p}")
+    expect(p["amount"] == PACKAGE["price"] and close_to(p["unique_amount"], 10.0042), f"amounts {p}")
+    expect(set(p) == set(storage.PAYMENT_FIELDS), f"fields {sorted(p)}")
+    store.provision_user(BASE_TG_ID + 2)
+    expect(store.get_payment(BASE_TG_ID + 2, payment_id) is None, "foreign payment visible")
+    expect(store.pending_payment_ids() == [payment_id], f"pending {store.pending_payment_ids()}")
+    expect(store.count_pending_payments() == 1, "count_pending_payments")
+
+
+@check("payment.confirm_once")
+def _payment_confirm(engine, store):
+    tg = BASE_TG_ID + 1
+    user_id = store.provision_user(tg)
+    payment_id = _pay(store, tg)
+    expect(store.confirm_payment(payment_id, _tx(1), PACKAGE, EXPIRES), "first confirm failed")
+    expect(not store.confirm_payment(payment_id, _tx(2), PACKAGE, EXPIRES), "second confirm applied")
+    stats = store.user_stats(user_id)
+    expect(stats["package_taps"] == PACKAGE["taps"], f"package applied twice or not at all: {stats}")
+    expect(stats["has_package"] and stats["package_type"] == PACKAGE["name"], f"stats {stats}")
+    p = store.get_payment(tg, payment_id)
+    expect(p["status"] == "paid" and p["tx_hash"] == _tx(1)["tx_hash"] and p["paid_at"], f"payment {p}")
+    expect(store.pending_payment_ids() == [] and store.count_pending_payments() == 0, "still pending")
+
+
+@check("payment.expire")
+def _payment_expire(engine, store):
+    tg = BASE_TG_ID + 1
+    ids = [_pay(store, tg) for _ in range(5)]
+    expect(store.expire_payments("2000-01-01 00:00:00") == [], "fresh invoices expired")
+    taken = store.get_payment(tg, ids[0])["unique_amount"]
+    expect(store.create_payment(tg, 1, PACKAGE["price"], [taken]) is None, "amount of a live invoice reused")
+
+    expect(store.expire_payments("9999-01-01 00:00:00", limit=2) == ids[:2], "batch is not the oldest two")
+    expect(store.expire_payments("9999-01-01 00:00:00", limit=10) == ids[2:], "second batch")
+    expect(store.expire_payments("9999-01-01 00:00:00") == [], "expired twice")
+    p = store.get_payment(tg, ids[0])
+    expect(p["status"] == "expired" and p["expired_at"], f"payment {p}")
+    expect(store.pending_payment_ids() == [], f"pending {store.pending_payment_ids()}")
+    expect(not store.confirm_payment(ids[0], _tx(1), PACKAGE, EXPIRES), "expired invoice confirmed")
+
+    reused = store.create_payment(tg, 1, PACKAGE["price"], [taken])
+    expect(reused is not None and close_to(reused[1], taken), f"slot not released: {reused}")
+
+
+@check("payment.late_review")
+def _payment_late(engine, store):
+    tg = BASE_TG_ID + 1
+    expired, paid = _pay(store, tg), _pay(store, tg)
+    store.confirm_payment(paid, _tx(2), PACKAGE, EXPIRES)
+    store.expire_payments("9999-01-01 00:00:00")
+    expect(store.flag_late_payment(expired, _tx(1)), "late transfer not flagged")
+    expect(not store.flag_late_payment(expired, _tx(1)), "same transfer flagged twice")
+    expect(not store.flag_late_payment(expired, _tx(2)), "transfer that paid another invoice flagged")
+
+
+@check("payment.history")
+def _payment_history(engine, store):
+    tg = BASE_TG_ID + 1
+    ids = [_pay(store, tg) for _ in range(25)]
+    _pay(store, BASE_TG_ID + 2, 50.0, 2)
+    history = store.payment_history(tg, limit=20)
+    expect([p["id"] for p in history] == ids[::-1][:20], f"order {[p['id'] for p in history]}")
+    expect(store.payment_history(BASE_TG_ID + 3) == [], "history of a missing user")
+
+
+@check("payment.history_pages")
+def _payment_history_pages(engine, store):
+    tg = BASE_TG_ID + 1
+    # Все в одну секунду: порядок внутри страницы и между страницами держит id
+    ids = [_pay(store, tg) for _ in range(25)]
+    seen, before = [], None
+    while True:
+        page = store.payment_history(tg, limit=10, before=before)
+        expect(all(set(p) == set(storage.HISTORY_FIELDS) for p in page), f"fields {page[:1]}")
+        seen += [p["id"] for p in page]
+        if len(page) < 10:
+            break
+        before = (page[-1]["created_at"], page[-1]["id"])
+    expect(seen == ids[::-1], f"pages {seen}")
+
+
+@check("payment.scan")
+def _payment_scan(engine, store):
+    ids = [_pay(store, BASE_TG_ID + i % 3) for i in range(12)]
+    for payment_id in ids[::4]:
+        store.confirm_payment(payment_id, _tx(payment_id), PACKAGE, EXPIRES)
+    seen, after = [], None
+    while True:
+        page = store.scan_payments(after=after, limit=5)
+        seen += [p["id"] for p in page]
+        if len(page) < 5:
+            break
+        after = (page[-1]["created_at"], page[-1]["id"])
+    expect(seen == ids, f"scan order {seen}")
+    paid = store.scan_payments(status="paid")
+    expect([p["id"] for p in paid] == ids[::4], f"status filter {[p['id'] for p in paid]}")
+    expect(set(paid[0]) == set(storage.PAYMENT_FIELDS), f"fields {sorted(paid[0])}")
+    created = paid[0]["created_at"]
+    expect(len(store.scan_payments(since=created)) == 12, "since is inclusive")
+    expect(store.scan_payments(until=created) == [], "until is exclusive")
+    expect(store.scan_payments(status="pending", after=(created, ids[-2]))[0]["id"] == ids[-1], "after + status")
+
+
+@check("persistence.reopen")
+def _reopen(engine, store):
+    tg = BASE_TG_ID + 1
+    user_id = store.provision_user(tg)
+    store.apply_taps(tg, 7)
+    paid = _pay(store, tg)
+    store.confirm_payment(paid, _tx(1), PACKAGE, EXPIRES)
+    pending = _pay(store, tg)
+    before = store.user_stats(user_id)
+
+    store = engine.reopen(store)
+    try:
+        expect(store.find_user(tg) == user_id, "user lost")
+        expect(store.user_stats(user_id) == before, f"stats {store.user_stats(user_id)} != {before}")
+        expect(store.pending_payment_ids() == [pending], f"pending {store.pending_payment_ids()}")
+        expect(store.get_payment(tg, paid)["status"] == "paid", "paid status lost")
+        expect(store.provision_user(BASE_TG_ID + 2) > user_id, "user ids reused after reopen")
+        expect(_pay(store, tg) > pending, "payment ids reused after reopen")
+    finally:
+        store.close()
+
+
+def run_checks(engine) -> list:
+    failures = []
+    for name, fn in CHECKS:
+        store = engine.fresh()
+        try:
+            fn(engine, store)
+            print(f"  ok    {engine.name}/{name}", flush=True)
+        except Exception as e:
+            failures.append(f"{engine.name}/{name}")
+            print(f"  FAIL  {engine.name}/{name}: {e}", flush=True)
+            if not isinstance(e, AssertionError):
+                traceback.print_exc()
+        finally:
+            store.close()
+    return failures
+
+
+# ================== БЕНЧМАРКИ ==================
+BENCHES = []
+
+
+def bench(name: str):
+    def register(setup):
+        BENCHES.append((name, setup))
+        return setup
+    return register
+
+
+class Ctx:
+    def __init__(self, users: int):
+        self.users = users
+        self.existing_tg = BASE_TG_ID + users // 2
+        self.next_new_tg = BASE_TG_ID + users + 1_000_000
+
+
+@bench("provision.existing")
+def _b_provision_existing(ctx, store):
+    return lambda: store.provision_user(ctx.existing_tg)
+
+
+@bench("provision.new")
+def _b_provision_new(ctx, store):
+    def call():
+        ctx.next_new_tg += 1
+        store.provision_user(ctx.next_new_tg)
+    return call
+
+
+@bench("load_user")
+def _b_load_user(ctx, store):
+    return lambda: store.load_user(ctx.existing_tg)
+
+
+@bench("tap")
+def _b_tap(ctx, store):
+    return lambda: store.apply_taps(ctx.existing_tg)
+
+
+@bench("tap.batch50")
+def _b_tap_batch(ctx, store):
+    return lambda: store.apply_taps(ctx.existing_tg, 50)
+
+
+@bench("payment.create")
+def _b_payment_create(ctx, store):
+    amounts = (PACKAGE["price"] + k / 10 ** 6 for k in itertools.count(1))
+    return lambda: store.create_payment(ctx.existing_tg, 1, PACKAGE["price"], [next(amounts)])
+
+
+@bench("payment.history")
+def _b_payment_history(ctx, store):
+    return lambda: store.payment_history(ctx.existing_tg)
+
+
+def run_benches(engine, users: int, number: int, repeat: int, only: str) -> dict:
+    store = engine.fresh()
+    results = {}
+    try:
+        t0 = time.monotonic()
+        for i in range(users):
+            store.provision_user(BASE_TG_ID + i)
+        print(f"-- {engine.name}: {users} users ({time.monotonic() - t0:.1f}s to prepare)", flush=True)
+        for name, setup in BENCHES:
+            if not name.startswith(only):
+                continue
+            key = f"storage.{name}/{engine.name}"
+            results[key] = measure(setup(Ctx(users), store), number, repeat)
+            print(f"{key:<40} {results[key]['median_us']:>10.1f} us", flush=True)
+        if isinstance(store, storage.MemoryStorage):
+            info = store.snapshot()
+            print(f"   snapshot: {info['users']} users, {info['payments']} payments, {info['ms']} ms", flush=True)
+    finally:
+        store.close()
+    return results
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--engines", default="sqlite,memory")
+    p.add_argument("--users", type=int, default=10000)
+    p.add_argument("--number", type=int, default=1000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--only", default="", help="префикс имени бенчмарка")
+    p.add_argument("--checks-only", action="store_true")
+    p.add_argument("--out", help="JSON (по умолчанию bench/results/storage-<commit>.json)")
+    args = p.parse_args(argv)
+
+    data_dir = tempfile.mkdtemp()
+    # app.py приводит схему при импорте — даём ему пустую временную БД
+    os.environ["DB_PATH"] = os.path.join(data_dir, "import.db")
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    import app
+    # Лимиты энергии, дневной квоты и заработка проверяют energy.regen, tap.daily_quota и tap.earn_cap;
+    # остальным они мешают (WELCOME_CAP None — новые пользователи без лимита заработка)
+    storage.FREE_ENERGY_CAP = storage.FREE_DAILY_TAPS = 10 ** 12
+    storage.WELCOME_CAP = None
+    storage.ENERGY_LIMITS.clear()
+    storage.DAILY_LIMITS.clear()
+
+    engines = [ENGINES[name](app, data_dir) for name in args.engines.split(",") if name]
+    failures, results = [], {}
+    try:
+        for engine in engines:
+            print(f"== {engine.name}: {len(CHECKS)} checks", flush=True)
+            failures += run_checks(engine)
+        if not args.checks_only and not failures:
+            for engine in engines:
+                results.update(run_benches(engine, args.users, args.number, args.repeat, args.only))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"{len(CHECKS) * len(engines) - len(failures)}/{len(CHECKS) * len(engines)} checks passed")
+    if failures:
+        print("failed: " + ", ".join(failures))
+        return 1
+    if results:
+        commit = git_commit()
+        out = args.out or os.path.join(ROOT, "bench", "results", f"storage-{commit}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump({
+                "kind": "micro",
+                "commit": commit,
+                "ts": int(time.time()),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "config": vars(args),
+                "results": results,
+            }, f, indent=2, ensure_ascii=False)
+        print(f"-> {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
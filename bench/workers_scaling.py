@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Масштабирование по воркерам: loadgen.py при 1, 2, 4 ... воркерах.
+
+    python bench/workers_scaling.py --workers 1 2 4 --users 300 --duration 30
+
+Для каждого числа воркеров поднимается свой стек (serve.py + fake_trongrid,
+чистая временная БД) и прогоняется одна и та же нагрузка. Итог — таблица
+rps и p95 по /api/tap и всем запросам, JSON в
+bench/results/scaling-<commit>.json. Остальные аргументы передаются
+loadgen.py как есть.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import loadgen
+
+ROOT = loadgen.ROOT
+TAP = "POST /api/tap"
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args, rest = p.parse_known_args(argv)
+
+    commit = loadgen.git_commit()
+    runs = []
+    for n in args.workers:
+        out = os.path.join(ROOT, "bench", "results", f"loadgen-{commit}-w{n}.json")
+        print(f"=== {n} worker(s) ===", flush=True)
+        code = loadgen.main(rest + ["--workers", str(n), "--out", out])
+        with open(out, encoding="utf-8") as f:
+            result = json.load(f)
+        tap = result["routes"].get(TAP, {})
+        runs.append({
+            "workers": n,
+            "exit_code": code,
+            "rps": result["rps"],
+            "tap_rps": tap.get("rps"),
+            "tap_p95_ms": tap.get("p95_ms"),
+            "p95_ms": max((r["p95_ms"] for r in result["routes"].values() if r["p95_ms"] is not None), default=None),
+            "error_rate": result["error_rate"],
+            "locked_rate": result["locked_rate"],
+            "file": os.path.relpath(out, ROOT),
+        })
+
+    base = runs[0]["rps"] or None
+    print(f"\n{'workers':>7} {'rps':>8} {'speedup':>8} {'tap rps':>8} {'tap p95':>8} {'max p95':>8} "
+          f"{'err%':>6} {'locked%':>8}  (cpus: {os.cpu_count()})")
+    for r in runs:
+        speedup = f"{r['rps'] / base:.2f}x" if base else "-"
+        print(f"{r['workers']:>7} {r['rps']:>8} {speedup:>8} {r['tap_rps'] or '-':>8} {r['tap_p95_ms'] or '-':>8} "
+              f"{r['p95_ms'] or '-':>8} {r['error_rate'] * 100:>6.2f} {r['locked_rate'] * 100:>8.2f}")
+
+    out = os.path.join(ROOT, "bench", "results", f"scaling-{commit}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({"commit": commit, "ts": int(time.time()), "cpus": os.cpu_count(),
+                   "loadgen_args": rest, "runs": runs}, f, indent=2)
+    print(f"-> {out}")
+    return 1 if any(r["exit_code"] for r in runs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,9 @@
 import os
-import requests
+import hmac
+import asyncio
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, ContextTypes
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 
@@ -15,6 +17,24 @@ MINIAPP_URL = os.getenv(
     "https://click-uper.com/?v=18"
 ).rstrip("/")
 
+# polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Сколько апдейтов обрабатываем одновременно (апдейты одного юзера — строго по очереди)
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "64"))
+
+# Публичный адрес, на который Telegram шлёт апдейты, например https://click-uper.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+
+# Кому доступны админские команды (/broadcast), через запятую
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+
+# Для локальных тестов/бенчмарков: http://127.0.0.1:8081/bot (см. fake_telegram.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").strip()
+
 
 def parse_ref(start_arg: str):
     # ожидаем ref_123
@@ -27,6 +47,96 @@ def parse_ref(start_arg: str):
             return int(num)
     return None
 
+
+# ================== CONCURRENCY ==================
+def _ordering_key(update: object):
+    """Ключ, по которому сохраняется порядок апдейтов (id пользователя/чата)"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов, но апдейты одного пользователя — по порядку.
+
+    Порядок внутри пользователя — asyncio.Lock на ключ. Application создаёт задачи
+    в порядке прихода апдейтов, а Lock будит ожидающих в порядке FIFO, поэтому
+    очередь юзера не переставляется. Слот общего лимита (concurrency) берётся
+    только после лока пользователя: ожидающие своей очереди апдейты слотов не
+    занимают, и один юзер, заспамивший бота, не блокирует остальных.
+
+    Семафор базового класса берётся в process_update до do_process_update,
+    поэтому ему отдаётся заведомо недостижимый лимит, а свой — в _slots.
+    """
+
+    # max_concurrent_updates для BaseUpdateProcessor: общий лимит здесь — _slots
+    UNBOUNDED = 1 << 30
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(self.UNBOUNDED)
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self.concurrency = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+        self._waiters = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = _ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            # Не держим локи для всех юзеров, которые когда-либо писали боту
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ================== BACKEND ==================
+async def backend_post(context: ContextTypes.DEFAULT_TYPE, path: str, payload: dict):
+    """POST в бэкенд без блокировки event loop"""
+    client = context.application.bot_data.get("backend_client")
+    try:
+        await client.post(f"{BACKEND_URL}{path}", json=payload)
+    except Exception:
+        pass
+
+
+async def _open_backend_client(application: Application):
+    application.bot_data["backend_client"] = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=BOT_CONCURRENCY, max_keepalive_connections=BOT_CONCURRENCY),
+    )
+
+
+async def _close_backend_client(application: Application):
+    client = application.bot_data.pop("backend_client", None)
+    if client is not None:
+        await client.aclose()
+
+
+# ================== HANDLERS ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user is None or update.message is None:
@@ -40,34 +150,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         referrer_tg_id = parse_ref(context.args[0])
 
     # 1) upsert invited в БД (реферал привяжется как referred_by)
-    try:
-        requests.post(
-            f"{BACKEND_URL}/api/user/upsert",
-            json={
-                "tg_id": invited_tg_id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "referred_by": referrer_tg_id
-            },
-            timeout=10
-        )
-    except Exception:
-        pass
+    await backend_post(context, "/api/user/upsert", {
+        "tg_id": invited_tg_id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "referred_by": referrer_tg_id
+    })
 
     # 2) Если есть referrer — начислить ему 0.1 СРАЗУ (один раз)
     if referrer_tg_id and referrer_tg_id != invited_tg_id:
-        try:
-            requests.post(
-                f"{BACKEND_URL}/api/referral/claim_start",
-                json={
-                    "referrer_tg_id": referrer_tg_id,
-                    "invited_tg_id": invited_tg_id
-                },
-                timeout=10
-            )
-        except Exception:
-            pass
+        await backend_post(context, "/api/referral/claim_start", {
+            "referrer_tg_id": referrer_tg_id,
+            "invited_tg_id": invited_tg_id
+        })
 
     # 3) Кнопка открытия мини-апки
     kb = InlineKeyboardMarkup([
@@ -79,13 +175,140 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=kb
     )
 
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast <текст> или /broadcast resume <id> — рассылка всем пользователям.
+
+    Читает users напрямую из DB_PATH, поэтому работает только там, где лежит БД.
+    """
+    user = update.effective_user
+    if user is None or update.message is None or user.id not in ADMIN_IDS:
+        return
+
+    from broadcast import Broadcaster
+
+    broadcaster = context.application.bot_data.get("broadcaster")
+    if broadcaster is None:
+        broadcaster = context.application.bot_data["broadcaster"] = Broadcaster(context.bot)
+
+    args = context.args or []
+    if len(args) == 2 and args[0] == "resume" and args[1].isdigit():
+        broadcast_id = int(args[1])
+    else:
+        text = (update.message.text or "").partition(" ")[2].strip()
+        if not text:
+            await update.message.reply_text("Usage: /broadcast <text> | /broadcast resume <id>")
+            return
+        broadcast_id = broadcaster.create(text)
+
+    admin_chat_id = update.effective_chat.id
+
+    async def _run_and_report():
+        r = await broadcaster.run(broadcast_id)
+        await context.bot.send_message(
+            admin_chat_id,
+            f"📣 Broadcast #{r['id']} {r['status']}: sent {r['sent']}, blocked {r['blocked']}, "
+            f"failed {r['failed']}, {r['rate_per_sec'] or 0} msg/s"
+        )
+
+    context.application.create_task(_run_and_report())
+    await update.message.reply_text(f"📣 Broadcast #{broadcast_id} started")
+
+
+def build_application(token: str = None, base_url: str = None) -> Application:
+    """Собрать Application с параллельной обработкой апдейтов"""
+    builder = (
+        Application.builder()
+        .token(token or BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENCY))
+        .post_init(_open_backend_client)
+        .post_shutdown(_close_backend_client)
+    )
+    base_url = base_url or TELEGRAM_API_BASE
+    if base_url:
+        builder = builder.base_url(base_url)
+
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    if ADMIN_IDS:
+        application.add_handler(CommandHandler("broadcast", broadcast_cmd))
+    return application
+
+
+# ================== WEBHOOK ==================
+def attach_webhook(api, application: Application, path: str = None,
+                   secret: str = None, public_url: str = None):
+    """Подключить приём апдейтов к FastAPI-приложению.
+
+    Работает и для отдельного ASGI-приложения (create_webhook_app), и для
+    основного app.py: маршрут только кладёт апдейт в очередь Application
+    и сразу отвечает 200, сама обработка идёт через PerUserUpdateProcessor.
+    """
+    from fastapi import Request
+    from fastapi.responses import JSONResponse
+
+    path = path or WEBHOOK_PATH
+    secret = WEBHOOK_SECRET if secret is None else secret
+    public_url = WEBHOOK_URL if public_url is None else public_url
+
+    @api.post(path, include_in_schema=False)
+    async def telegram_webhook(request: Request):
+        if secret and not hmac.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), secret.encode()):
+            return JSONResponse(status_code=403, content={"ok": False})
+        try:
+            data = await request.json()
+        except ValueError:
+            return JSONResponse(status_code=400, content={"ok": False})
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return {"ok": True}
+
+    async def _startup():
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if public_url:
+            await application.bot.set_webhook(
+                url=f"{public_url}{path}",
+                secret_token=secret or None,
+                max_connections=min(100, max(1, BOT_CONCURRENCY)),
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+    async def _shutdown():
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    api.router.add_event_handler("startup", _startup)
+    api.router.add_event_handler("shutdown", _shutdown)
+    return api
+
+
+def create_webhook_app(application: Application = None):
+    """Отдельное ASGI-приложение для webhook-режима"""
+    from fastapi import FastAPI
+
+    api = FastAPI(title="TG Clicker Bot", docs_url=None, redoc_url=None)
+    attach_webhook(api, application or build_application())
+    return api
+
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env variable.")
 
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.run_polling(close_loop=False)
+    app = build_application()
+
+    if BOT_MODE == "webhook":
+        import uvicorn
+        uvicorn.run(create_webhook_app(app), host=WEBHOOK_HOST, port=WEBHOOK_PORT, log_level="info")
+    else:
+        app.run_polling(close_loop=False)
 
 if __name__ == "__main__":
     main()
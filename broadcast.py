@@ -0,0 +1,268 @@
+"""Массовая рассылка сообщений всем пользователям бота.
+
+Получатели читаются из таблицы users порциями по ключу (id > последний_id),
+отправка идёт через общий token bucket (лимит Telegram ~30 msg/s на бота).
+На RetryAfter ставим на паузу весь bucket, а не только один запрос.
+Прогресс (последний обработанный users.id и счётчики) сохраняется после
+каждой порции, поэтому прерванная рассылка продолжается с того же места;
+при падении повторно может уйти не больше одной порции.
+
+    python broadcast.py send "Новые пакеты уже в приложении!"
+    python broadcast.py resume 3
+    python broadcast.py list
+"""
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+from contextlib import closing
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from schema import ensure_schema
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "data.db"))
+BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").strip()
+
+# Оставляем запас до 30 msg/s под ответы на /start
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "30"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+BROADCAST_REPORT_SEC = float(os.getenv("BROADCAST_REPORT_SEC", "10"))
+
+
+# ================== DB ==================
+def get_db(db_path: str = None):
+    """Соединение с БД (те же PRAGMA, что и в app.py)"""
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    return conn
+
+
+# ================== RATE LIMIT ==================
+class TokenBucket:
+    """Асинхронный token bucket с глобальной паузой (для RetryAfter)"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов на seconds; накопленные токены сгорают"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        # Lock выстраивает ожидающих в очередь FIFO
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _retry_after_seconds(err: RetryAfter) -> float:
+    # В новых версиях PTB retry_after — timedelta
+    value = err.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+# ================== BROADCAST ==================
+class Broadcaster:
+    """Рассылка с возобновлением по сохранённому курсору"""
+
+    def __init__(self, bot: Bot, db_path: str = None, rate: float = BROADCAST_RATE,
+                 chunk_size: int = BROADCAST_CHUNK, workers: int = BROADCAST_WORKERS):
+        self.bot = bot
+        self.db_path = db_path or DB_PATH
+        self.bucket = TokenBucket(rate)
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retry_after_hits = 0
+
+        with closing(get_db(self.db_path)) as conn:
+            ensure_schema(conn)
+
+    def create(self, text: str, parse_mode: str = None) -> int:
+        with closing(get_db(self.db_path)) as conn:
+            cur = conn.execute(
+                "INSERT INTO broadcasts (text, parse_mode) VALUES (?, ?)", (text, parse_mode))
+            conn.commit()
+            return cur.lastrowid
+
+    def get(self, broadcast_id: int):
+        with closing(get_db(self.db_path)) as conn:
+            row = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            return dict(row) if row else None
+
+    def list(self, limit: int = 20):
+        with closing(get_db(self.db_path)) as conn:
+            rows = conn.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            return [dict(r) for r in rows]
+
+    def _recipients(self, conn, after_id: int):
+        return conn.execute(
+            "SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, self.chunk_size)).fetchall()
+
+    async def _send_one(self, chat_id: int, text: str, parse_mode, counters: dict, semaphore):
+        async with semaphore:
+            for attempt in range(BROADCAST_MAX_ATTEMPTS):
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                    counters["sent"] += 1
+                    return
+                except RetryAfter as e:
+                    # Лимит бота общий — тормозим всех отправителей сразу
+                    self.retry_after_hits += 1
+                    self.bucket.pause(_retry_after_seconds(e))
+                except Forbidden:
+                    counters["blocked"] += 1
+                    return
+                except BadRequest:
+                    counters["failed"] += 1
+                    return
+                except (TimedOut, NetworkError):
+                    await asyncio.sleep(min(30, 2 ** attempt))
+            counters["failed"] += 1
+
+    async def run(self, broadcast_id: int) -> dict:
+        """Отправить (или доотправить) рассылку, вернуть итоговую статистику"""
+        row = self.get(broadcast_id)
+        if row is None:
+            raise ValueError(f"Broadcast {broadcast_id} not found")
+        if row["status"] == "done":
+            return self._report(row, 0, 0.0)
+
+        text, parse_mode = row["text"], row["parse_mode"]
+        cursor = row["last_user_id"] or 0
+        totals = {"sent": row["sent"], "blocked": row["blocked"], "failed": row["failed"]}
+        semaphore = asyncio.Semaphore(self.workers)
+        started = time.monotonic()
+        sent_this_run = 0
+        last_report = started
+        status = "interrupted"
+
+        with closing(get_db(self.db_path)) as conn:
+            conn.execute("""
+                UPDATE broadcasts
+                SET status = 'running', started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                WHERE id = ?
+            """, (broadcast_id,))
+            conn.commit()
+
+            try:
+                while True:
+                    chunk = self._recipients(conn, cursor)
+                    if not chunk:
+                        status = "done"
+                        break
+
+                    counters = {"sent": 0, "blocked": 0, "failed": 0}
+                    await asyncio.gather(*(
+                        self._send_one(r["telegram_id"], text, parse_mode, counters, semaphore)
+                        for r in chunk
+                    ))
+
+                    # Чекпоинт: порция целиком обработана
+                    cursor = chunk[-1]["id"]
+                    for k in totals:
+                        totals[k] += counters[k]
+                    sent_this_run += counters["sent"]
+                    conn.execute("""
+                        UPDATE broadcasts
+                        SET last_user_id = ?, sent = ?, blocked = ?, failed = ?
+                        WHERE id = ?
+                    """, (cursor, totals["sent"], totals["blocked"], totals["failed"], broadcast_id))
+                    conn.commit()
+
+                    now = time.monotonic()
+                    if now - last_report >= BROADCAST_REPORT_SEC:
+                        last_report = now
+                        rate = sent_this_run / (now - started)
+                        print(f"📣 broadcast #{broadcast_id}: sent={totals['sent']} blocked={totals['blocked']} "
+                              f"failed={totals['failed']} cursor={cursor} rate={rate:.1f} msg/s")
+            finally:
+                conn.execute("""
+                    UPDATE broadcasts
+                    SET status = ?, finished_at = CASE WHEN ? = 'done' THEN CURRENT_TIMESTAMP END
+                    WHERE id = ?
+                """, (status, status, broadcast_id))
+                conn.commit()
+
+        return self._report(self.get(broadcast_id), sent_this_run, time.monotonic() - started)
+
+    def _report(self, row: dict, sent_this_run: int, elapsed: float) -> dict:
+        return {
+            "id": row["id"],
+            "status": row["status"],
+            "sent": row["sent"],
+            "blocked": row["blocked"],
+            "failed": row["failed"],
+            "last_user_id": row["last_user_id"],
+            "sent_this_run": sent_this_run,
+            "elapsed_sec": round(elapsed, 3),
+            "rate_per_sec": round(sent_this_run / elapsed, 2) if elapsed else None,
+            "retry_after_hits": self.retry_after_hits,
+        }
+
+
+def make_bot(token: str = None, base_url: str = None) -> Bot:
+    """Bot с пулом соединений под параллельную отправку"""
+    from telegram.request import HTTPXRequest
+
+    kwargs = {"request": HTTPXRequest(connection_pool_size=BROADCAST_WORKERS + 8)}
+    base_url = base_url or TELEGRAM_API_BASE
+    if base_url:
+        kwargs["base_url"] = base_url
+    return Bot(token or BOT_TOKEN, **kwargs)
+
+
+async def _cli(argv):
+    if not argv or argv[0] not in ("send", "resume", "list"):
+        print(__doc__)
+        return 1
+
+    bot = make_bot()
+    broadcaster = Broadcaster(bot)
+    if argv[0] == "list":
+        for row in broadcaster.list():
+            print(row)
+        return 0
+
+    if argv[0] == "send":
+        broadcast_id = broadcaster.create(" ".join(argv[1:]))
+    else:
+        broadcast_id = int(argv[1])
+
+    async with bot:
+        print(await broadcaster.run(broadcast_id))
+    return 0
+
+
+if __name__ == "__main__":
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN is empty. Set BOT_TOKEN env variable.")
+    sys.exit(asyncio.run(_cli(sys.argv[1:])))
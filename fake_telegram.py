@@ -0,0 +1,321 @@
+"""Локальный фейковый Telegram Bot API для тестов и бенчмарков бота.
+
+Запуск:
+    uvicorn fake_telegram:app --port 8081
+    TELEGRAM_API_BASE=http://127.0.0.1:8081/bot BACKEND_URL=http://127.0.0.1:8081 python bot.py
+
+Поддерживает getMe, getUpdates (long polling), sendMessage, set/deleteWebhook.
+Апдейты подаются через POST /fake/inject, статистика — GET /fake/stats.
+Лимиты Telegram (429 + retry_after) и заблокировавшие бота юзеры (403)
+включаются через POST /fake/config.
+Заодно изображает бэкенд (/api/user/upsert, /api/referral/claim_start)
+с настраиваемой задержкой, чтобы бот не ходил в прод.
+"""
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from urllib.parse import parse_qsl
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FAKE_TG_LATENCY_MS = int(os.getenv("FAKE_TG_LATENCY_MS", "0"))
+FAKE_BACKEND_LATENCY_MS = int(os.getenv("FAKE_BACKEND_LATENCY_MS", "0"))
+# 0 — без ограничений
+FAKE_TG_RATE_LIMIT = int(os.getenv("FAKE_TG_RATE_LIMIT", "0"))
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Fake", "username": "fake_clicker_bot"}
+
+
+def make_start_update(update_id: int, user_id: int, start_arg: str = "") -> dict:
+    """Апдейт с командой /start от пользователя user_id"""
+    text = f"/start {start_arg}".strip()
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"u{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def _update_chat_id(update: dict):
+    for key in ("message", "edited_message", "callback_query", "my_chat_member"):
+        obj = update.get(key)
+        if obj:
+            sender = obj.get("from") or obj.get("chat") or {}
+            return sender.get("id")
+    return None
+
+
+class BotAPIError(Exception):
+    """Ошибка в формате Bot API: HTTP-код + description + parameters"""
+
+    def __init__(self, code: int, description: str, parameters: dict = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class FakeTelegram:
+    """Состояние фейкового API"""
+
+    def __init__(self, latency_ms: int = 0, backend_latency_ms: int = 0, rate_limit: int = 0):
+        self.latency = latency_ms / 1000
+        self.backend_latency = backend_latency_ms / 1000
+        self.rate_limit = rate_limit
+        self.per_chat_interval = 1.0
+        self.blocked = set()
+        self.reset()
+
+    def reset(self):
+        self.pending = deque()
+        self.has_updates = asyncio.Event()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.webhook_url = ""
+        self.webhook_secret = ""
+        self.webhook_max_connections = 40
+        self.webhook_errors = 0
+        self.injected = 0
+        self.sent = 0
+        self.sent_per_chat = {}
+        self.first_inject_at = None
+        self.last_sent_at = None
+        self.backend_calls = 0
+        self.calls = {}
+        self.rejected_429 = 0
+        self.rejected_403 = 0
+        self.recent_sends = deque()
+        self.last_send_per_chat = {}
+
+    def stats(self) -> dict:
+        elapsed = None
+        if self.first_inject_at and self.last_sent_at:
+            elapsed = self.last_sent_at - self.first_inject_at
+        return {
+            "injected": self.injected,
+            "sent": self.sent,
+            "pending": len(self.pending),
+            "webhook": self.webhook_url,
+            "webhook_errors": self.webhook_errors,
+            "backend_calls": self.backend_calls,
+            "rejected_429": self.rejected_429,
+            "rejected_403": self.rejected_403,
+            "duplicates": sum(1 for n in self.sent_per_chat.values() if n > 1),
+            "elapsed_sec": elapsed,
+            "rate_per_sec": (self.sent / elapsed) if elapsed else None,
+            "calls": dict(self.calls),
+        }
+
+    # ---------- Bot API ----------
+    async def call(self, method: str, params: dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, f"m_{method.lower()}", None)
+        if handler is None:
+            return True
+        return await handler(params)
+
+    async def m_getme(self, params):
+        return BOT_USER
+
+    async def m_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        while self.pending and self.pending[0]["update_id"] < offset:
+            self.pending.popleft()
+
+        if not self.pending and timeout > 0:
+            self.has_updates.clear()
+            try:
+                await asyncio.wait_for(self.has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return [self.pending[i] for i in range(min(limit, len(self.pending)))]
+
+    def _check_limits(self, chat_id: int):
+        now = time.monotonic()
+        if chat_id in self.blocked:
+            self.rejected_403 += 1
+            raise BotAPIError(403, "Forbidden: bot was blocked by the user")
+        if not self.rate_limit:
+            return
+
+        while self.recent_sends and now - self.recent_sends[0] >= 1.0:
+            self.recent_sends.popleft()
+        last = self.last_send_per_chat.get(chat_id)
+        if len(self.recent_sends) >= self.rate_limit or (last and now - last < self.per_chat_interval):
+            self.rejected_429 += 1
+            raise BotAPIError(429, "Too Many Requests: retry after 1", {"retry_after": 1})
+        self.recent_sends.append(now)
+        self.last_send_per_chat[chat_id] = now
+
+    async def m_sendmessage(self, params):
+        chat_id = int(params["chat_id"])
+        self._check_limits(chat_id)
+        self.sent += 1
+        self.sent_per_chat[chat_id] = self.sent_per_chat.get(chat_id, 0) + 1
+        self.last_sent_at = time.perf_counter()
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def m_setwebhook(self, params):
+        self.webhook_url = params.get("url", "")
+        self.webhook_secret = params.get("secret_token", "")
+        self.webhook_max_connections = int(params.get("max_connections") or 40)
+        return True
+
+    async def m_deletewebhook(self, params):
+        self.webhook_url = ""
+        if str(params.get("drop_pending_updates", "")).lower() == "true":
+            self.pending.clear()
+        return True
+
+    async def m_getwebhookinfo(self, params):
+        return {"url": self.webhook_url, "has_custom_certificate": False,
+                "pending_update_count": len(self.pending)}
+
+    # ---------- инъекция апдейтов ----------
+    async def inject(self, updates: list):
+        if self.first_inject_at is None:
+            self.first_inject_at = time.perf_counter()
+        self.injected += len(updates)
+
+        if not self.webhook_url:
+            self.pending.extend(updates)
+            self.has_updates.set()
+            return
+
+        # Как и Telegram: разные чаты параллельно (до max_connections),
+        # апдейты одного чата — по очереди
+        semaphore = asyncio.Semaphore(self.webhook_max_connections)
+        chat_locks = {}
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret} if self.webhook_secret else {}
+
+        async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(
+                max_connections=self.webhook_max_connections)) as client:
+
+            async def deliver(update):
+                lock = chat_locks.setdefault(_update_chat_id(update), asyncio.Lock())
+                async with lock, semaphore:
+                    try:
+                        r = await client.post(self.webhook_url, json=update, headers=headers)
+                        if r.status_code != 200:
+                            self.webhook_errors += 1
+                    except httpx.HTTPError:
+                        self.webhook_errors += 1
+
+            await asyncio.gather(*(deliver(u) for u in updates))
+
+    def build_start_updates(self, users: int, per_user: int = 1, first_user_id: int = 1000) -> list:
+        updates = []
+        for _ in range(per_user):
+            for i in range(users):
+                updates.append(make_start_update(self.next_update_id, first_user_id + i))
+                self.next_update_id += 1
+        return updates
+
+
+async def _read_params(request: Request) -> dict:
+    body = await request.body()
+    params = dict(request.query_params)
+    if not body:
+        return params
+    ctype = request.headers.get("content-type", "")
+    if "json" in ctype:
+        params.update(json.loads(body))
+    else:
+        params.update(parse_qsl(body.decode()))
+    return params
+
+
+def create_fake_app(latency_ms: int = FAKE_TG_LATENCY_MS,
+                    backend_latency_ms: int = FAKE_BACKEND_LATENCY_MS,
+                    rate_limit: int = FAKE_TG_RATE_LIMIT) -> FastAPI:
+    api = FastAPI(title="Fake Telegram Bot API", docs_url=None, redoc_url=None)
+    fake = api.state.fake = FakeTelegram(latency_ms, backend_latency_ms, rate_limit)
+
+    @api.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def bot_method(token: str, method: str, request: Request):
+        params = await _read_params(request)
+        try:
+            result = await fake.call(method, params)
+        except BotAPIError as e:
+            content = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.parameters:
+                content["parameters"] = e.parameters
+            return JSONResponse(status_code=e.code, content=content)
+        except (KeyError, ValueError) as e:
+            return JSONResponse(status_code=400, content={
+                "ok": False, "error_code": 400, "description": f"Bad Request: {e}"})
+        return {"ok": True, "result": result}
+
+    @api.post("/fake/inject")
+    async def inject(request: Request):
+        """{"users": 1000, "per_user": 1} или {"updates": [...]}"""
+        data = await request.json()
+        updates = data.get("updates") or fake.build_start_updates(
+            int(data.get("users", 1)), int(data.get("per_user", 1)), int(data.get("first_user_id", 1000)))
+        # Доставка в webhook идёт в фоне, чтобы клиент бенчмарка не ждал её
+        asyncio.get_running_loop().create_task(fake.inject(updates))
+        return {"ok": True, "injected": len(updates)}
+
+    @api.post("/fake/config")
+    async def config(request: Request):
+        """{"rate_limit": 30, "per_chat_interval": 1.0, "blocked": [1001, 1002]}"""
+        data = await request.json()
+        if "rate_limit" in data:
+            fake.rate_limit = int(data["rate_limit"])
+        if "per_chat_interval" in data:
+            fake.per_chat_interval = float(data["per_chat_interval"])
+        if "blocked" in data:
+            fake.blocked = {int(x) for x in data["blocked"]}
+        return {"ok": True}
+
+    @api.get("/fake/stats")
+    async def stats():
+        return fake.stats()
+
+    @api.post("/fake/reset")
+    async def reset():
+        fake.reset()
+        return {"ok": True}
+
+    # ---------- имитация бэкенда ----------
+    @api.post("/api/user/upsert")
+    @api.post("/api/referral/claim_start")
+    async def backend_stub():
+        fake.backend_calls += 1
+        if fake.backend_latency:
+            await asyncio.sleep(fake.backend_latency)
+        return {"ok": True}
+
+    return api
+
+
+app = create_fake_app()
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("FAKE_TG_PORT", "8081")), log_level="warning")
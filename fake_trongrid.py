@@ -0,0 +1,124 @@
+"""Локальный фейковый TronGrid для нагрузочных тестов оплаты.
+
+Запуск:
+    python fake_trongrid.py                         # порт FAKE_TRON_PORT (8091)
+    TRONGRID_BASE=http://127.0.0.1:8091 TRON_RECEIVE_ADDRESS=TFake... uvicorn app:app
+
+Отвечает на GET /v1/accounts/{address}/transactions/trc20 в формате TronGrid.
+«Оплата» счёта — POST /fake/pay {"amount": 10.0123}: появляется подтверждённая
+TRC20-транзакция на эту сумму. Задержка ответа и лимит запросов (429, как у
+TronGrid без API-ключа) настраиваются через POST /fake/config.
+"""
+import os
+import time
+import asyncio
+import hashlib
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FAKE_TRON_LATENCY_MS = int(os.getenv("FAKE_TRON_LATENCY_MS", "150"))
+# 0 — без ограничений
+FAKE_TRON_RATE_LIMIT = int(os.getenv("FAKE_TRON_RATE_LIMIT", "0"))
+
+USDT_CONTRACT = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+
+
+class FakeTronGrid:
+    def __init__(self, latency_ms: int = 0, rate_limit: int = 0):
+        self.latency = latency_ms / 1000
+        self.rate_limit = rate_limit
+        self.reset()
+
+    def reset(self):
+        self.transactions = []
+        self.requests = 0
+        self.rejected_429 = 0
+        self._window = deque()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "rejected_429": self.rejected_429,
+            "transactions": len(self.transactions),
+        }
+
+    def pay(self, amount: float, to: str = None) -> dict:
+        n = len(self.transactions) + 1
+        tx = {
+            "transaction_id": hashlib.sha256(f"fake-tx-{n}-{amount}".encode()).hexdigest(),
+            "value": str(int(round(amount * 1_000_000))),
+            "block_timestamp": int(time.time() * 1000),
+            "from": "TFakePayer",
+            "to": to,
+            "type": "Transfer",
+            "token_info": {"address": USDT_CONTRACT, "symbol": "USDT", "decimals": 6},
+        }
+        self.transactions.append(tx)
+        return tx
+
+    def _limited(self) -> bool:
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        while self._window and now - self._window[0] >= 1.0:
+            self._window.popleft()
+        if len(self._window) >= self.rate_limit:
+            return True
+        self._window.append(now)
+        return False
+
+    async def trc20(self, address: str, limit: int) -> list:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        txs = [tx for tx in self.transactions if tx["to"] in (None, address)]
+        txs.sort(key=lambda tx: tx["block_timestamp"], reverse=True)
+        return [dict(tx, to=address) for tx in txs[:limit]]
+
+
+def create_fake_app(latency_ms: int = FAKE_TRON_LATENCY_MS, rate_limit: int = FAKE_TRON_RATE_LIMIT) -> FastAPI:
+    api = FastAPI(title="Fake TronGrid", docs_url=None, redoc_url=None)
+    fake = api.state.fake = FakeTronGrid(latency_ms, rate_limit)
+
+    @api.get("/v1/accounts/{address}/transactions/trc20")
+    async def trc20(address: str, limit: int = 20):
+        if fake._limited():
+            fake.rejected_429 += 1
+            return JSONResponse(status_code=429, content={"Error": "rate limit exceeded"})
+        return {"data": await fake.trc20(address, limit), "success": True, "meta": {"page_size": limit}}
+
+    @api.post("/fake/pay")
+    async def pay(request: Request):
+        """{"amount": 10.0123, "to": "T..."} — to необязателен"""
+        data = await request.json()
+        return {"ok": True, "tx": fake.pay(float(data["amount"]), data.get("to"))}
+
+    @api.post("/fake/config")
+    async def config(request: Request):
+        """{"latency_ms": 300, "rate_limit": 15}"""
+        data = await request.json()
+        if "latency_ms" in data:
+            fake.latency = int(data["latency_ms"]) / 1000
+        if "rate_limit" in data:
+            fake.rate_limit = int(data["rate_limit"])
+        return {"ok": True}
+
+    @api.get("/fake/stats")
+    async def stats():
+        return fake.stats()
+
+    @api.post("/fake/reset")
+    async def reset():
+        fake.reset()
+        return {"ok": True}
+
+    return api
+
+
+app = create_fake_app()
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("FAKE_TRON_PORT", "8091")), log_level="warning")
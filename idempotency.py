@@ -0,0 +1,109 @@
+"""Idempotency-Key для изменяющих запросов (тап, пачка, синхронизация, счёт, вывод).
+
+Клиент в Telegram на плохой сети повторяет запрос. С заголовком
+Idempotency-Key повтор не выполняется заново, а получает сохранённый ответ:
+
+  1. LRU в памяти воркера (IDEMPOTENCY_CACHE_SIZE ответов, не дольше
+     IDEMPOTENCY_TTL_H) — без обращения к БД;
+  2. промах — Storage.claim_request: ключ резервируется одной вставкой,
+     если его ещё нет; уже выполненный отдаёт сохранённый (status, body),
+     выполняющийся сейчас (другой воркер, параллельный ретрай) — 409,
+     брошенный резерв старше IDEMPOTENCY_CLAIM_SEC перехватывается;
+  3. после выполнения — finish_request (ответ) или release_request, если
+     ответ повторять нельзя (5xx, 429, 401 — ретрай должен выполниться).
+
+Тап и вывод средств (app.idempotent с render) резерв не пишут: промах —
+Storage.find_request (чтение), а ключ вместе с готовым ответом хранилище
+записывает в той же транзакции, что и списание или клик (Pending). Падение
+между эффектом и ответом невозможно — повтор не выполнится второй раз, и
+запрос с ключом стоит одну транзакцию записи вместо трёх. Параллельный
+повтор, записавший ключ раньше, обнаруживается внутри транзакции (Replay).
+withdrawals.idempotency_key остаётся только у заявок, созданных до этого.
+
+Ключ хранится вместе с маршрутом и telegram_id: одинаковые ключи разных
+пользователей и маршрутов не пересекаются. С ключом сохраняется отпечаток
+тела (fingerprint): тот же ключ с другой суммой или адресом получает 422,
+а не чужой ответ. Записи старше IDEMPOTENCY_TTL_H удаляет свипер (app._sweeper).
+
+Некорректный ключ — 400: клиент не должен принять его за выполненный запрос.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_TTL_H = int(os.getenv("IDEMPOTENCY_TTL_H", "24"))
+# Резерв без ответа дольше — воркер упал посреди запроса, повтор его перехватывает
+IDEMPOTENCY_CLAIM_SEC = int(os.getenv("IDEMPOTENCY_CLAIM_SEC", "60"))
+
+# Ответы, которые не сохраняются: повтор должен выполниться заново
+NOT_REPLAYED = {401, 409, 429}
+
+
+def request_key(route: str, telegram_id: int, key: str) -> str:
+    return f"{route}:{telegram_id}:{key}"
+
+
+def replayable(status: int) -> bool:
+    return status < 500 and status not in NOT_REPLAYED
+
+
+def fingerprint(body: dict) -> str:
+    """sha256 тела запроса; порядок полей не важен"""
+    raw = json.dumps(body, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class Pending:
+    """Ключ, который хранилище записывает в транзакции эффекта: render(результат хранилища) -> (status, body)"""
+
+    def __init__(self, key: str, fingerprint: str, render):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.render = render
+        self.response: Optional[Tuple[int, str]] = None
+
+    def respond(self, result) -> Optional[Tuple[int, str]]:
+        """Ответ маршрута на result; None — не сохраняется (повтор выполнится заново)"""
+        status, body = self.render(result)
+        if not replayable(status):
+            return None
+        self.response = (status, body)
+        return self.response
+
+
+class Replay(Exception):
+    """Ключ уже записан параллельным повтором: stored — (status, body, fingerprint)"""
+
+    def __init__(self, stored: Tuple[int, str, Optional[str]]):
+        super().__init__(stored[0])
+        self.stored = stored
+
+
+class ResponseCache:
+    """LRU key -> (status, body JSON, fingerprint); только завершённые запросы, не дольше ttl секунд"""
+
+    def __init__(self, size: int = IDEMPOTENCY_CACHE_SIZE, ttl: float = IDEMPOTENCY_TTL_H * 3600):
+        self.size = size
+        self.ttl = ttl
+        self.items: "OrderedDict[str, Tuple[float, int, str, Optional[str]]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[int, str, Optional[str]]]:
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            # Свипер уже удалил ключ из хранилища — повтор должен выполниться заново
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return item[1:]
+
+    def put(self, key: str, status: int, body: str, fingerprint: Optional[str] = None):
+        self.items[key] = (time.monotonic() + self.ttl, status, body, fingerprint)
+        self.items.move_to_end(key)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
@@ -0,0 +1,250 @@
+"""Метрики в текстовом формате Prometheus (/metrics) без внешних зависимостей.
+
+Запись метрики — пара операций со словарём и bisect по границам бакетов,
+без локов: обработчики app.py асинхронные и работают в одном потоке
+воркера, а потерянный инкремент из стороннего потока для метрик не страшен.
+Метрики считаются на процесс; при нескольких воркерах Prometheus собирает
+каждый отдельно (label pid в /metrics).
+
+SQLite меряется через фабрику соединений MetricsConnection: время ожидания
+лока — длительность BEGIN (или первой записи неявной транзакции), время
+транзакции — от начала до commit/rollback. Маршрут для label берётся из
+ASGI scope текущего запроса (MetricsMiddleware кладёт его в contextvar).
+"""
+import os
+import time
+import sqlite3
+from bisect import bisect_left
+from contextvars import ContextVar
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Ожидание лока дольше этого считаем срабатыванием busy_timeout
+BUSY_WAIT_SEC = 0.001
+
+REGISTRY = []
+
+_current_scope: ContextVar = ContextVar("metrics_scope", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, out: list):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} counter")
+        for key, v in sorted(self.values.items()):
+            out.append(f"{self.name}{_labels(self.labels, key)} {v}")
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=HTTP_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [счётчики по бакетам..., +Inf, sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, seconds: float, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, seconds)] += 1
+        row[-1] += seconds
+
+    def render(self, out: list):
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        names = self.labels + ("le",)
+        for key, row in sorted(self.values.items()):
+            total = 0
+            for bound, n in zip(self.buckets, row):
+                total += n
+                out.append(f"{self.name}_bucket{_labels(names, key + (bound,))} {total}")
+            total += row[len(self.buckets)]
+            out.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {total}")
+            out.append(f"{self.name}_sum{_labels(self.labels, key)} {row[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labels, key)} {total}")
+
+
+class Gauge:
+    """Значение считается в момент скрейпа функцией fn() -> число"""
+
+    def __init__(self, name: str, help: str, fn):
+        self.name, self.help, self.fn = name, help, fn
+        REGISTRY.append(self)
+
+    def render(self, out: list):
+        try:
+            value = self.fn()
+        except Exception as e:
+            out.append(f"# {self.name} unavailable: {type(e).__name__}")
+            return
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} gauge")
+        out.append(f"{self.name} {value}")
+
+
+def render() -> str:
+    out = []
+    for m in REGISTRY:
+        m.render(out)
+    out.append(f"# process pid={os.getpid()}")
+    return "\n".join(out) + "\n"
+
+
+# ================== HTTP ==================
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency",
+                         ("route", "method", "status"))
+
+
+def current_route() -> str:
+    scope = _current_scope.get()
+    if scope is None:
+        return "-"
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: латентность по шаблону маршрута (не по пути — без взрыва кардинальности)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        token = _current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_LATENCY.observe(time.perf_counter() - started, current_route(), scope["method"], status[0])
+            _current_scope.reset(token)
+
+
+# ================== SQLITE ==================
+DB_TXN = Histogram("sqlite_transaction_duration_seconds", "Write transaction duration, BEGIN to COMMIT/ROLLBACK",
+                   ("route", "outcome"), DB_BUCKETS)
+DB_LOCK_WAIT = Histogram("sqlite_lock_wait_seconds", "Time spent acquiring the write lock (BEGIN / first write)",
+                         ("route",), DB_BUCKETS)
+DB_BUSY = Counter("sqlite_busy_waits_total",
+                  f"Write transactions that waited on busy_timeout (> {BUSY_WAIT_SEC * 1000:g} ms for the lock)",
+                  ("route",))
+DB_LOCKED = Counter("sqlite_locked_errors_total", "busy_timeout exhausted: 'database is locked'", ("route",))
+
+_WRITE_HEADS = ("BEGIN", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+# Базовые методы напрямую — без super() и замыканий на каждом execute
+_perf = time.perf_counter
+_conn_execute = sqlite3.Connection.execute
+_conn_cursor = sqlite3.Connection.cursor
+_cursor_execute = sqlite3.Cursor.execute
+
+
+# SQL в коде — константы, поэтому классификацию кэшируем по строке (хэш str уже посчитан)
+_write_cache = {}
+
+
+def _is_write(sql: str) -> bool:
+    if len(_write_cache) > 4096:
+        _write_cache.clear()
+    w = _write_cache[sql] = sql.lstrip()[:7].upper().startswith(_WRITE_HEADS)
+    return w
+
+
+def _first_write(conn, execute, target, sql, args):
+    """Первый пишущий statement транзакции: меряем ожидание лока"""
+    started = _perf()
+    try:
+        result = execute(target, sql, *args)
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e):
+            DB_LOCKED.inc(current_route())
+        raise
+    waited = _perf() - started
+    route = current_route()
+    DB_LOCK_WAIT.observe(waited, route)
+    if waited > BUSY_WAIT_SEC:
+        DB_BUSY.inc(route)
+    conn._txn_started = started
+    return result
+
+
+class MetricsCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        conn = self.connection
+        if conn.in_transaction:
+            return _cursor_execute(self, sql, *args)
+        w = _write_cache.get(sql)
+        if not (_is_write(sql) if w is None else w):
+            return _cursor_execute(self, sql, *args)
+        return _first_write(conn, _cursor_execute, self, sql, args)
+
+
+class MetricsConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=MetricsConnection)"""
+    _txn_started = None
+
+    def cursor(self, factory=MetricsCursor):
+        return _conn_cursor(self, factory)
+
+    def execute(self, sql, *args):
+        if self.in_transaction:
+            return _conn_execute(self, sql, *args)
+        w = _write_cache.get(sql)
+        if not (_is_write(sql) if w is None else w):
+            return _conn_execute(self, sql, *args)
+        return _first_write(self, _conn_execute, self, sql, args)
+
+    def _end(self, outcome: str):
+        if self._txn_started is not None:
+            DB_TXN.observe(_perf() - self._txn_started, current_route(), outcome)
+            self._txn_started = None
+
+    def commit(self):
+        sqlite3.Connection.commit(self)
+        self._end("commit")
+
+    def rollback(self):
+        sqlite3.Connection.rollback(self)
+        self._end("rollback")
+
+
+# ================== TRONGRID / ИГРА ==================
+TRON_LATENCY = Histogram("trongrid_request_duration_seconds", "TronGrid API call latency", ("status",))
+TRON_ERRORS = Counter("trongrid_errors_total", "TronGrid API call failures", ("kind",))
+TAPS = Counter("taps_total", "Accepted taps by type", ("type",))
+TAP_BATCHES = Counter("tap_batches_total", "Client tap batches: applied or duplicate retry", ("result",))
+PAYMENTS_EXPIRED = Counter("payments_expired_total", "Pending invoices expired by the sweeper")
+PACKAGES_EXPIRED = Counter("packages_expired_total", "Packages reset by the background sweeper after package_expires")
+PAYMENTS_LATE = Counter("payments_late_total", "Transfers for expired invoices flagged for manual review")
+IDEMPOTENCY_LOOKUPS = Counter("idempotency_lookups_total",
+                              "Idempotency-Key lookups: worker LRU hit, storage hit, miss, in progress, or body mismatch",
+                              ("result",))
@@ -1,100 +1,370 @@
 #!/usr/bin/env python3
-import sqlite3
+"""Миграция старой «широкой» таблицы users в users + user_stats.
+
+Старая схема (backend/app.py, migration.py): одна таблица users с балансом
+и тапами, ключ — telegram_id (в самой старой версии — user_id), и payments
+по telegram_id и package_type. Новая схема (app.py): users(id, telegram_id, ...)
++ user_stats(user_id, ...), payments по user_id и package_id.
+
+Как работает:
+  * копирование идёт порциями по rowid старой таблицы; каждая порция —
+    два INSERT ... SELECT в одной транзакции вместе с чекпоинтом,
+    поэтому после прерывания миграция продолжается с последней порции;
+  * users.id в новой схеме = rowid старой строки, так что user_stats
+    заполняется без джойнов и без запросов на каждого пользователя;
+  * новые таблицы строятся рядом (users_new/user_stats_new), старая не
+    удаляется, а переименовывается в users_legacy при переключении;
+  * payments старого формата переносятся в той же транзакции переключения
+    (telegram_id -> user_id, package_type -> package_id, completed_at -> paid_at),
+    старая таблица остаётся как payments_legacy;
+  * --online: триггеры на старой таблице пишут изменённые rowid в журнал,
+    приложение продолжает работать, после копирования журнал догоняется,
+    а переключение занимает одну короткую транзакцию.
+
+    python migrate_db.py                 # офлайн
+    python migrate_db.py --online        # пока старое приложение пишет в БД
+    python migrate_db.py --status
+"""
 import os
+import sys
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
 
-DB_PATH = 'data.db'
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.db"))
 
-def migrate():
-    print("=== Миграция базы данных ===")
-    
-    conn = sqlite3.connect(DB_PATH)
+MIGRATION = "legacy_users_v1"
+SOURCE = "users"
+LEGACY = "users_legacy"
+CHANGES = "_migrate_changes"
+PAYMENTS_LEGACY = "payments_legacy"
+# package_type старых платежей -> package_id (PACKAGES в app.py и backend/app.py)
+PACKAGE_IDS = {"basic": 1, "pro": 2, "max": 3}
+
+
+def connect(db_path: str):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
     conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    
-    # 1. Проверяем текущую схему users
-    cur.execute("PRAGMA table_info(users)")
-    columns = [col[1] for col in cur.fetchall()]
-    print(f"Текущие колонки users: {columns}")
-    
-    # 2. Если нет колонки id, нужно пересоздать таблицу
-    if 'id' not in columns:
-        print("❌ Обнаружена старая схема таблицы users")
-        
-        # Сохраняем данные из старой таблицы
-        cur.execute("SELECT * FROM users")
-        old_data = cur.fetchall()
-        print(f"Найдено {len(old_data)} записей для миграции")
-        
-        # Переименовываем старую таблицу
-        cur.execute("ALTER TABLE users RENAME TO users_old")
-        print("✅ Таблица users переименована в users_old")
-        
-        # Создаем новую таблицу с правильной схемой
-        cur.execute('''
-            CREATE TABLE users (
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    # Переименования не должны переписывать ссылки FK в других таблицах
+    conn.execute("PRAGMA foreign_keys=OFF;")
+    conn.execute("PRAGMA legacy_alter_table=ON;")
+    return conn
+
+
+def table_columns(conn, table: str) -> list:
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+
+
+class MigrationRunner:
+    def __init__(self, db_path: str = DB_PATH, chunk_size: int = 50_000, online: bool = False,
+                 verbose: bool = True):
+        self.conn = connect(db_path)
+        self.chunk_size = chunk_size
+        self.online = online
+        self.verbose = verbose
+
+    def log(self, msg: str):
+        if self.verbose:
+            print(msg, flush=True)
+
+    @contextmanager
+    def _txn(self):
+        """BEGIN IMMEDIATE ... COMMIT; при любой ошибке — ROLLBACK, чекпоинт остаётся прежним"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    # ---------- состояние ----------
+    def _init_state(self):
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS _migration_state (
+            name TEXT PRIMARY KEY,
+            phase TEXT NOT NULL,
+            online INTEGER DEFAULT 0,
+            last_rowid INTEGER DEFAULT 0,
+            copied INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+    def state(self):
+        self._init_state()
+        row = self.conn.execute("SELECT * FROM _migration_state WHERE name = ?", (MIGRATION,)).fetchone()
+        return dict(row) if row else None
+
+    def _set_state(self, **fields):
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        self.conn.execute(
+            f"UPDATE _migration_state SET {sets}, updated_at = CURRENT_TIMESTAMP WHERE name = ?",
+            (*fields.values(), MIGRATION))
+
+    def needs_migration(self) -> bool:
+        cols = table_columns(self.conn, SOURCE)
+        return bool(cols) and "id" not in cols
+
+    def needs_payments(self) -> bool:
+        cols = table_columns(self.conn, "payments")
+        return bool(cols) and "user_id" not in cols
+
+    # ---------- SQL для переноса ----------
+    def _select_sql(self):
+        """SELECT-части для users и user_stats по колонкам, которые есть в старой таблице"""
+        cols = set(table_columns(self.conn, SOURCE))
+        key = "telegram_id" if "telegram_id" in cols else "user_id"
+
+        def col(name, default="NULL"):
+            return name if name in cols else default
+
+        created = ("CASE WHEN typeof(created_at) = 'integer' THEN datetime(created_at, 'unixepoch') "
+                   "ELSE COALESCE(created_at, CURRENT_TIMESTAMP) END") if "created_at" in cols else "CURRENT_TIMESTAMP"
+        # Срок пакета в новой схеме — epoch-секунды (schema.py, миграция 7)
+        expires = ("CASE WHEN typeof(package_expires) = 'text' "
+                   "THEN CAST(strftime('%s', package_expires) AS INTEGER) ELSE package_expires END"
+                   ) if "package_expires" in cols else "NULL"
+        users = (f"rowid, {key}, {col('username')}, {col('first_name')}, {col('last_name')}, "
+                 f"{created}, COALESCE({col('welcome_given', '1')}, 1), {col('last_active')}")
+        stats = (f"rowid, COALESCE({col('balance', '0')}, 0), COALESCE({col('free_taps_left', '10000')}, 10000), "
+                 f"COALESCE({col('total_taps', '0')}, 0), COALESCE({col('paid_taps_left', '0')}, 0), "
+                 f"COALESCE({col('tap_value', '0.0001')}, 0.0001), {col('package_type')}, {expires}")
+        return users, stats
+
+    def _insert_sql(self, where: str, replace: bool = False):
+        users_sel, stats_sel = self._select_sql()
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        return (
+            f"{verb} INTO users_new (id, telegram_id, username, first_name, last_name, created_at, welcome_given, "
+            f"last_active) "
+            f"SELECT {users_sel} FROM {SOURCE} WHERE {where}",
+            f"{verb} INTO user_stats_new (user_id, balance, free_taps, total_taps, package_taps_remaining, "
+            f"tap_reward, package_type, package_expires) "
+            f"SELECT {stats_sel} FROM {SOURCE} WHERE {where}",
+        )
+
+    # ---------- фазы ----------
+    def prepare(self):
+        c = self.conn
+        total = c.execute(f"SELECT COUNT(*) FROM {SOURCE}").fetchone()[0]
+        with self._txn():
+            c.execute("DROP TABLE IF EXISTS users_new")
+            c.execute("DROP TABLE IF EXISTS user_stats_new")
+            c.execute("""
+                CREATE TABLE users_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    telegram_id INTEGER UNIQUE NOT NULL,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    welcome_given BOOLEAN DEFAULT 0,
+                    last_active TEXT
+                )
+            """)
+            c.execute("""
+                CREATE TABLE user_stats_new (
+                    user_id INTEGER PRIMARY KEY,
+                    balance REAL DEFAULT 0.0,
+                    free_taps INTEGER DEFAULT 10000,
+                    total_taps INTEGER DEFAULT 0,
+                    package_taps_remaining INTEGER DEFAULT 0,
+                    tap_reward REAL DEFAULT 0.0001,
+                    package_type TEXT,
+                    package_expires TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+                )
+            """)
+            if self.online:
+                c.execute(f"CREATE TABLE IF NOT EXISTS {CHANGES} (rid INTEGER PRIMARY KEY)")
+                for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                    c.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS _migrate_{event.lower()} AFTER {event} ON {SOURCE}
+                        BEGIN INSERT OR IGNORE INTO {CHANGES} (rid) VALUES ({ref}.rowid); END
+                    """)
+            c.execute("""
+                INSERT OR REPLACE INTO _migration_state (name, phase, online, last_rowid, copied, total)
+                VALUES (?, 'copy', ?, 0, 0, ?)
+            """, (MIGRATION, int(self.online), total))
+        self.log(f"📦 {total} пользователей к переносу ({'online' if self.online else 'offline'})")
+
+    def copy(self):
+        c = self.conn
+        st = self.state()
+        last, copied, total = st["last_rowid"], st["copied"], st["total"]
+        users_sql, stats_sql = self._insert_sql("rowid > ? AND rowid <= ?")
+        started, copied_at_start = time.monotonic(), copied
+
+        while True:
+            # Верхняя граница порции по индексу rowid — без OFFSET-скана таблицы
+            hi = c.execute(
+                f"SELECT MAX(rowid) FROM (SELECT rowid FROM {SOURCE} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last, self.chunk_size)).fetchone()[0]
+            if hi is None:
+                break
+
+            with self._txn():
+                n = c.execute(users_sql, (last, hi)).rowcount
+                c.execute(stats_sql, (last, hi))
+                copied += n
+                last = hi
+                self._set_state(last_rowid=last, copied=copied)
+
+            elapsed = time.monotonic() - started
+            rate = (copied - copied_at_start) / elapsed if elapsed else 0
+            eta = (total - copied) / rate if rate else 0
+            self.log(f"   {copied}/{total} ({100 * copied / max(total, 1):.1f}%) "
+                     f"{rate:,.0f} rows/s, ETA {eta:,.0f}s")
+
+        self._set_state(phase="catchup" if self.online else "cutover")
+
+    def _apply_changes(self, limit: int = None) -> int:
+        """Перенести строки, изменённые в старой таблице после начала копирования"""
+        c = self.conn
+        users_sql, stats_sql = self._insert_sql(f"rowid IN (SELECT rid FROM {CHANGES} ORDER BY rid LIMIT ?)",
+                                                replace=True)
+        limit = limit or self.chunk_size
+        rids = "SELECT rid FROM {0} ORDER BY rid LIMIT ?".format(CHANGES)
+        # Удалённые в старой таблице строки удаляем и в новой; поиск по rowid, без скана старой таблицы
+        c.execute(f"DELETE FROM user_stats_new WHERE user_id IN ({rids}) "
+                  f"AND NOT EXISTS (SELECT 1 FROM {SOURCE} WHERE rowid = user_stats_new.user_id)", (limit,))
+        c.execute(f"DELETE FROM users_new WHERE id IN ({rids}) "
+                  f"AND NOT EXISTS (SELECT 1 FROM {SOURCE} WHERE rowid = users_new.id)", (limit,))
+        c.execute(users_sql, (limit,))
+        c.execute(stats_sql, (limit,))
+        return c.execute(f"DELETE FROM {CHANGES} WHERE rid IN ({rids})", (limit,)).rowcount
+
+    def catchup(self, max_backlog: int = None):
+        """Догоняем журнал изменений, пока он не станет меньше одной порции"""
+        c = self.conn
+        max_backlog = max_backlog or self.chunk_size
+        while True:
+            with self._txn():
+                applied = self._apply_changes()
+                backlog = c.execute(f"SELECT COUNT(*) FROM {CHANGES}").fetchone()[0]
+            self.log(f"   догоняем изменения: +{applied}, в очереди {backlog}")
+            if backlog < max_backlog:
+                break
+        self._set_state(phase="cutover")
+
+    def cutover(self):
+        """Одна транзакция: хвост журнала, снятие триггеров, переименование таблиц"""
+        c = self.conn
+        with self._txn():
+            if self.state()["online"]:
+                while self._apply_changes():
+                    pass
+                for event in ("insert", "update", "delete"):
+                    c.execute(f"DROP TRIGGER IF EXISTS _migrate_{event}")
+                c.execute(f"DROP TABLE IF EXISTS {CHANGES}")
+
+            c.execute(f"ALTER TABLE {SOURCE} RENAME TO {LEGACY}")
+            # Индексы старой таблицы занимают имена (idx_users_telegram, ...), нужные новой схеме
+            for (name,) in c.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                    (LEGACY,)).fetchall():
+                c.execute(f"DROP INDEX {name}")
+            c.execute("ALTER TABLE users_new RENAME TO users")
+            if c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'").fetchone():
+                c.execute("ALTER TABLE user_stats RENAME TO user_stats_legacy")
+            c.execute("ALTER TABLE user_stats_new RENAME TO user_stats")
+            self._carry_over()
+            self._set_state(phase="done")
+        self.log(f"✅ Переключено: старая таблица сохранена как {LEGACY}")
+
+    def _carry_over(self):
+        """Что ранние версии раннера не переносили: users.last_active и payments старого формата.
+
+        Вызывается после переименования users_new -> users, в транзакции переключения,
+        либо отдельно для базы, мигрированной раньше (run, фаза done).
+        """
+        c = self.conn
+        if "last_active" not in table_columns(c, "users"):
+            c.execute("ALTER TABLE users ADD COLUMN last_active TEXT")
+            if "last_active" in table_columns(c, LEGACY):
+                c.execute(f"UPDATE users SET last_active = (SELECT last_active FROM {LEGACY} WHERE rowid = users.id)")
+        if not self.needs_payments():
+            return
+        c.execute(f"ALTER TABLE payments RENAME TO {PAYMENTS_LEGACY}")
+        # Индексы старой таблицы (idx_payments_telegram) новой схеме не нужны
+        for (name,) in c.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (PAYMENTS_LEGACY,)).fetchall():
+            c.execute(f"DROP INDEX {name}")
+        c.execute("""
+            CREATE TABLE payments (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
+                user_id INTEGER NOT NULL,
+                package_id INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                unique_amount REAL NOT NULL,
+                status TEXT DEFAULT 'pending',
+                tx_hash TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                welcome_given BOOLEAN DEFAULT 0
+                paid_at TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
-        ''')
-        print("✅ Создана новая таблица users")
-        
-        # Переносим данные
-        for row in old_data:
-            telegram_id = row['telegram_id']
-            username = row['username']
-            first_name = row['first_name']
-            
-            cur.execute('''
-                INSERT INTO users (telegram_id, username, first_name, welcome_given)
-                VALUES (?, ?, ?, 1)
-            ''', (telegram_id, username, first_name))
-        
-        print(f"✅ Перенесено {len(old_data)} записей")
-    
-    # 3. Проверяем user_stats
-    cur.execute("SELECT COUNT(*) FROM user_stats")
-    stats_count = cur.fetchone()[0]
-    
-    if stats_count == 0:
-        print("❌ Таблица user_stats пуста, создаем записи...")
-        
-        # Создаем записи для всех пользователей
-        cur.execute("SELECT id, telegram_id FROM users")
-        users = cur.fetchall()
-        
-        for user in users:
-            user_id = user['id']
-            telegram_id = user['telegram_id']
-            
-            # Получаем данные из users_old если есть
-            cur.execute("SELECT balance, free_taps_left, paid_taps_left FROM users_old WHERE telegram_id = ?", (telegram_id,))
-            old_user = cur.fetchone()
-            
-            if old_user:
-                balance = old_user['balance']
-                free_taps = old_user['free_taps_left']
-                paid_taps = old_user['paid_taps_left']
-            else:
-                balance = 1.0
-                free_taps = 10000
-                paid_taps = 0
-            
-            cur.execute('''
-                INSERT OR REPLACE INTO user_stats 
-                (user_id, balance, free_taps, total_taps, package_taps_remaining, tap_reward)
-                VALUES (?, ?, ?, 0, ?, 0.0001)
-            ''', (user_id, balance, free_taps, paid_taps))
-            
-        print(f"✅ Создано {len(users)} записей в user_stats")
-    
-    conn.commit()
-    conn.close()
-    print("\n✅ Миграция завершена!")
+        """)
+        package_id = "CASE p.package_type " + " ".join(
+            f"WHEN '{name}' THEN {pid}" for name, pid in PACKAGE_IDS.items()) + " ELSE 0 END"
+        # Неоплаченные старые счета — истёкшие: у них нет уникальной суммы, сканер не должен их подтверждать
+        n = c.execute(f"""
+            INSERT INTO payments (id, user_id, package_id, amount, unique_amount, status, created_at, paid_at)
+            SELECT p.id, u.id, {package_id}, p.amount, p.amount,
+                   CASE p.status WHEN 'completed' THEN 'paid' WHEN 'pending' THEN 'expired' ELSE p.status END,
+                   p.created_at, p.completed_at
+            FROM {PAYMENTS_LEGACY} p JOIN users u ON u.telegram_id = p.telegram_id
+        """).rowcount
+        total = c.execute(f"SELECT COUNT(*) FROM {PAYMENTS_LEGACY}").fetchone()[0]
+        self.log(f"💳 Платежи: перенесено {n} из {total}, старая таблица сохранена как {PAYMENTS_LEGACY}")
+
+    def run(self):
+        st = self.state()
+        if st is None or st["phase"] == "done":
+            if not self.needs_migration():
+                cols = table_columns(self.conn, SOURCE)
+                if cols and (self.needs_payments() or "last_active" not in cols):
+                    with self._txn():
+                        self._carry_over()
+                self.log("✅ Схема уже новая, переносить нечего")
+                return
+            self.prepare()
+            st = self.state()
+        else:
+            self.online = bool(st["online"])
+            self.log(f"↻ Продолжаем с фазы {st['phase']}, rowid > {st['last_rowid']}")
+
+        started = time.monotonic()
+        if st["phase"] == "copy":
+            self.copy()
+        if self.state()["phase"] == "catchup":
+            self.catchup()
+        if self.state()["phase"] == "cutover":
+            self.cutover()
+        self.log(f"⏱  {time.monotonic() - started:.1f}s")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Миграция users -> users + user_stats")
+    p.add_argument("--db", default=DB_PATH)
+    p.add_argument("--chunk", type=int, default=50_000)
+    p.add_argument("--online", action="store_true", help="копировать, пока приложение пишет в старую таблицу")
+    p.add_argument("--status", action="store_true")
+    args = p.parse_args(argv)
+
+    runner = MigrationRunner(args.db, chunk_size=args.chunk, online=args.online)
+    if args.status:
+        print(runner.state() or "Миграция не запускалась")
+        return
+    print("=== Миграция базы данных ===")
+    runner.run()
+
 
 if __name__ == "__main__":
-    migrate()
+    main()
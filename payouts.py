@@ -0,0 +1,295 @@
+"""Выплаты по заявкам на вывод.
+
+API (app.py, /api/withdraw/create) атомарно списывает баланс и кладёт заявку
+в withdrawals со статусом pending. Этот воркер по расписанию собирает
+pending-заявки в пачки по сети, строит одну выплату на пачку и отдаёт её
+подписанту/бродкастеру. Одна транзакция на пачку вместо одной на заявку —
+иначе комиссии TRON и квоты TronGrid съедают всю экономику.
+
+    python payouts.py            # цикл раз в PAYOUT_INTERVAL_SEC
+    python payouts.py --once     # один проход (cron)
+
+Бродкастер выбирается через PAYOUT_BROADCASTER=module:Class, по умолчанию
+LocalPayoutBroadcaster — локальная заглушка, которая пишет пачки в JSONL.
+
+Неудачная пачка (ошибка бродкастера или воркер упал между захватом и
+отметкой — такие пачки старше PAYOUT_CLAIM_TIMEOUT_SEC подбирает следующий
+проход) повторяется тем же набором заявок: ключ идемпотентности выплаты
+считается от id заявок, поэтому отправка, которая прошла, но не дождалась
+ответа, второй раз не платит.
+
+Баланс возвращается только при однозначном отказе (PayoutRejected: сеть или
+API отклонили выплату, ничего не отправлено). Таймаут и прочие ошибки после
+отправки неоднозначны — выплата могла уйти, поэтому заявки, исчерпавшие
+попытки, уходят в статус review без возврата, на ручную проверку.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import importlib
+from contextlib import closing
+
+from schema import ensure_schema
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "data.db"))
+
+PAYOUT_INTERVAL_SEC = int(os.getenv("PAYOUT_INTERVAL_SEC", "600"))
+PAYOUT_BATCH_MAX = int(os.getenv("PAYOUT_BATCH_MAX", "100"))
+PAYOUT_MAX_ATTEMPTS = int(os.getenv("PAYOUT_MAX_ATTEMPTS", "3"))
+PAYOUT_BROADCASTER = os.getenv("PAYOUT_BROADCASTER", "payouts:LocalPayoutBroadcaster")
+PAYOUT_LOCAL_LOG = os.getenv("PAYOUT_LOCAL_LOG", os.path.join(BASE_DIR, "payouts.jsonl"))
+# Пачка в 'building' дольше — воркер упал после захвата, заявки возвращаются в очередь
+PAYOUT_CLAIM_TIMEOUT_SEC = int(os.getenv("PAYOUT_CLAIM_TIMEOUT_SEC", "900"))
+
+# Знаков у USDT в сети (BEP20-USDT — 18); суммы заявок хранятся с точностью AMOUNT_DECIMALS
+NETWORK_DECIMALS = {"TRC20": 6, "BEP20": 18, "TON": 6}
+AMOUNT_DECIMALS = 6
+
+
+# ================== DB ==================
+def get_db(db_path: str = None):
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    return conn
+
+
+# ================== BUILD ==================
+def build_payout(batch_id: int, network: str, rows) -> dict:
+    """Неподписанная выплата: один получатель на адрес, суммы в минимальных единицах"""
+    decimals = NETWORK_DECIMALS.get(network, 6)
+    outputs = {}
+    for r in rows:
+        # Сначала целые микро-USDT, потом сдвиг: float * 10**18 теряет младшие разряды
+        units = int(round(r["amount"] * 10 ** AMOUNT_DECIMALS)) * 10 ** (decimals - AMOUNT_DECIMALS)
+        outputs[r["address"]] = outputs.get(r["address"], 0) + units
+
+    transfers = [{"to": addr, "amount": units} for addr, units in sorted(outputs.items())]
+    withdrawal_ids = sorted(r["id"] for r in rows)
+    body = json.dumps({"network": network, "transfers": transfers, "withdrawal_ids": withdrawal_ids},
+                      sort_keys=True)
+    return {
+        "batch_id": batch_id,
+        "network": network,
+        "decimals": decimals,
+        "transfers": transfers,
+        "total": sum(t["amount"] for t in transfers),
+        "withdrawal_ids": withdrawal_ids,
+        # Ключ идемпотентности для подписанта — от заявок, не от batch_id: повтор той же пачки
+        # после сбоя (новый batch_id) не даст второй выплаты
+        "idempotency_key": f"payout-{network}-{hashlib.sha256(body.encode()).hexdigest()[:32]}",
+    }
+
+
+# ================== BROADCASTERS ==================
+class PayoutRejected(Exception):
+    """Выплата однозначно отклонена сетью или API и не отправлена — баланс можно вернуть"""
+
+
+class PayoutBroadcaster:
+    """Интерфейс подписанта/бродкастера: подписать и отправить выплату, вернуть tx hash.
+
+    Должен быть идемпотентным по payout["idempotency_key"]: если пачка уже
+    отправлена, вернуть прежний hash, а не платить второй раз. Отказ, после
+    которого точно ничего не ушло, — PayoutRejected; любое другое исключение
+    считается неоднозначным.
+    """
+
+    def broadcast(self, payout: dict) -> str:
+        raise NotImplementedError
+
+
+class LocalPayoutBroadcaster(PayoutBroadcaster):
+    """Заглушка для разработки и тестов: пишет пачки в JSONL, hash — детерминированный"""
+
+    def __init__(self, path: str = None):
+        self.path = path or PAYOUT_LOCAL_LOG
+        self.sent = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    rec = json.loads(line)
+                    self.sent[rec["idempotency_key"]] = rec["tx_hash"]
+
+    def broadcast(self, payout: dict) -> str:
+        key = payout["idempotency_key"]
+        if key in self.sent:
+            return self.sent[key]
+
+        tx_hash = hashlib.sha256(key.encode()).hexdigest()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**payout, "tx_hash": tx_hash, "ts": int(time.time())}) + "\n")
+        self.sent[key] = tx_hash
+        return tx_hash
+
+
+def load_broadcaster(spec: str = None) -> PayoutBroadcaster:
+    module_name, _, class_name = (spec or PAYOUT_BROADCASTER).partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+# ================== WORKER ==================
+def _claim_batch(conn, network: str, limit: int):
+    """Забрать pending-заявки сети в новую пачку (одна транзакция).
+
+    Сначала — заявки неудачной пачки (у них остался её batch_id), тем же составом:
+    иначе изменится ключ идемпотентности выплаты.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    retry = conn.execute("""
+        SELECT batch_id FROM withdrawals
+        WHERE status = 'pending' AND network = ? AND batch_id IS NOT NULL
+        ORDER BY id
+        LIMIT 1
+    """, (network,)).fetchone()
+    if retry:
+        rows = conn.execute("""
+            SELECT id, user_id, amount, address, attempts
+            FROM withdrawals
+            WHERE status = 'pending' AND network = ? AND batch_id = ?
+            ORDER BY id
+        """, (network, retry["batch_id"])).fetchall()
+    else:
+        rows = conn.execute("""
+            SELECT id, user_id, amount, address, attempts
+            FROM withdrawals
+            WHERE status = 'pending' AND network = ? AND batch_id IS NULL
+            ORDER BY id
+            LIMIT ?
+        """, (network, limit)).fetchall()
+    if not rows:
+        conn.rollback()
+        return None, []
+
+    cur = conn.execute(
+        "INSERT INTO payout_batches (network, items, total) VALUES (?, ?, ?)",
+        (network, len(rows), round(sum(r["amount"] for r in rows), 6)))
+    batch_id = cur.lastrowid
+    conn.executemany(
+        "UPDATE withdrawals SET status = 'batched', batch_id = ?, attempts = attempts + 1 WHERE id = ?",
+        [(batch_id, r["id"]) for r in rows])
+    conn.commit()
+    return batch_id, rows
+
+
+def _finish_batch(conn, batch_id: int, tx_hash: str):
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(
+        "UPDATE payout_batches SET status = 'sent', tx_hash = ?, sent_at = CURRENT_TIMESTAMP WHERE id = ?",
+        (tx_hash, batch_id))
+    conn.execute(
+        "UPDATE withdrawals SET status = 'sent', processed_at = CURRENT_TIMESTAMP WHERE batch_id = ?",
+        (batch_id,))
+    conn.commit()
+
+
+def _fail_batch(conn, batch_id: int, error: str, rejected: bool = False):
+    """Пачка не ушла: заявки обратно в очередь (с batch_id — для повтора тем же составом).
+
+    Исчерпавшие попытки: при однозначном отказе (rejected) — failed с возвратом баланса,
+    иначе — review без возврата: выплата могла уйти, как и в _reap_batches.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("UPDATE payout_batches SET status = 'failed', error = ? WHERE id = ?", (error[:500], batch_id))
+    if not rejected:
+        conn.execute("""
+            UPDATE withdrawals
+            SET status = CASE WHEN attempts >= ? THEN 'review' ELSE 'pending' END
+            WHERE batch_id = ?
+        """, (PAYOUT_MAX_ATTEMPTS, batch_id))
+        conn.commit()
+        return
+    conn.execute("""
+        UPDATE user_stats
+        SET balance = balance + (
+            SELECT COALESCE(SUM(w.amount), 0) FROM withdrawals w
+            WHERE w.batch_id = ? AND w.user_id = user_stats.user_id AND w.attempts >= ?
+        ),
+            version = version + 1
+        WHERE user_id IN (SELECT user_id FROM withdrawals WHERE batch_id = ? AND attempts >= ?)
+    """, (batch_id, PAYOUT_MAX_ATTEMPTS, batch_id, PAYOUT_MAX_ATTEMPTS))
+    conn.execute("""
+        UPDATE withdrawals
+        SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+            processed_at = CASE WHEN attempts >= ? THEN CURRENT_TIMESTAMP END
+        WHERE batch_id = ?
+    """, (PAYOUT_MAX_ATTEMPTS, PAYOUT_MAX_ATTEMPTS, batch_id))
+    conn.commit()
+
+
+def _reap_batches(conn, timeout_sec: int = PAYOUT_CLAIM_TIMEOUT_SEC) -> list:
+    """Пачки, брошенные в 'building' (воркер упал между захватом и отметкой), — заявки обратно в очередь.
+
+    Баланс не возвращается: выплата могла уйти, повтор с тем же ключом идемпотентности
+    это выяснит; исчерпавшие попытки — в review, на ручную проверку.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    ids = [r[0] for r in conn.execute("""
+        SELECT id FROM payout_batches
+        WHERE status = 'building' AND created_at < datetime('now', ?)
+    """, (f"-{int(timeout_sec)} seconds",))]
+    if not ids:
+        conn.rollback()
+        return []
+    conn.executemany(
+        "UPDATE payout_batches SET status = 'failed', error = 'claim expired' WHERE id = ?",
+        [(i,) for i in ids])
+    conn.executemany("""
+        UPDATE withdrawals SET status = CASE WHEN attempts >= ? THEN 'review' ELSE 'pending' END
+        WHERE batch_id = ? AND status = 'batched'
+    """, [(PAYOUT_MAX_ATTEMPTS, i) for i in ids])
+    conn.commit()
+    return ids
+
+
+def run_once(broadcaster: PayoutBroadcaster = None, db_path: str = None,
+             batch_max: int = PAYOUT_BATCH_MAX) -> list:
+    """Один проход по всем сетям; возвращает сводку по отправленным пачкам"""
+    broadcaster = broadcaster or load_broadcaster()
+    results = []
+    with closing(get_db(db_path)) as conn:
+        for batch_id in _reap_batches(conn):
+            print(f"♻️ payout batch #{batch_id} abandoned in 'building', requeued")
+        networks = [r[0] for r in conn.execute(
+            "SELECT DISTINCT network FROM withdrawals WHERE status = 'pending'")]
+        for network in networks:
+            while True:
+                batch_id, rows = _claim_batch(conn, network, batch_max)
+                if batch_id is None:
+                    break
+                payout = build_payout(batch_id, network, rows)
+                try:
+                    tx_hash = broadcaster.broadcast(payout)
+                except Exception as e:
+                    print(f"❌ payout batch #{batch_id} ({network}) failed: {e}")
+                    _fail_batch(conn, batch_id, str(e), rejected=isinstance(e, PayoutRejected))
+                    results.append({"batch_id": batch_id, "network": network, "items": len(rows), "error": str(e)})
+                    # Сеть/подписант недоступны — остальные пачки этой сети ждут следующего прохода
+                    break
+                _finish_batch(conn, batch_id, tx_hash)
+                results.append({"batch_id": batch_id, "network": network, "items": len(rows), "tx_hash": tx_hash})
+    return results
+
+
+def main(argv):
+    broadcaster = load_broadcaster()
+    with closing(get_db()) as conn:
+        ensure_schema(conn)
+
+    while True:
+        for r in run_once(broadcaster):
+            print(f"💸 payout {r}")
+        if "--once" in argv:
+            return 0
+        time.sleep(PAYOUT_INTERVAL_SEC)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,158 @@
+"""Семплирующий профайлер для живого воркера (без внешних зависимостей).
+
+Отдельный поток раз в 1/hz секунды снимает стеки всех потоков процесса
+(sys._current_frames) и считает одинаковые стеки. Корнем каждого стека
+ставится маршрут FastAPI: он берётся из scope в кадре MetricsMiddleware,
+который есть в цепочке await у любого обрабатываемого запроса.
+
+Ограничения:
+  * одновременно идёт не больше MAX_SESSIONS сессий, длина — до MAX_SECONDS;
+  * снятие стека держит GIL, поэтому его стоимость — прямое замедление
+    приложения; интервал между снимками держится не меньше
+    (средняя цена снимка / max_overhead), по умолчанию 2%.
+
+Результат — collapsed stacks (flamegraph.pl, speedscope, inferno) или JSON
+в формате speedscope.
+"""
+import os
+import sys
+import time
+import threading
+
+from metrics import MetricsMiddleware
+
+MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+MAX_HZ = int(os.getenv("PROFILE_MAX_HZ", "1000"))
+MAX_OVERHEAD = float(os.getenv("PROFILE_MAX_OVERHEAD", "0.02"))
+MAX_SESSIONS = 1
+
+_sessions = threading.BoundedSemaphore(MAX_SESSIONS)
+
+_MIDDLEWARE_CODE = MetricsMiddleware.__call__.__code__
+
+# Листовые кадры простаивающих потоков: event loop в select, пул потоков в ожидании
+_IDLE_LEAVES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"),
+                ("thread.py", "_worker"), ("base_events.py", "_run_once")}
+
+
+class Busy(RuntimeError):
+    pass
+
+
+class SamplingProfiler:
+    def __init__(self, hz: int = 100, include_idle: bool = False, max_overhead: float = MAX_OVERHEAD):
+        self.interval = 1.0 / max(1, min(int(hz), MAX_HZ))
+        self.include_idle = include_idle
+        self.max_overhead = max_overhead
+        self.stacks = {}
+        self.samples = 0
+        self.idle_samples = 0
+        self.sampling_sec = 0.0
+        self.duration = 0.0
+        self.throttled = False
+        self.effective_interval = self.interval
+        self._labels = {}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = self._labels[code] = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _sample(self, skip_ident: int):
+        for ident, frame in sys._current_frames().items():
+            if ident == skip_ident:
+                continue
+            leaf = frame.f_code
+            idle = (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES
+            if idle:
+                self.idle_samples += 1
+                if not self.include_idle:
+                    continue
+
+            labels, route = [], None
+            f = frame
+            while f is not None:
+                code = f.f_code
+                if code is _MIDDLEWARE_CODE and route is None:
+                    scope = f.f_locals.get("scope") or {}
+                    route = f"{scope.get('method', '')} {getattr(scope.get('route'), 'path', scope.get('path', '?'))}"
+                labels.append(self._label(code))
+                f = f.f_back
+            labels.reverse()
+            root = f"route {route}" if route else ("idle" if idle else f"thread {ident}")
+            key = (root, *labels)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def run(self, seconds: float):
+        """Семплировать seconds секунд (блокирует вызывающий поток — его стек не снимается)"""
+        if not _sessions.acquire(blocking=False):
+            raise Busy("another profiling session is running")
+        try:
+            me = threading.get_ident()
+            started = time.perf_counter()
+            deadline = started + min(seconds, MAX_SECONDS)
+            interval, avg_cost = self.interval, None
+            while True:
+                t0 = time.perf_counter()
+                if t0 >= deadline:
+                    break
+                self._sample(me)
+                cost = time.perf_counter() - t0
+                self.sampling_sec += cost
+                # Доля времени под GIL у профайлера — не выше max_overhead (по сглаженной цене снимка)
+                avg_cost = cost if avg_cost is None else 0.8 * avg_cost + 0.2 * cost
+                interval = max(self.interval, avg_cost / self.max_overhead)
+                if interval > self.interval:
+                    self.throttled = True
+                time.sleep(max(0.0, interval - cost))
+            self.duration = time.perf_counter() - started
+            self.effective_interval = interval
+        finally:
+            _sessions.release()
+        return self
+
+    # ---------- форматы ----------
+    def collapsed(self) -> str:
+        lines = [f"{';'.join(stack)} {n}" for stack, n in sorted(self.stacks.items(), key=lambda kv: -kv[1])]
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str = "profile") -> dict:
+        frames, index, samples, weights = [], {}, [], []
+        for stack, n in sorted(self.stacks.items(), key=lambda kv: -kv[1]):
+            ids = []
+            for label in stack:
+                if label not in index:
+                    index[label] = len(frames)
+                    frames.append({"name": label})
+                ids.append(index[label])
+            samples.append(ids)
+            weights.append(n)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "none",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": name,
+            "exporter": "usdt-clicker sampler",
+        }
+
+    def summary(self) -> dict:
+        return {
+            "duration_sec": round(self.duration, 3),
+            "samples": self.samples,
+            "idle_samples": self.idle_samples,
+            "interval_ms": round(self.interval * 1000, 3),
+            "effective_interval_ms": round(self.effective_interval * 1000, 3),
+            "overhead": round(self.sampling_sec / self.duration, 5) if self.duration else 0,
+            "throttled": self.throttled,
+        }
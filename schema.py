@@ -0,0 +1,367 @@
+"""Единая версионированная схема БД.
+
+Версия хранится в PRAGMA user_version. При старте воркера ensure_schema()
+читает её одним PRAGMA и, если она совпадает с SCHEMA_VERSION, не выполняет
+никакого DDL. Иначе под BEGIN IMMEDIATE (один воркер мигрирует, остальные
+ждут и перечитывают версию) применяются шаги из MIGRATIONS по порядку.
+
+Старую «широкую» таблицу users и payments по telegram_id (backend/app.py
+до v5, app.py.backup) здесь не переносим — для них есть migrate_db.py,
+который умеет работать порциями и онлайн.
+"""
+import time
+
+# Шаги миграции: (версия, название, функция(cur)). Только дописывать в конец.
+MIGRATIONS = []
+
+
+class LegacySchemaError(RuntimeError):
+    pass
+
+
+def migration(version: int, name: str):
+    def register(step):
+        MIGRATIONS.append((version, name, step))
+        return step
+    return register
+
+
+def table_columns(cur, table: str) -> list:
+    return [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def add_column(cur, table: str, column: str, decl: str):
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет (выполняется только при миграции)"""
+    if column not in table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# ================== STEPS ==================
+@migration(1, "base")
+def _base(cur):
+    """Схема app.py v3: users + user_stats, payments, processed_transactions"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        welcome_given BOOLEAN DEFAULT 0
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        balance REAL DEFAULT 0.0,
+        free_taps INTEGER DEFAULT 10000,
+        total_taps INTEGER DEFAULT 0,
+        package_taps_remaining INTEGER DEFAULT 0,
+        tap_reward REAL DEFAULT 0.0001,
+        package_type TEXT,
+        package_expires TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        package_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        unique_amount REAL NOT NULL,
+        status TEXT DEFAULT 'pending',
+        tx_hash TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        paid_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_transactions (
+        tx_hash TEXT PRIMARY KEY,
+        payment_id INTEGER,
+        amount REAL NOT NULL,
+        timestamp INTEGER NOT NULL
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_created ON payments(created_at);")
+
+
+@migration(2, "withdrawals_broadcasts")
+def _withdrawals_broadcasts(cur):
+    """Заявки на вывод и пачки выплат (payouts.py), рассылки (broadcast.py)"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        network TEXT NOT NULL,
+        address TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        idempotency_key TEXT UNIQUE,
+        batch_id INTEGER,
+        attempts INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        processed_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS payout_batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        network TEXT NOT NULL,
+        status TEXT DEFAULT 'building',
+        items INTEGER NOT NULL,
+        total REAL NOT NULL,
+        tx_hash TEXT,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        status TEXT DEFAULT 'pending',
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_queue ON withdrawals(status, network, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals(user_id, id);")
+
+
+@migration(3, "users_last_active")
+def _users_last_active(cur):
+    """last_active из широкой схемы backend/app.py"""
+    add_column(cur, "users", "last_active", "TEXT")
+
+
+@migration(4, "payments_keyset_indexes")
+def _payments_keyset_indexes(cur):
+    """История платежей и админская выгрузка постранично по (created_at, id) без сортировки.
+
+    История покрывается индексом целиком (колонки ответа в хвосте индекса);
+    (status, created_at, id) заменяет idx_payments_status — префикс status
+    остаётся для выборок pending, idx_payments_user — префикс нового индекса.
+    """
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_payments_user_history
+        ON payments(user_id, created_at, id, package_id, amount, status, paid_at);
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments(status, created_at, id);")
+    cur.execute("DROP INDEX IF EXISTS idx_payments_user;")
+    cur.execute("DROP INDEX IF EXISTS idx_payments_status;")
+
+
+@migration(5, "payments_expiry")
+def _payments_expiry(cur):
+    """Истечение счетов: занятые суммы по частичному индексу, поздние переводы на ручную проверку.
+
+    idx_payments_pending_amount — только строки со status = 'pending', размер не растёт
+    с историей платежей. Очередь истечения (от старых к новым) уже покрывает
+    idx_payments_status_created из v4.
+    """
+    add_column(cur, "payments", "expired_at", "TIMESTAMP")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_payments_pending_amount
+        ON payments(unique_amount) WHERE status = 'pending';
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS payment_reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_id INTEGER NOT NULL,
+        tx_hash TEXT UNIQUE NOT NULL,
+        amount REAL NOT NULL,
+        timestamp INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        status TEXT DEFAULT 'open',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (payment_id) REFERENCES payments(id) ON DELETE CASCADE
+    );
+    """)
+
+
+@migration(6, "tap_batches")
+def _tap_batches(cur):
+    """Применённые пачки тапов клиента: повтор той же пачки (ретрай после обрыва) не начисляет дважды"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tap_batches (
+        user_id INTEGER NOT NULL,
+        batch_id TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, batch_id),
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+    """)
+    # Чистка старых пачек свипером
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tap_batches_created ON tap_batches(created_at);")
+
+
+@migration(7, "package_expires_epoch")
+def _package_expires_epoch(cur):
+    """package_expires: ISO-строка -> целые epoch-секунды; индекс для фонового истечения пакетов.
+
+    Старые строки писались datetime.now() сервера без пояснения зоны и читаются как UTC.
+    Неразбираемое значение становится NULL (бессрочный пакет — как и раньше для пустого).
+    """
+    cur.execute("""
+        UPDATE user_stats
+        SET package_expires = CAST(strftime('%s', package_expires) AS INTEGER)
+        WHERE typeof(package_expires) = 'text'
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_stats_package_expires
+        ON user_stats(package_expires) WHERE package_expires IS NOT NULL;
+    """)
+
+
+@migration(8, "user_energy")
+def _user_energy(cur):
+    """Энергия кликов: значение и момент последней записи; NULL — полный запас (storage.energy_now)"""
+    add_column(cur, "user_stats", "energy", "REAL")
+    add_column(cur, "user_stats", "energy_ts", "REAL")
+
+
+@migration(9, "activity_days")
+def _activity_days(cur):
+    """Дневные HyperLogLog-скетчи активных пользователей (activity.py): DAU/WAU/MAU без обхода users"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS activity_days (
+        day TEXT PRIMARY KEY,
+        hll BLOB NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+    """)
+
+
+@migration(10, "daily_taps")
+def _daily_taps(cur):
+    """Дневная квота кликов: счётчик и день (YYYY-MM-DD в TAP_DAY_TZ), к которому он относится"""
+    add_column(cur, "user_stats", "daily_taps", "INTEGER DEFAULT 0")
+    add_column(cur, "user_stats", "day_stamp", "TEXT")
+
+
+@migration(11, "earn_cap_remaining")
+def _earn_cap_remaining(cur):
+    """Остаток лимита заработка, ведётся инкрементально (storage.tap_outcome, confirm_payment).
+
+    У существующих строк NULL — без ограничения; по пакету их заполняет earn_cap_backfill (v15).
+    """
+    add_column(cur, "user_stats", "earn_cap_remaining", "REAL")
+
+
+@migration(12, "idempotency_keys")
+def _idempotency_keys(cur):
+    """Ответы на запросы с Idempotency-Key (idempotency.py); status NULL — запрос ещё выполняется"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        status INTEGER,
+        response TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+    """)
+    # Чистка по TTL свипером
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at);")
+
+
+@migration(13, "user_stats_version")
+def _user_stats_version(cur):
+    """Версия строки user_stats: +1 при каждой записи; /api/sync пишет с условием WHERE version = ?"""
+    add_column(cur, "user_stats", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(14, "idempotency_fingerprint")
+def _idempotency_fingerprint(cur):
+    """Отпечаток тела запроса (idempotency.fingerprint): тот же ключ с другим телом — 422, а не чужой ответ.
+    У старых строк NULL — сверка пропускается."""
+    add_column(cur, "idempotency_keys", "fingerprint", "TEXT")
+
+
+@migration(15, "earn_cap_backfill")
+def _earn_cap_backfill(cur):
+    """earn_cap_remaining NULL (строки до v11) — без ограничения; заполняем по пакету.
+
+    Активный пакет — его cap (PACKAGES в app.py, имя или ключ backend/app.py), иначе —
+    WELCOME_CAP (storage.py). Значения на момент миграции: шаг не должен зависеть от кода.
+    """
+    cur.execute("""
+        UPDATE user_stats
+        SET earn_cap_remaining = CASE
+            WHEN package_taps_remaining > 0
+                 AND (package_expires IS NULL OR package_expires > CAST(strftime('%s', 'now') AS INTEGER))
+            THEN CASE package_type
+                WHEN 'Новичок' THEN 20.0 WHEN 'basic' THEN 20.0
+                WHEN 'Профи' THEN 125.0 WHEN 'pro' THEN 125.0
+                WHEN 'VIP' THEN 300.0 WHEN 'max' THEN 300.0
+                ELSE 1.0 END
+            ELSE 1.0 END,
+            version = version + 1
+        WHERE earn_cap_remaining IS NULL
+    """)
+
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+# ================== APPLY ==================
+# Таблицы старой схемы backend/app.py: (таблица, колонка новой схемы, которой в старой нет)
+LEGACY_TABLES = (("users", "id"), ("payments", "user_id"))
+
+
+def _check_legacy(cur):
+    """Старые users (без id) и payments (по telegram_id) — пустые убираем, с данными отправляем в migrate_db.py"""
+    for table, column in LEGACY_TABLES:
+        cols = table_columns(cur, table)
+        if not cols or column in cols:
+            continue
+        if cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})").fetchone()[0]:
+            raise LegacySchemaError(
+                f"{table} table has the legacy layout (no {column} column). "
+                "Run `python migrate_db.py` (or `--online`) before starting the app.")
+        cur.execute(f"DROP TABLE {table}")
+
+
+def ensure_schema(conn) -> dict:
+    """Привести БД к SCHEMA_VERSION. Если версия уже совпадает — только один PRAGMA."""
+    started = time.perf_counter()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == SCHEMA_VERSION:
+        return {"version": version, "applied": [], "ms": round((time.perf_counter() - started) * 1000, 3)}
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"DB schema v{version} is newer than this code (v{SCHEMA_VERSION})")
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.cursor()
+        # Пока ждали лок, другой воркер мог уже всё сделать
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        applied = []
+        if version == 0:
+            _check_legacy(cur)
+        for step_version, name, step in MIGRATIONS:
+            if step_version > version:
+                step(cur)
+                applied.append(name)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    return {"version": SCHEMA_VERSION, "applied": applied,
+            "ms": round((time.perf_counter() - started) * 1000, 3)}
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Запуск app.py в несколько воркеров с общим состоянием.
+
+    python serve.py --workers 4 --port 8000
+
+При --workers > 1 сначала поднимается брокер shared_state.py на Unix-сокете,
+путь передаётся воркерам в SHARED_STATE_SOCKET: лимитер тапов, инвалидации
+кэша пользователей и множество неоплаченных счетов становятся общими.
+С одним воркером брокер не нужен — всё живёт в памяти процесса.
+Балансы и пакеты по-прежнему только в SQLite (WAL), брокер их не хранит.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+import uvicorn
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_broker(path: str, timeout: float = 10.0) -> subprocess.Popen:
+    if os.path.exists(path):
+        os.unlink(path)
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "shared_state.py"), "--socket", path], cwd=ROOT)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if proc.poll() is not None:
+            raise RuntimeError(f"shared state broker exited with code {proc.returncode}")
+        if time.monotonic() > deadline:
+            proc.terminate()
+            raise RuntimeError(f"shared state broker did not create {path} in {timeout:g}s")
+        time.sleep(0.05)
+    return proc
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="app.py в несколько воркеров с общим состоянием")
+    p.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    p.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    p.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")))
+    p.add_argument("--socket", help="путь сокета брокера (по умолчанию во временном каталоге)")
+    p.add_argument("--log-level", default="info")
+    args = p.parse_args(argv)
+
+    broker, path = None, None
+    if args.workers > 1:
+        path = args.socket or os.path.join(tempfile.mkdtemp(prefix="clicker-"), "state.sock")
+        broker = start_broker(path)
+        # Воркеры — дочерние процессы uvicorn, окружение наследуется
+        os.environ["SHARED_STATE_SOCKET"] = path
+        print(f"🔗 {args.workers} workers, shared state broker {path}", flush=True)
+    else:
+        os.environ.pop("SHARED_STATE_SOCKET", None)
+
+    try:
+        uvicorn.run("app:app", host=args.host, port=args.port, workers=args.workers,
+                    log_level=args.log_level, app_dir=ROOT)
+    finally:
+        if broker is not None:
+            broker.terminate()
+            try:
+                broker.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                broker.kill()
+            if os.path.exists(path):
+                os.unlink(path)
+            if not args.socket:
+                os.rmdir(os.path.dirname(path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
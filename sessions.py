@@ -0,0 +1,109 @@
+"""Сессии мини-приложения: проверка Telegram initData один раз, дальше — подписанный токен.
+
+POST /api/session проверяет initData (HMAC-SHA256 по алгоритму Telegram
+WebApp, ключ — от токена бота) и выдаёт токен вида
+
+    <user_id>.<telegram_id>.<expires>.<подпись>
+
+подпись — первые 16 байт HMAC-SHA256(SESSION_SECRET, "<user_id>.<telegram_id>.<expires>")
+в base64url. Токен не хранится на сервере: любой воркер проверяет его сам.
+Проверка — один HMAC, а проверенные токены ещё и помнятся в LRU на воркер,
+так что горячий путь (/api/tap) обходится поиском в словаре.
+"""
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import urllib.parse
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# initData старше — не принимается (Telegram подписывает его при открытии приложения)
+INIT_DATA_MAX_AGE_SEC = int(os.getenv("INIT_DATA_MAX_AGE_SEC", "86400"))
+SESSION_TTL_SEC = int(os.getenv("SESSION_TTL_SEC", "86400"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+
+
+def verify_init_data(init_data: str, bot_token: str, max_age: int = INIT_DATA_MAX_AGE_SEC) -> Optional[Dict]:
+    """Поля initData (user — уже dict) или None: подпись не сошлась, устарел, нет user.id"""
+    if not init_data or not bot_token:
+        return None
+    fields = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True))
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+    secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not received.isascii() or not hmac.compare_digest(expected, received):
+        return None
+    try:
+        auth_date = int(fields.get("auth_date", "0"))
+        user = json.loads(fields.get("user", "{}"))
+        int(user["id"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if max_age and time.time() - auth_date > max_age:
+        return None
+    fields["user"] = user
+    return fields
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+class SessionTokens:
+    """Выдача и проверка токенов; cache — token -> (telegram_id, user_id, expires), LRU"""
+
+    def __init__(self, secret: bytes, ttl: int = SESSION_TTL_SEC, cache_size: int = SESSION_CACHE_SIZE):
+        self.secret = secret
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, Tuple[int, int, int]]" = OrderedDict()
+
+    def _sign(self, payload: str) -> str:
+        return _b64(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()[:16])
+
+    def issue(self, user_id: int, telegram_id: int) -> Tuple[str, int]:
+        """(токен, expires)"""
+        expires = int(time.time()) + self.ttl
+        payload = f"{user_id}.{telegram_id}.{expires}"
+        return f"{payload}.{self._sign(payload)}", expires
+
+    def verify(self, token: str) -> Optional[Tuple[int, int]]:
+        """(telegram_id, user_id) или None — подделан или истёк"""
+        now = time.time()
+        cached = self.cache.get(token)
+        if cached is not None:
+            if cached[2] <= now:
+                del self.cache[token]
+                return None
+            self.cache.move_to_end(token)
+            return cached[0], cached[1]
+
+        payload, _, signature = token.rpartition(".")
+        if not payload or not signature.isascii() or not hmac.compare_digest(self._sign(payload), signature):
+            return None
+        try:
+            user_id, telegram_id, expires = map(int, payload.split("."))
+        except ValueError:
+            return None
+        if expires <= now:
+            return None
+        self.cache[token] = (telegram_id, user_id, expires)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return telegram_id, user_id
+
+
+def session_secret(bot_token: str) -> bytes:
+    """SESSION_SECRET, иначе производный от токена бота (общий у всех воркеров), иначе случайный"""
+    configured = os.getenv("SESSION_SECRET", "").strip()
+    if configured:
+        return configured.encode()
+    if bot_token:
+        return hmac.new(b"session", bot_token.encode(), hashlib.sha256).digest()
+    # без токена бота initData всё равно не проверить; токены живут до рестарта воркера
+    return secrets.token_bytes(32)
@@ -0,0 +1,285 @@
+"""Общее состояние воркеров app.py: счётчики лимитов, инвалидации кэша, множества.
+
+Один воркер — LocalState, всё в памяти процесса. Несколько воркеров
+(serve.py --workers N) — маленький брокер на Unix-сокете, без внешних
+сервисов: serve.py запускает его отдельным процессом и передаёт путь
+воркерам в SHARED_STATE_SOCKET, каждый воркер держит одно соединение
+(BrokerState).
+
+Протокол — JSON построчно:
+    {"i": 7, "op": "incr", "a": ["tap:42:1700000000", 2.0]}  ->  {"i": 7, "r": 3}
+    {"op": "pub", "a": ["user", "42"]}   ->  остальным клиентам {"ev": "user", "m": "42"}
+
+Если брокер недоступен, вызовы бросают SharedStateError — вызывающий код
+решает, как деградировать (лимитер пропускает, кэш сбрасывается целиком).
+
+    python shared_state.py --socket /tmp/clicker-state.sock
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+SHARED_STATE_SOCKET = os.getenv("SHARED_STATE_SOCKET", "").strip()
+
+
+class SharedStateError(RuntimeError):
+    pass
+
+
+# ================== ХРАНИЛИЩЕ ==================
+class Store:
+    """Данные и операции; общие для LocalState и брокера"""
+
+    def __init__(self):
+        self.counters = {}
+        self.sets = {}
+        self._next_sweep = 0.0
+
+    def _sweep(self, now: float):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + 1.0
+        for key in [k for k, (_, exp) in self.counters.items() if exp <= now]:
+            del self.counters[key]
+
+    def incr(self, key: str, ttl: float, by: int = 1) -> int:
+        """Счётчик с временем жизни (окно лимитера); возвращает новое значение"""
+        now = time.monotonic()
+        self._sweep(now)
+        value, expires = self.counters.get(key, (0, 0.0))
+        if expires <= now:
+            value, expires = 0, now + ttl
+        value += by
+        self.counters[key] = (value, expires)
+        return value
+
+    def sinit(self, name: str, members: list) -> bool:
+        """Заполнить множество, если его ещё нет (первый воркер сидирует из БД)"""
+        if name in self.sets:
+            return False
+        self.sets[name] = set(members)
+        return True
+
+    def sadd(self, name: str, member) -> int:
+        s = self.sets.setdefault(name, set())
+        before = len(s)
+        s.add(member)
+        return len(s) - before
+
+    def srem(self, name: str, member) -> int:
+        s = self.sets.get(name)
+        if not s or member not in s:
+            return 0
+        s.discard(member)
+        return 1
+
+    def scard(self, name: str) -> int:
+        return len(self.sets.get(name, ()))
+
+    def smembers(self, name: str) -> list:
+        return sorted(self.sets.get(name, ()))
+
+    def sismember(self, name: str, member) -> bool:
+        return member in self.sets.get(name, ())
+
+
+OPS = ("incr", "sinit", "sadd", "srem", "scard", "smembers", "sismember")
+
+
+# ================== КЛИЕНТЫ ==================
+class _Base:
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """callback(channel, message) — вызывается в каждом воркере, включая опубликовавший"""
+        self._subscribers.append(callback)
+
+    def _deliver(self, channel: str, message: str):
+        for cb in self._subscribers:
+            cb(channel, message)
+
+    async def incr(self, key: str, ttl: float, by: int = 1) -> int:
+        return await self._call("incr", key, ttl, by)
+
+    async def sinit(self, name: str, members: list) -> bool:
+        return await self._call("sinit", name, list(members))
+
+    async def sadd(self, name: str, member) -> int:
+        return await self._call("sadd", name, member)
+
+    async def srem(self, name: str, member) -> int:
+        return await self._call("srem", name, member)
+
+    async def scard(self, name: str) -> int:
+        return await self._call("scard", name)
+
+    async def smembers(self, name: str) -> list:
+        return await self._call("smembers", name)
+
+    async def sismember(self, name: str, member) -> bool:
+        return await self._call("sismember", name, member)
+
+
+class LocalState(_Base):
+    mode = "local"
+
+    def __init__(self):
+        super().__init__()
+        self.store = Store()
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def _call(self, op: str, *args):
+        return getattr(self.store, op)(*args)
+
+    def publish(self, channel: str, message: str):
+        self._deliver(channel, message)
+
+
+class BrokerState(_Base):
+    mode = "broker"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.reader = self.writer = None
+        self._seq = 0
+        self._waiters = {}
+        self._task = None
+        self._retry_at = 0.0
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=2 ** 20)
+        self._task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    async def _ensure(self):
+        if self.writer is not None and not self.writer.is_closing():
+            return
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise SharedStateError("shared state broker unavailable")
+        self._retry_at = now + 1.0
+        try:
+            await self.start()
+        except OSError as e:
+            self.writer = None
+            raise SharedStateError(f"shared state broker unavailable: {e}") from e
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                if "ev" in msg:
+                    self._deliver(msg["ev"], msg["m"])
+                    continue
+                fut = self._waiters.pop(msg["i"], None)
+                if fut is not None and not fut.done():
+                    if "e" in msg:
+                        fut.set_exception(SharedStateError(msg["e"]))
+                    else:
+                        fut.set_result(msg["r"])
+        finally:
+            err = SharedStateError("shared state broker connection lost")
+            for fut in self._waiters.values():
+                if not fut.done():
+                    fut.set_exception(err)
+            self._waiters.clear()
+            if self.writer:
+                self.writer.close()
+            # Пока брокера не было, инвалидации могли потеряться — пусть подписчики сбросят всё
+            self._deliver("*", "")
+
+    async def _call(self, op: str, *args):
+        await self._ensure()
+        self._seq += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[self._seq] = fut
+        self.writer.write(json.dumps({"i": self._seq, "op": op, "a": args}).encode() + b"\n")
+        return await fut
+
+    def publish(self, channel: str, message: str):
+        """Без ожидания ответа; свой воркер получает сообщение сразу"""
+        self._deliver(channel, message)
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(json.dumps({"op": "pub", "a": [channel, message]}).encode() + b"\n")
+
+
+def create_state(path: str = None):
+    path = SHARED_STATE_SOCKET if path is None else path
+    return BrokerState(path) if path else LocalState()
+
+
+# ================== БРОКЕР ==================
+class Broker:
+    def __init__(self):
+        self.store = Store()
+        self.clients = set()
+
+    async def handle(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                op, args = msg["op"], msg.get("a", [])
+                if op == "pub":
+                    out = json.dumps({"ev": args[0], "m": args[1]}).encode() + b"\n"
+                    for other in self.clients:
+                        if other is not writer and not other.is_closing():
+                            other.write(out)
+                    continue
+                if op not in OPS:
+                    reply = {"i": msg.get("i"), "e": f"unknown op {op}"}
+                else:
+                    reply = {"i": msg.get("i"), "r": getattr(self.store, op)(*args)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                if writer.transport.get_write_buffer_size() > 2 ** 20:
+                    await writer.drain()
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+
+async def serve(path: str):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(Broker().handle, path, limit=2 ** 20)
+    print(f"🔗 shared state broker on {path}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Брокер общего состояния воркеров")
+    p.add_argument("--socket", default=SHARED_STATE_SOCKET or "/tmp/clicker-state.sock")
+    args = p.parse_args(argv)
+    try:
+        asyncio.run(serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
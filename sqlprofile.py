@@ -0,0 +1,193 @@
+"""Профилирование SQL по запросам и лог медленных запросов (включается SQL_PROFILE=1).
+
+Без SQL_PROFILE get_db() использует обычный MetricsConnection и этот модуль
+ничего не стоит. С ним каждое соединение из get_db() — ProfiledConnection:
+  * каждый statement (и COMMIT) меряется; дольше SQL_SLOW_MS — строка в лог
+    с маршрутом, текстом и замаскированными параметрами;
+  * доля SQL_PROFILE_SAMPLE запросов профилируется целиком (все statements,
+    длительность, число строк) и попадает в кольцевой буфер RECENT;
+  * запрос с заголовком X-Debug-Queries: <SQL_DEBUG_TOKEN> профилируется
+    всегда, а разбивка возвращается в ответе (Server-Timing + X-Query-Profile).
+
+set_trace_callback не используем: он отдаёт SQL с подставленными значениями,
+а параметры (telegram_id, адреса, суммы) в логи попадать не должны.
+Время statement — это execute(), т.е. подготовка и первый шаг; дочитывание
+строк fetch*() учитывается только в счётчике строк.
+"""
+import os
+import json
+import time
+import hmac
+import random
+import sqlite3
+from collections import deque
+from contextvars import ContextVar
+
+from metrics import MetricsConnection, MetricsCursor, current_route
+
+SQL_PROFILE = os.getenv("SQL_PROFILE", "").strip() == "1"
+SQL_PROFILE_SAMPLE = float(os.getenv("SQL_PROFILE_SAMPLE", "0.01"))
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))
+SQL_DEBUG_TOKEN = os.getenv("SQL_DEBUG_TOKEN", "").strip()
+SQL_PROFILE_KEEP = int(os.getenv("SQL_PROFILE_KEEP", "200"))
+
+# Последние профили сэмплированных запросов
+RECENT = deque(maxlen=SQL_PROFILE_KEEP)
+
+_profile: ContextVar = ContextVar("sql_profile", default=None)
+_perf = time.perf_counter
+
+
+def redact(params) -> list:
+    """Вместо значений — только типы (и длина строк)"""
+    if params is None:
+        return []
+    values = params.values() if isinstance(params, dict) else params
+    out = []
+    for v in values:
+        if isinstance(v, (str, bytes)):
+            out.append(f"{type(v).__name__}[{len(v)}]")
+        else:
+            out.append(type(v).__name__)
+    return out
+
+
+def _compact(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+class RequestProfile:
+    __slots__ = ("queries", "db_ms")
+
+    def __init__(self):
+        self.queries = []
+        self.db_ms = 0.0
+
+    def summary(self) -> dict:
+        return {"count": len(self.queries), "db_ms": round(self.db_ms, 3), "queries": self.queries}
+
+
+def _record(sql: str, params, ms: float):
+    """Отметить выполненный statement; возвращает запись профиля (для счётчика строк) или None"""
+    if ms >= SQL_SLOW_MS:
+        print(f"🐢 slow query {ms:.1f} ms [{current_route()}] {_compact(sql)[:500]} params={redact(params)}")
+    prof = _profile.get()
+    if prof is None:
+        return None
+    prof.db_ms += ms
+    q = {"sql": _compact(sql)[:300], "params": redact(params), "ms": round(ms, 3), "rows": 0}
+    prof.queries.append(q)
+    return q
+
+
+class ProfiledCursor(MetricsCursor):
+    _q = None
+
+    def execute(self, sql, params=()):
+        started = _perf()
+        result = MetricsCursor.execute(self, sql, params)
+        q = self._q = _record(sql, params, (_perf() - started) * 1000)
+        if q is not None and self.rowcount > 0:
+            q["rows"] = self.rowcount
+        return result
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        started = _perf()
+        result = sqlite3.Cursor.executemany(self, sql, seq)
+        q = self._q = _record(sql, seq[0] if seq else None, (_perf() - started) * 1000)
+        if q is not None:
+            q["rows"] = max(self.rowcount, 0)
+            q["batch"] = len(seq)
+        return result
+
+    def fetchone(self):
+        row = sqlite3.Cursor.fetchone(self)
+        if row is not None and self._q is not None:
+            self._q["rows"] += 1
+        return row
+
+    def fetchall(self):
+        rows = sqlite3.Cursor.fetchall(self)
+        if self._q is not None:
+            self._q["rows"] += len(rows)
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = sqlite3.Cursor.fetchmany(self, size if size is not None else self.arraysize)
+        if self._q is not None:
+            self._q["rows"] += len(rows)
+        return rows
+
+    def __next__(self):
+        row = sqlite3.Cursor.__next__(self)
+        if self._q is not None:
+            self._q["rows"] += 1
+        return row
+
+
+class ProfiledConnection(MetricsConnection):
+    def cursor(self, factory=ProfiledCursor):
+        return MetricsConnection.cursor(self, factory)
+
+    def execute(self, sql, params=()):
+        # Через свой курсор, чтобы считать строки и для conn.execute(...).fetchone()
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        started = _perf()
+        MetricsConnection.commit(self)
+        _record("COMMIT", None, (_perf() - started) * 1000)
+
+
+class QueryProfileMiddleware:
+    """Решает, профилировать ли запрос целиком, и отдаёт разбивку по X-Debug-Queries"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        debug = False
+        if SQL_DEBUG_TOKEN:
+            for name, value in scope.get("headers", ()):
+                if name == b"x-debug-queries":
+                    debug = hmac.compare_digest(value.decode("latin-1"), SQL_DEBUG_TOKEN)
+                    break
+        if not debug and random.random() >= SQL_PROFILE_SAMPLE:
+            return await self.app(scope, receive, send)
+
+        prof = RequestProfile()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if debug:
+                    body = json.dumps(prof.summary(), ensure_ascii=True, separators=(",", ":"))
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing",
+                                    f'db;dur={prof.db_ms:.3f};desc="{len(prof.queries)} queries"'.encode()))
+                    # Заголовки не резиновые — длинный профиль обрезаем
+                    headers.append((b"x-query-profile", body[:8000].encode()))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        token = _profile.set(prof)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _profile.reset(token)
+            RECENT.append({
+                "ts": int(time.time()),
+                "method": scope["method"],
+                "route": getattr(scope.get("route"), "path", scope["path"]),
+                "status": status[0],
+                "debug": debug,
+                **prof.summary(),
+            })
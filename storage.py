@@ -0,0 +1,1472 @@
+"""Хранилище игровых данных: интерфейс Storage и два движка.
+
+app.py работает с пользователями, кликами и платежами только через
+Storage — это и есть все операции, которые нужны маршрутам:
+
+    find_user / provision_user / user_stats / load_user
+    apply_taps                  — count кликов одной транзакцией
+    apply_tap_batch / prune_tap_batches — пачка клиента, не больше раза на batch_id
+    expire_packages             — сброс истёкших пакетов пачками по индексу срока
+    sync_taps                   — дельта кликов от версии клиента, оптимистично (UPDATE ... WHERE version = ?)
+    record_activity / activity_days — last_active и дневные скетчи активности (activity.py)
+    claim_request / finish_request / release_request / prune_requests / find_request — Idempotency-Key (idempotency.py)
+    create_withdrawal           — списание и заявка на вывод одной транзакцией (только SQLite)
+    create_payment / get_payment / confirm_payment
+    expire_payments / flag_late_payment — истечение счетов и поздние переводы
+    pending_payment_ids / count_pending_payments
+    payment_history / scan_payments   — постранично по ключу (created_at, id)
+
+SQLiteStorage — текущая схема (schema.py), соединение на операцию через
+переданную фабрику (app.get_db: метрики, профилирование, PRAGMA).
+Чтения идут через отдельную фабрику (app.read_db — пул read-only
+соединений, см. ReadPool): в WAL они не ждут писателей.
+
+MemoryStorage — всё в словарях процесса под одним локом, раз в
+STORAGE_SNAPSHOT_SEC секунд (если были изменения) снимок в JSON
+(запись во временный файл + os.replace), при старте — загрузка снимка.
+Изменения после последнего снимка при падении процесса теряются.
+Только один воркер: выводы, выплаты (payouts.py), рассылки и бот читают
+SQLite и этих данных не видят.
+
+Выбор движка — STORAGE_BACKEND=sqlite|memory. Общий набор проверок и
+бенчмарков для обоих — bench/storage_suite.py.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from bisect import bisect_left
+import heapq
+from typing import Optional, Dict, List, Tuple
+
+from activity import merge_registers
+from idempotency import Pending, Replay
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+STORAGE_SNAPSHOT_PATH = os.getenv("STORAGE_SNAPSHOT_PATH", "").strip()
+STORAGE_SNAPSHOT_SEC = float(os.getenv("STORAGE_SNAPSHOT_SEC", "30"))
+
+# Новый пользователь: приветственные бесплатные клики и бонус
+WELCOME_TAPS = 10000
+WELCOME_BALANCE = 1.0
+FREE_TAP_REWARD = 0.0001
+# Лимит заработка: earn_cap_remaining — сколько ещё можно заработать кликами. Новому — WELCOME_CAP,
+# покупка пакета прибавляет его cap, клик вычитает начисленное. NULL — без ограничения
+# (строки до учёта лимита в SQLite заполняет миграция earn_cap_backfill)
+WELCOME_CAP = 1.0
+# Энергия: клик тратит 1, восстанавливается со временем до потолка. Хранится только
+# (energy, energy_ts) на момент последней записи, текущее значение считается при чтении.
+# Без пакета — FREE_*, с пакетом — ENERGY_LIMITS[package_type] (заполняют app.py и backend/app.py из PACKAGES)
+FREE_ENERGY_CAP = 1000
+FREE_ENERGY_REGEN = 1.0     # в секунду
+ENERGY_LIMITS: Dict[str, Tuple[int, float]] = {}
+# sync_taps: сколько раз перечитать строку и применить дельту заново, если её изменил другой писатель
+SYNC_RETRIES = 5
+# Дневная квота кликов: (daily_taps, day_stamp) — счётчик и день, к которому он относится.
+# Другой день в TAP_DAY_TZ — счётчик считается нулём, ночной сброс по таблице не нужен.
+# Без пакета — FREE_DAILY_TAPS, с пакетом — DAILY_LIMITS[package_type] (заполняют app.py и backend/app.py)
+TAP_DAY_TZ = ZoneInfo(os.getenv("TAP_DAY_TZ", "UTC"))
+FREE_DAILY_TAPS = 10000
+DAILY_LIMITS: Dict[str, int] = {}
+
+PAYMENT_FIELDS = ("id", "user_id", "package_id", "amount", "unique_amount", "status",
+                  "tx_hash", "created_at", "paid_at", "expired_at")
+# История отдаётся из покрывающего индекса idx_payments_user_history — только эти поля
+HISTORY_FIELDS = ("id", "package_id", "amount", "status", "created_at", "paid_at")
+
+
+class StorageError(RuntimeError):
+    pass
+
+
+# ================== ОБЩАЯ ЛОГИКА ==================
+def stats_json(row) -> Dict:
+    """Статистика для API из строки user_stats (sqlite3.Row или dict)"""
+    if row is None:
+        return {
+            "balance": 0.0,
+            "free_taps": WELCOME_TAPS,
+            "total_taps": 0,
+            "package_taps": 0,
+            "tap_reward": FREE_TAP_REWARD,
+            "package_type": None,
+            "has_package": False,
+            "welcome_given": False,
+            "energy": FREE_ENERGY_CAP,
+            "energy_cap": FREE_ENERGY_CAP,
+            "energy_regen": FREE_ENERGY_REGEN,
+            "daily_taps_left": FREE_DAILY_TAPS,
+            "daily_limit": FREE_DAILY_TAPS,
+            "earn_cap_remaining": WELCOME_CAP,
+            "version": 0
+        }
+
+    return {
+        **sync_state(row, time.time()),
+        "welcome_given": bool(row['welcome_given']),
+        "version": row['version']
+    }
+
+
+def sync_state(row, now: float) -> Dict:
+    """Игровое состояние строки user_stats на момент now — всё, что /api/sync сравнивает по полям"""
+    has_package = bool(row['package_taps_remaining'] > 0 and package_active(row['package_expires'], int(now)))
+    energy_cap, energy_regen = energy_limits(row['package_type'], row['package_expires'], now)
+    daily_taps, daily_limit = daily_quota(row, now)
+
+    return {
+        "balance": float(row['balance'] or 0),
+        "free_taps": int(row['free_taps'] if row['free_taps'] is not None else WELCOME_TAPS),
+        "total_taps": int(row['total_taps'] or 0),
+        "package_taps": int(row['package_taps_remaining'] or 0),
+        "tap_reward": float(row['tap_reward'] or FREE_TAP_REWARD),
+        "package_type": row['package_type'],
+        "has_package": has_package,
+        "energy": int(energy_now(row, now)),
+        "energy_cap": energy_cap,
+        "energy_regen": energy_regen,
+        "daily_taps_left": max(0, daily_limit - daily_taps),
+        "daily_limit": daily_limit,
+        "earn_cap_remaining": row['earn_cap_remaining']
+    }
+
+
+# Итог «ни одного клика» для sync_result (повтор уже начисленной пачки)
+NO_TAPS = {"taps": 0, "earned": 0.0, "types": {}}
+
+
+def sync_result(before, after, result: Dict, client_version: int, now: float) -> Dict:
+    """Ответ sync_taps: новая версия и только изменившиеся поля.
+
+    Клиент отстал (его версия не та, к которой применили дельту) — все поля, stale=True.
+    """
+    old, new = sync_state(before, now), sync_state(after, now)
+    stale = client_version != before['version']
+    return {
+        "taps": result['taps'],
+        "earned": result['earned'],
+        "types": result['types'],
+        "version": after['version'],
+        "stale": stale,
+        "changed": {k: v for k, v in new.items() if stale or old[k] != v},
+    }
+
+
+def package_active(package_expires, now: int = None) -> bool:
+    """package_expires — epoch-секунды или NULL (бессрочно)"""
+    return package_expires is None or package_expires > (now if now is not None else int(time.time()))
+
+
+def energy_limits(package_type, package_expires, now: float) -> Tuple[int, float]:
+    """(потолок, восстановление в секунду) для пакета пользователя"""
+    limits = ENERGY_LIMITS.get(package_type)
+    if limits is None or not package_active(package_expires, int(now)):
+        return FREE_ENERGY_CAP, FREE_ENERGY_REGEN
+    return limits
+
+
+def energy_now(row, now: float) -> float:
+    """min(cap, energy + regen * прошло) — O(1), без фоновых записей; NULL — полный запас"""
+    cap, regen = energy_limits(row['package_type'], row['package_expires'], now)
+    if row['energy'] is None or row['energy_ts'] is None:
+        return float(cap)
+    return min(float(cap), row['energy'] + regen * max(0.0, now - row['energy_ts']))
+
+
+def day_stamp(now: float) -> str:
+    """День now в TAP_DAY_TZ — к нему относится daily_taps"""
+    return datetime.fromtimestamp(now, TAP_DAY_TZ).strftime("%Y-%m-%d")
+
+
+def daily_quota(row, now: float) -> Tuple[int, int]:
+    """(клики за сегодня, дневной лимит); счётчик прошлого дня — 0"""
+    limit = DAILY_LIMITS.get(row['package_type'])
+    if limit is None or not package_active(row['package_expires'], int(now)):
+        limit = FREE_DAILY_TAPS
+    used = (row['daily_taps'] or 0) if row['day_stamp'] == day_stamp(now) else 0
+    return used, limit
+
+
+def tap_outcome(*, balance, free_taps, package_taps, tap_reward, total_taps, count: int = 1,
+                package_expires: int = None, energy: float = None,
+                daily_taps: int = None, daily_limit: int = None, earn_cap: float = None) -> Dict:
+    """Результат count кликов подряд: сначала бесплатные, потом из пакета, потом «после пакета».
+
+    Пакет с истёкшим package_expires не платит: его клики обнуляются, package_expired=True —
+    вызывающий сбрасывает пакет той же записью (reset_package), не дожидаясь фонового истечения.
+    energy (energy_now) и остаток дневной квоты (daily_quota) ограничивают count: taps — сколько засчитано.
+    earn_cap (earn_cap_remaining) ограничивает earned: на границе клик доплачивает ровно остаток,
+    с исчерпанным лимитом клики не засчитываются. None — без лимита.
+    """
+    balance = float(balance or 0)
+    # 0 — законное значение (бесплатные клики кончились), дефолт только для NULL
+    free_taps = int(free_taps if free_taps is not None else WELCOME_TAPS)
+    package_taps = int(package_taps or 0)
+    tap_reward = float(tap_reward or FREE_TAP_REWARD)
+    total_taps = int(total_taps or 0)
+    package_expired = not package_active(package_expires)
+    if package_expired:
+        package_taps, tap_reward = 0, FREE_TAP_REWARD
+    if energy is not None:
+        count = max(0, min(count, int(energy)))
+    if daily_limit is not None:
+        count = max(0, min(count, daily_limit - daily_taps))
+    if earn_cap is not None and earn_cap <= 0:
+        count = 0
+
+    used_free = min(count, free_taps)
+    used_package = min(count - used_free, package_taps)
+    post = count - used_free - used_package
+    earned = (used_free + post) * FREE_TAP_REWARD + used_package * tap_reward
+    if earn_cap is not None:
+        earned = min(earned, earn_cap)
+
+    return {
+        "earned": earned,
+        "balance": balance + earned,
+        "free_taps": free_taps - used_free,
+        "package_taps": package_taps - used_package,
+        "total_taps": total_taps + count,
+        "tap_reward": tap_reward if package_taps > 0 else FREE_TAP_REWARD,
+        "types": {k: n for k, n in (("free", used_free), ("package", used_package), ("post_package", post)) if n},
+        "package_expired": package_expired,
+        "taps": count,
+        "energy": None if energy is None else energy - count,
+        "daily_taps": None if daily_limit is None else daily_taps + count,
+        "daily_taps_left": None if daily_limit is None else daily_limit - daily_taps - count,
+        "earn_cap_remaining": None if earn_cap is None else max(0.0, earn_cap - earned),
+    }
+
+
+def user_outcome(user, count: int, now: float) -> Dict:
+    """tap_outcome для строки пользователя: _tap_row в SQLite или запись MemoryStorage, поля по имени"""
+    daily_taps, daily_limit = daily_quota(user, now)
+    return tap_outcome(balance=user["balance"], free_taps=user["free_taps"],
+                       package_taps=user["package_taps_remaining"], tap_reward=user["tap_reward"],
+                       total_taps=user["total_taps"], count=count, package_expires=user["package_expires"],
+                       energy=energy_now(user, now), daily_taps=daily_taps, daily_limit=daily_limit,
+                       earn_cap=user["earn_cap_remaining"])
+
+
+def _epoch(value: str) -> Optional[int]:
+    """ISO-время без зоны (как писали до epoch) -> epoch-секунды, считая его UTC; мусор — None"""
+    try:
+        return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        return None
+
+
+def _now_sql() -> str:
+    """Как CURRENT_TIMESTAMP в SQLite (UTC)"""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ================== ИНТЕРФЕЙС ==================
+class Storage:
+    name = "base"
+    # Данные лежат в SQLite DB_PATH — их видят payouts.py, broadcast.py, bot.py
+    in_sqlite = False
+
+    def find_user(self, telegram_id: int) -> Optional[int]:
+        raise NotImplementedError
+
+    def provision_user(self, telegram_id: int) -> int:
+        """user_id; новый пользователь создаётся с приветственным бонусом"""
+        raise NotImplementedError
+
+    def user_stats(self, user_id: int) -> Dict:
+        raise NotImplementedError
+
+    def load_user(self, telegram_id: int) -> Tuple[int, Dict]:
+        user_id = self.provision_user(telegram_id)
+        return user_id, self.user_stats(user_id)
+
+    def apply_taps(self, telegram_id: int, count: int = 1, user_id: int = None,
+                   request: Pending = None) -> Optional[Dict]:
+        """tap_outcome(...) после применения, None — пользователя нет.
+
+        user_id (из сессии) — строка ищется прямо по нему, без поиска по telegram_id.
+        request — Idempotency-Key: ключ с ответом пишется той же транзакцией, что и клики;
+        ключ, уже записанный параллельным повтором, — idempotency.Replay, ничего не применено.
+        """
+        raise NotImplementedError
+
+    def apply_tap_batch(self, telegram_id: int, batch_id: str, count: int, user_id: int = None) -> Optional[Dict]:
+        """apply_taps для пачки клиента, не больше одного раза на batch_id.
+
+        Повтор уже применённой пачки ничего не начисляет и возвращает текущее
+        состояние (earned 0); в результате duplicate — был ли это повтор.
+        """
+        raise NotImplementedError
+
+    def sync_taps(self, telegram_id: int, version: int, count: int, user_id: int = None,
+                  batch_id: str = None) -> Optional[Dict]:
+        """count кликов, накопленных клиентом с версии version -> sync_result(...) + duplicate; None — пользователя нет.
+
+        Дельта применяется к текущей строке, а не к присланным значениям: клики коммутируют,
+        поэтому конфликт с другим писателем решается перечитыванием и повтором.
+        batch_id отмечается в tap_batches той же транзакцией, что и начисление (как apply_tap_batch):
+        повтор пачки не начисляет второй раз (duplicate=True) и получает текущее состояние.
+        """
+        raise NotImplementedError
+
+    def prune_tap_batches(self, cutoff: str, limit: int = 500) -> int:
+        """Забыть пачки старше cutoff (их повтор применится заново); сколько удалено"""
+        raise NotImplementedError
+
+    def expire_packages(self, now: int, limit: int = 500) -> List[int]:
+        """Сбросить пакеты с package_expires <= now, самые старые первыми; telegram_id затронутых"""
+        raise NotImplementedError
+
+    def record_activity(self, last_active: Dict[int, str], days: Dict[str, bytes]):
+        """Сброс ActivityTracker: users.last_active по telegram_id и слияние дневных скетчей"""
+        raise NotImplementedError
+
+    def activity_days(self, first: str, last: str) -> Dict[str, bytes]:
+        """Сохранённые скетчи дней first..last (YYYY-MM-DD) -> регистры"""
+        raise NotImplementedError
+
+    def claim_request(self, key: str, stale: str,
+                      fingerprint: Optional[str] = None) -> Optional[Tuple[Optional[int], Optional[str], Optional[str]]]:
+        """Зарезервировать ключ запроса с отпечатком тела. None — зарезервирован сейчас, выполняйте;
+        (status, body, fingerprint) — уже выполнен; (None, None, fingerprint) — выполняется другим запросом.
+        Резерв без ответа старше stale (воркер упал посреди запроса) перехватывается с новым отпечатком."""
+        raise NotImplementedError
+
+    def finish_request(self, key: str, status: int, body: str):
+        raise NotImplementedError
+
+    def find_request(self, key: str) -> Optional[Tuple[Optional[int], Optional[str], Optional[str]]]:
+        """(status, body, fingerprint) ключа или None — без резерва (ключ пишет транзакция эффекта, Pending)"""
+        raise NotImplementedError
+
+    def release_request(self, key: str):
+        """Снять резерв: ответ не сохраняется, повтор выполнится заново"""
+        raise NotImplementedError
+
+    def prune_requests(self, cutoff: str, limit: int = 500) -> int:
+        """Забыть ключи старше cutoff; сколько удалено"""
+        raise NotImplementedError
+
+    def create_payment(self, telegram_id: int, package_id: int, amount: float,
+                       candidates) -> Optional[Tuple[int, float]]:
+        """Счёт с первой свободной уникальной суммой из candidates -> (payment_id, unique_amount).
+
+        Сумма занята, пока у неё есть pending-счёт; истёкший счёт её освобождает.
+        None — свободных сумм среди candidates нет. Пользователь создаётся, если его нет.
+        """
+        raise NotImplementedError
+
+    def get_payment(self, telegram_id: int, payment_id: int) -> Optional[Dict]:
+        """Платёж этого пользователя (поля PAYMENT_FIELDS) или None"""
+        raise NotImplementedError
+
+    def confirm_payment(self, payment_id: int, tx: Dict, package: Dict, expires_at: int) -> bool:
+        """pending -> paid и начисление пакета (срок expires_at, epoch) атомарно; False — платёж уже не pending"""
+        raise NotImplementedError
+
+    def create_withdrawal(self, telegram_id: int, amount: float, network: str, address: str,
+                          request: Pending = None) -> Optional[Dict]:
+        """Списание amount и заявка на вывод одной транзакцией -> {"withdrawal": строка withdrawals, "balance"}.
+
+        withdrawal None — баланса не хватает, ничего не списано (и ключ request не пишется);
+        None — пользователя нет. request — как в apply_taps.
+        """
+        raise NotImplementedError
+
+    def expire_payments(self, cutoff: str, limit: int = 500) -> List[int]:
+        """pending с created_at < cutoff -> expired, самые старые первыми, не больше limit; id истёкших"""
+        raise NotImplementedError
+
+    def flag_late_payment(self, payment_id: int, tx: Dict) -> bool:
+        """Перевод на истёкший счёт — в ручную проверку.
+
+        False — перевод уже отмечен или уже оплатил другой счёт (сумма могла перейти к новому).
+        """
+        raise NotImplementedError
+
+    def pending_payment_ids(self) -> List[int]:
+        raise NotImplementedError
+
+    def count_pending_payments(self) -> int:
+        return len(self.pending_payment_ids())
+
+    def payment_history(self, telegram_id: int, limit: int = 20, before: Tuple = None) -> List[Dict]:
+        """Новые первыми (поля HISTORY_FIELDS); before=(created_at, id) — страница после этого ключа"""
+        raise NotImplementedError
+
+    def scan_payments(self, status: str = None, since: str = None, until: str = None,
+                      after: Tuple = None, limit: int = 1000) -> List[Dict]:
+        """Все платежи по возрастанию (created_at, id), since <= created_at < until; after — ключ с прошлой страницы"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# ================== SQLITE ==================
+# Сброс пакета (истёк): клики пакета обнуляются, награда — базовая
+RESET_PACKAGE_SQL = """
+    UPDATE user_stats
+    SET package_taps_remaining = 0,
+        tap_reward = ?,
+        package_type = NULL,
+        package_expires = NULL,
+        version = version + 1
+"""
+
+
+def _store_taps(cur, user_id: int, result: Dict, now: float, version: int = None) -> bool:
+    """Записать итог tap_outcome в user_stats (внутри транзакции вызывающего).
+
+    version — записать, только если строка всё ещё этой версии; False — её успел изменить другой писатель.
+    """
+    if not result['taps'] and not result['package_expired']:
+        return True  # энергии или квоты нет — писать нечего
+    cur.execute("""
+        UPDATE user_stats
+        SET balance = ?,
+            free_taps = ?,
+            package_taps_remaining = ?,
+            total_taps = ?,
+            energy = ?,
+            energy_ts = ?,
+            daily_taps = ?,
+            day_stamp = ?,
+            earn_cap_remaining = ?,
+            version = version + 1
+        WHERE user_id = ? AND (? IS NULL OR version = ?)
+    """, (result['balance'], result['free_taps'], result['package_taps'], result['total_taps'],
+          result['energy'], now, result['daily_taps'], day_stamp(now), result['earn_cap_remaining'], user_id,
+          version, version))
+    if not cur.rowcount:
+        return False
+    if result['package_expired']:
+        cur.execute(RESET_PACKAGE_SQL + " WHERE user_id = ?", (FREE_TAP_REWARD, user_id))
+    return True
+
+
+TAP_ROW_SQL = """
+    SELECT us.user_id, us.balance, us.free_taps, us.package_taps_remaining, us.tap_reward, us.total_taps,
+           us.package_type, us.package_expires, us.energy, us.energy_ts, us.daily_taps, us.day_stamp,
+           us.earn_cap_remaining, us.version
+    FROM user_stats us
+"""
+
+
+def _tap_row(cur, telegram_id: int, user_id: int = None):
+    """Строка user_stats для клика: по user_id (сессия) — по первичному ключу, иначе через users.telegram_id"""
+    if user_id:
+        return cur.execute(TAP_ROW_SQL + " WHERE us.user_id = ?", (user_id,)).fetchone()
+    return cur.execute(TAP_ROW_SQL + " JOIN users u ON u.id = us.user_id WHERE u.telegram_id = ?",
+                       (telegram_id,)).fetchone()
+
+
+def _check_request(conn, request: Optional[Pending]):
+    """Ключ уже записан параллельным повтором (после find_request) -> откат и Replay; резерв без ответа перезаписывается"""
+    if request is None:
+        return
+    row = conn.execute("SELECT status, response, fingerprint FROM idempotency_keys WHERE key = ?",
+                       (request.key,)).fetchone()
+    if row and row['status'] is not None:
+        conn.rollback()
+        raise Replay(tuple(row))
+
+
+def _save_request(cur, request: Optional[Pending], result):
+    """Ключ с ответом маршрута на result — внутри транзакции вызывающего, вместе с эффектом"""
+    response = request.respond(result) if request is not None else None
+    if response is None:
+        return
+    cur.execute("""
+        INSERT INTO idempotency_keys (key, fingerprint, status, response) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET created_at = CURRENT_TIMESTAMP, fingerprint = excluded.fingerprint,
+                                       status = excluded.status, response = excluded.response
+    """, (request.key, request.fingerprint, *response))
+
+
+def get_or_create_user(conn, telegram_id: int) -> int:
+    """Получить или создать пользователя, возвращает user_id"""
+    user_id = ensure_user(conn, telegram_id)
+    conn.commit()
+    return user_id
+
+
+def ensure_user(conn, telegram_id: int) -> int:
+    """get_or_create_user без commit — внутри транзакции вызывающего (BEGIN IMMEDIATE)"""
+    cur = conn.cursor()
+
+    # Проверяем существующего пользователя
+    cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+    row = cur.fetchone()
+
+    if row:
+        return row['id']
+
+    # Создаем нового пользователя
+    cur.execute("""
+        INSERT INTO users (telegram_id, welcome_given)
+        VALUES (?, 0)
+    """, (telegram_id,))
+
+    user_id = cur.lastrowid
+
+    # Создаем запись в статистике с приветственным бонусом
+    cur.execute("""
+        INSERT INTO user_stats (user_id, free_taps, tap_reward, balance, earn_cap_remaining)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, WELCOME_TAPS, FREE_TAP_REWARD, WELCOME_BALANCE, WELCOME_CAP))
+
+    # Отмечаем, что бонус выдан
+    cur.execute("UPDATE users SET welcome_given = 1 WHERE id = ?", (user_id,))
+    return user_id
+
+
+def get_user_stats(conn, user_id: int) -> Dict:
+    """Получить статистику пользователя"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            us.balance,
+            us.free_taps,
+            us.total_taps,
+            us.package_taps_remaining,
+            us.tap_reward,
+            us.package_type,
+            us.package_expires,
+            us.energy,
+            us.energy_ts,
+            us.daily_taps,
+            us.day_stamp,
+            us.earn_cap_remaining,
+            us.version,
+            u.welcome_given
+        FROM user_stats us
+        JOIN users u ON u.id = us.user_id
+        WHERE us.user_id = ?
+    """, (user_id,))
+    return stats_json(cur.fetchone())
+
+
+class ReadPool:
+    """Пул read-only соединений (mode=ro, query_only) отдельно от писателя.
+
+    Свободное соединение не держит открытого чтения (курсоры дочитаны или
+    собраны), поэтому не мешает чекпоинту WAL. Чтение дольше timeout_ms
+    прерывается progress handler'ом (OperationalError: interrupted) — долгий
+    снимок не даёт чекпоинту дойти до конца WAL, и тот растёт.
+    """
+
+    def __init__(self, connect, size: int = 4, timeout_ms: int = 2000):
+        self.connect = connect      # connect(path) -> sqlite3.Connection
+        self.size = size
+        self.timeout = timeout_ms / 1000
+        self.path = None
+        self.idle = []
+        self.deadlines = {}
+        self.opened = 0
+        # idle/path делят event loop и потоки asyncio.to_thread; соединения открываются и закрываются вне лока
+        self.lock = threading.Lock()
+
+    def _open(self, path: str):
+        conn = self.connect(path)
+        deadline = self.deadlines[id(conn)] = [0.0]
+        if self.timeout > 0:
+            conn.set_progress_handler(lambda: time.perf_counter() > deadline[0], 10000)
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def _discard(self, conn):
+        self.deadlines.pop(id(conn), None)
+        conn.close()
+
+    def reset(self, path: str = None):
+        """Закрыть свободные соединения (сменился файл БД или остановка)"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.path = path
+        for conn in idle:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self, path: str):
+        if path != self.path:
+            self.reset(path)
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self._open(path)
+        self.deadlines[id(conn)][0] = time.perf_counter() + self.timeout
+        try:
+            yield conn
+        finally:
+            with self.lock:
+                keep = len(self.idle) < self.size and path == self.path
+                if keep:
+                    self.idle.append(conn)
+            if not keep:
+                self._discard(conn)
+
+    def stats(self) -> Dict:
+        return {"size": self.size, "idle": len(self.idle), "opened": self.opened}
+
+
+def _payment_json(row) -> Dict:
+    return {k: row[k] for k in PAYMENT_FIELDS}
+
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+    in_sqlite = True
+
+    def __init__(self, connect, read=None):
+        # connect() -> sqlite3.Connection с row_factory = sqlite3.Row и нужными PRAGMA;
+        # read() -> context manager с соединением для чтения (по умолчанию — тот же connect)
+        self.connect = connect
+        self.read = read or (lambda: closing(connect()))
+
+    def find_user(self, telegram_id: int) -> Optional[int]:
+        with self.read() as conn:
+            row = conn.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+            return row['id'] if row else None
+
+    def provision_user(self, telegram_id: int) -> int:
+        with closing(self.connect()) as conn:
+            return get_or_create_user(conn, telegram_id)
+
+    def user_stats(self, user_id: int) -> Dict:
+        with self.read() as conn:
+            return get_user_stats(conn, user_id)
+
+    def load_user(self, telegram_id: int) -> Tuple[int, Dict]:
+        # Существующий пользователь — одним чтением; писатель нужен только новому
+        with self.read() as conn:
+            row = conn.execute("""
+                SELECT
+                    us.user_id,
+                    us.balance,
+                    us.free_taps,
+                    us.total_taps,
+                    us.package_taps_remaining,
+                    us.tap_reward,
+                    us.package_type,
+                    us.package_expires,
+                    us.energy,
+                    us.energy_ts,
+                    us.daily_taps,
+                    us.day_stamp,
+                    us.earn_cap_remaining,
+                    us.version,
+                    u.welcome_given
+                FROM users u
+                JOIN user_stats us ON us.user_id = u.id
+                WHERE u.telegram_id = ?
+            """, (telegram_id,)).fetchone()
+        if row:
+            return row['user_id'], stats_json(row)
+        with closing(self.connect()) as conn:
+            user_id = get_or_create_user(conn, telegram_id)
+            return user_id, get_user_stats(conn, user_id)
+
+    def apply_taps(self, telegram_id: int, count: int = 1, user_id: int = None,
+                   request: Pending = None) -> Optional[Dict]:
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            _check_request(conn, request)
+            row = _tap_row(cur, telegram_id, user_id)
+            if not row:
+                conn.rollback()
+                return None
+
+            now = time.time()
+            result = user_outcome(row, count, now)
+            _store_taps(cur, row['user_id'], result, now)
+            _save_request(cur, request, result)
+            conn.commit()
+            return result
+
+    def apply_tap_batch(self, telegram_id: int, batch_id: str, count: int, user_id: int = None) -> Optional[Dict]:
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            row = _tap_row(cur, telegram_id, user_id)
+            if not row:
+                conn.rollback()
+                return None
+
+            # Отметка пачки и начисление в одной транзакции: либо оба, либо ничего
+            cur.execute("INSERT OR IGNORE INTO tap_batches (user_id, batch_id, count) VALUES (?, ?, ?)",
+                        (row['user_id'], batch_id, count))
+            duplicate = cur.rowcount == 0
+            now = time.time()
+            result = user_outcome(row, 0 if duplicate else count, now)
+            if not duplicate:
+                _store_taps(cur, row['user_id'], result, now)
+            conn.commit()
+            result["duplicate"] = duplicate
+            return result
+
+    def sync_taps(self, telegram_id: int, version: int, count: int, user_id: int = None,
+                  batch_id: str = None) -> Optional[Dict]:
+        for _ in range(SYNC_RETRIES):
+            # Чтение без лока записи; запись — одним UPDATE ... WHERE version = <прочитанная>
+            with self.read() as conn:
+                row = _tap_row(conn.cursor(), telegram_id, user_id)
+            if row is None:
+                return None
+            now = time.time()
+            result = user_outcome(row, count, now)
+            with closing(self.connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                cur = conn.cursor()
+                if batch_id is not None:
+                    # Отметка пачки и начисление в одной транзакции: либо оба, либо ничего
+                    cur.execute("INSERT OR IGNORE INTO tap_batches (user_id, batch_id, count) VALUES (?, ?, ?)",
+                                (row['user_id'], batch_id, count))
+                    if cur.rowcount == 0:
+                        current = _tap_row(cur, telegram_id, row['user_id'])
+                        conn.rollback()
+                        return dict(sync_result(current, current, NO_TAPS, version, now), duplicate=True)
+                if not _store_taps(cur, row['user_id'], result, now, row['version']):
+                    conn.rollback()
+                    continue  # строку изменил другой писатель — применить дельту к новой версии
+                after = _tap_row(cur, telegram_id, row['user_id'])
+                conn.commit()
+            return dict(sync_result(row, after, result, version, now), duplicate=False)
+        raise StorageError(f"sync_taps: user {telegram_id} changed concurrently {SYNC_RETRIES} times")
+
+    def prune_tap_batches(self, cutoff: str, limit: int = 500) -> int:
+        with closing(self.connect()) as conn:
+            # WITHOUT ROWID: пачка удаляется по первичному ключу
+            cur = conn.execute("""
+                DELETE FROM tap_batches
+                WHERE (user_id, batch_id) IN (
+                    SELECT user_id, batch_id FROM tap_batches WHERE created_at < ? LIMIT ?
+                )
+            """, (cutoff, limit))
+            conn.commit()
+            return cur.rowcount
+
+    def expire_packages(self, now: int, limit: int = 500) -> List[int]:
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            # idx_user_stats_package_expires (частичный): только пользователи со сроком пакета
+            cur.execute("""
+                SELECT us.user_id, u.telegram_id
+                FROM user_stats us
+                JOIN users u ON u.id = us.user_id
+                WHERE us.package_expires <= ?
+                ORDER BY us.package_expires
+                LIMIT ?
+            """, (now, limit))
+            rows = cur.fetchall()
+            if rows:
+                cur.execute(RESET_PACKAGE_SQL + f" WHERE user_id IN ({','.join('?' * len(rows))})",
+                            (FREE_TAP_REWARD, *[r[0] for r in rows]))
+            conn.commit()
+            return [r[1] for r in rows]
+
+    def record_activity(self, last_active: Dict[int, str], days: Dict[str, bytes]):
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            cur.executemany("UPDATE users SET last_active = ? WHERE telegram_id = ?",
+                            [(ts, tg) for tg, ts in last_active.items()])
+            for day, registers in days.items():
+                row = cur.execute("SELECT hll FROM activity_days WHERE day = ?", (day,)).fetchone()
+                cur.execute("""
+                    INSERT INTO activity_days (day, hll) VALUES (?, ?)
+                    ON CONFLICT(day) DO UPDATE SET hll = excluded.hll, updated_at = CURRENT_TIMESTAMP
+                """, (day, merge_registers(row[0] if row else None, registers)))
+            conn.commit()
+
+    def activity_days(self, first: str, last: str) -> Dict[str, bytes]:
+        with self.read() as conn:
+            rows = conn.execute("SELECT day, hll FROM activity_days WHERE day BETWEEN ? AND ?",
+                                (first, last)).fetchall()
+            return {r[0]: bytes(r[1]) for r in rows}
+
+    def claim_request(self, key: str, stale: str,
+                      fingerprint: Optional[str] = None) -> Optional[Tuple[Optional[int], Optional[str], Optional[str]]]:
+        with closing(self.connect()) as conn:
+            cur = conn.execute("""
+                INSERT INTO idempotency_keys (key, fingerprint) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET created_at = CURRENT_TIMESTAMP, fingerprint = excluded.fingerprint
+                WHERE status IS NULL AND created_at < ?
+            """, (key, fingerprint, stale))
+            conn.commit()
+            if cur.rowcount:
+                return None
+            row = conn.execute("SELECT status, response, fingerprint FROM idempotency_keys WHERE key = ?",
+                               (key,)).fetchone()
+            # Между вставкой и чтением резерв могли снять — считаем, что ещё выполняется
+            return tuple(row) if row else (None, None, None)
+
+    def finish_request(self, key: str, status: int, body: str):
+        with closing(self.connect()) as conn:
+            conn.execute("UPDATE idempotency_keys SET status = ?, response = ? WHERE key = ?", (status, body, key))
+            conn.commit()
+
+    def find_request(self, key: str) -> Optional[Tuple[Optional[int], Optional[str], Optional[str]]]:
+        with self.read() as conn:
+            row = conn.execute("SELECT status, response, fingerprint FROM idempotency_keys WHERE key = ?",
+                               (key,)).fetchone()
+            return tuple(row) if row else None
+
+    def release_request(self, key: str):
+        with closing(self.connect()) as conn:
+            conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL", (key,))
+            conn.commit()
+
+    def prune_requests(self, cutoff: str, limit: int = 500) -> int:
+        with closing(self.connect()) as conn:
+            cur = conn.execute("""
+                DELETE FROM idempotency_keys
+                WHERE key IN (SELECT key FROM idempotency_keys WHERE created_at < ? LIMIT ?)
+            """, (cutoff, limit))
+            conn.commit()
+            return cur.rowcount
+
+    def create_payment(self, telegram_id: int, package_id: int, amount: float,
+                       candidates) -> Optional[Tuple[int, float]]:
+        with closing(self.connect()) as conn:
+            user_id = get_or_create_user(conn, telegram_id)
+            # Проверка суммы и вставка под одним локом записи — два воркера не займут одну сумму
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            for unique_amount in candidates:
+                # idx_payments_pending_amount: только живые счета
+                cur.execute("SELECT 1 FROM payments WHERE status = 'pending' AND unique_amount = ?", (unique_amount,))
+                if cur.fetchone() is None:
+                    break
+            else:
+                conn.rollback()
+                return None
+            cur.execute("""
+                INSERT INTO payments (user_id, package_id, amount, unique_amount, status)
+                VALUES (?, ?, ?, ?, 'pending')
+            """, (user_id, package_id, amount, unique_amount))
+            conn.commit()
+            return cur.lastrowid, unique_amount
+
+    def get_payment(self, telegram_id: int, payment_id: int) -> Optional[Dict]:
+        with self.read() as conn:
+            row = conn.execute("""
+                SELECT p.*
+                FROM payments p
+                JOIN users u ON u.id = p.user_id
+                WHERE p.id = ? AND u.telegram_id = ?
+            """, (payment_id, telegram_id)).fetchone()
+            return _payment_json(row) if row else None
+
+    def confirm_payment(self, payment_id: int, tx: Dict, package: Dict, expires_at: int) -> bool:
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            # Условие на статус: из двух параллельных проверок пакет начислит только одна
+            cur.execute("""
+                UPDATE payments
+                SET status = 'paid',
+                    tx_hash = ?,
+                    paid_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending'
+            """, (tx['tx_hash'], payment_id))
+            if cur.rowcount == 0:
+                conn.rollback()
+                return False
+
+            # Регистрируем транзакцию
+            cur.execute("""
+                INSERT OR IGNORE INTO processed_transactions (tx_hash, payment_id, amount, timestamp)
+                VALUES (?, ?, ?, ?)
+            """, (tx['tx_hash'], payment_id, tx['amount'], tx['timestamp']))
+
+            # Начисляем пакет; его cap прибавляется к остатку лимита заработка
+            cur.execute("""
+                UPDATE user_stats
+                SET package_taps_remaining = package_taps_remaining + ?,
+                    tap_reward = ?,
+                    package_type = ?,
+                    package_expires = ?,
+                    energy = NULL,
+                    energy_ts = NULL,
+                    earn_cap_remaining = COALESCE(earn_cap_remaining, 0) + ?,
+                    version = version + 1
+                WHERE user_id = (SELECT user_id FROM payments WHERE id = ?)
+            """, (package['taps'], package['reward'], package['name'], expires_at, package['cap'], payment_id))
+            conn.commit()
+            return True
+
+    def expire_payments(self, cutoff: str, limit: int = 500) -> List[int]:
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            # idx_payments_status_created: только живые счета, от старых к новым
+            cur.execute("""
+                SELECT id FROM payments
+                WHERE status = 'pending' AND created_at < ?
+                ORDER BY created_at, id
+                LIMIT ?
+            """, (cutoff, limit))
+            ids = [r[0] for r in cur.fetchall()]
+            if ids:
+                cur.execute(f"""
+                    UPDATE payments
+                    SET status = 'expired',
+                        expired_at = CURRENT_TIMESTAMP
+                    WHERE status = 'pending' AND id IN ({",".join("?" * len(ids))})
+                """, ids)
+            conn.commit()
+            return ids
+
+    def flag_late_payment(self, payment_id: int, tx: Dict) -> bool:
+        with closing(self.connect()) as conn:
+            cur = conn.execute("""
+                INSERT OR IGNORE INTO payment_reviews (payment_id, tx_hash, amount, timestamp, reason)
+                SELECT ?, ?, ?, ?, 'late_transfer'
+                WHERE NOT EXISTS (SELECT 1 FROM processed_transactions WHERE tx_hash = ?)
+            """, (payment_id, tx['tx_hash'], tx['amount'], tx['timestamp'], tx['tx_hash']))
+            conn.commit()
+            return cur.rowcount > 0
+
+    def pending_payment_ids(self) -> List[int]:
+        with self.read() as conn:
+            return [r[0] for r in conn.execute("SELECT id FROM payments WHERE status = 'pending'")]
+
+    def count_pending_payments(self) -> int:
+        with self.read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM payments WHERE status = 'pending'").fetchone()[0]
+
+    def payment_history(self, telegram_id: int, limit: int = 20, before: Tuple = None) -> List[Dict]:
+        # Обход idx_payments_user_history с конца: без сортировки и без чтения самой таблицы
+        sql = """
+            SELECT id, package_id, amount, status, created_at, paid_at
+            FROM payments
+            WHERE user_id = (SELECT id FROM users WHERE telegram_id = ?)
+        """
+        args = [telegram_id]
+        if before is not None:
+            sql += " AND (created_at, id) < (?, ?)"
+            args += before
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        with self.read() as conn:
+            rows = conn.execute(sql, (*args, limit)).fetchall()
+            return [{k: r[k] for k in HISTORY_FIELDS} for r in rows]
+
+    def scan_payments(self, status: str = None, since: str = None, until: str = None,
+                      after: Tuple = None, limit: int = 1000) -> List[Dict]:
+        # С status — idx_payments_status_created, без — idx_payments_created; OFFSET не нужен
+        where, args = [], []
+        if status is not None:
+            where.append("status = ?")
+            args.append(status)
+        if since is not None:
+            where.append("created_at >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("created_at < ?")
+            args.append(until)
+        if after is not None:
+            where.append("(created_at, id) > (?, ?)")
+            args += after
+        sql = "SELECT * FROM payments"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at, id LIMIT ?"
+        with self.read() as conn:
+            return [_payment_json(r) for r in conn.execute(sql, (*args, limit)).fetchall()]
+
+    def create_withdrawal(self, telegram_id: int, amount: float, network: str, address: str,
+                          request: Pending = None) -> Optional[Dict]:
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.cursor()
+            _check_request(conn, request)
+            cur.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+            row = cur.fetchone()
+            if not row:
+                conn.rollback()
+                return None
+            user_id = row['id']
+
+            # Списание одним UPDATE с условием — баланс не уйдёт в минус при гонке
+            cur.execute("""
+                UPDATE user_stats
+                SET balance = balance - ?,
+                    version = version + 1
+                WHERE user_id = ? AND balance >= ?
+            """, (amount, user_id, amount))
+            if cur.rowcount == 0:
+                conn.rollback()
+                return {"withdrawal": None, "balance": None}
+
+            cur.execute("""
+                INSERT INTO withdrawals (user_id, amount, network, address)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, amount, network, address))
+            withdrawal = dict(cur.execute("SELECT * FROM withdrawals WHERE id = ?", (cur.lastrowid,)).fetchone())
+            balance = float(cur.execute("SELECT balance FROM user_stats WHERE user_id = ?",
+                                        (user_id,)).fetchone()['balance'])
+            result = {"withdrawal": withdrawal, "balance": balance}
+            _save_request(cur, request, result)
+            conn.commit()
+            return result
+
+
+# ================== MEMORY ==================
+# 2: expired_at у платежей, reviews; 3: package_expires — epoch; 4: energy;
+# 5: last_active, activity (скетчи в hex); 6: daily_taps, day_stamp; 7: earn_cap_remaining;
+# 8: requests (Idempotency-Key); 9: version; 10: fingerprint у requests. Старые форматы читаются
+SNAPSHOT_FORMAT = 10
+
+# Поля записи пользователя (строка users + user_stats)
+USER_FIELDS = ("id", "telegram_id", "welcome_given", "balance", "free_taps", "total_taps",
+               "package_taps_remaining", "tap_reward", "package_type", "package_expires",
+               "energy", "energy_ts", "last_active", "daily_taps", "day_stamp",
+               "earn_cap_remaining", "version")
+
+
+class MemoryStorage(Storage):
+    name = "memory"
+
+    def __init__(self, snapshot_path: str = None, snapshot_sec: float = STORAGE_SNAPSHOT_SEC):
+        self.snapshot_path = snapshot_path
+        self.snapshot_sec = snapshot_sec
+        self.lock = threading.Lock()
+        self.users = {}             # user_id -> запись (USER_FIELDS)
+        self.by_telegram = {}       # telegram_id -> запись
+        self.payments = {}          # payment_id -> запись (PAYMENT_FIELDS)
+        self.user_payments = {}     # user_id -> [payment_id, ...] в порядке создания
+        self.pending = set()
+        self.pending_amounts = {}   # unique_amount -> payment_id живого счёта
+        self.processed = {}         # tx_hash -> (payment_id, amount, timestamp)
+        self.reviews = {}           # tx_hash -> (payment_id, amount, timestamp, reason)
+        self.tap_batches = {}       # (user_id, batch_id) -> (count, created_at), по времени
+        self.package_heap = []      # (package_expires, user_id); устаревшие записи пропускаются
+        self.activity = {}          # day -> регистры дневного скетча активности
+        self.requests = {}          # Idempotency-Key -> (status, body, created_at, fingerprint), по времени
+        self.next_user_id = 1
+        self.next_payment_id = 1
+        self.changes = 0
+        self.saved_changes = 0
+        self.last_snapshot = None
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load(snapshot_path)
+
+        self._stop = threading.Event()
+        self._thread = None
+        if snapshot_path and snapshot_sec > 0:
+            self._thread = threading.Thread(target=self._snapshot_loop, name="storage-snapshot", daemon=True)
+            self._thread.start()
+
+    # ---------- пользователи ----------
+    def _create_user(self, telegram_id: int) -> Dict:
+        user = {
+            "id": self.next_user_id, "telegram_id": telegram_id, "welcome_given": 1,
+            "balance": WELCOME_BALANCE, "free_taps": WELCOME_TAPS, "total_taps": 0,
+            "package_taps_remaining": 0, "tap_reward": FREE_TAP_REWARD,
+            "package_type": None, "package_expires": None, "energy": None, "energy_ts": None,
+            "last_active": None, "daily_taps": None, "day_stamp": None, "earn_cap_remaining": WELCOME_CAP,
+            "version": 0,
+        }
+        self.next_user_id += 1
+        self.users[user["id"]] = self.by_telegram[telegram_id] = user
+        self.changes += 1
+        return user
+
+    def find_user(self, telegram_id: int) -> Optional[int]:
+        user = self.by_telegram.get(telegram_id)
+        return user["id"] if user else None
+
+    def provision_user(self, telegram_id: int) -> int:
+        with self.lock:
+            user = self.by_telegram.get(telegram_id) or self._create_user(telegram_id)
+            return user["id"]
+
+    def user_stats(self, user_id: int) -> Dict:
+        with self.lock:
+            return stats_json(self.users.get(user_id))
+
+    def load_user(self, telegram_id: int) -> Tuple[int, Dict]:
+        with self.lock:
+            user = self.by_telegram.get(telegram_id) or self._create_user(telegram_id)
+            return user["id"], stats_json(user)
+
+    def apply_taps(self, telegram_id: int, count: int = 1, user_id: int = None,
+                   request: Pending = None) -> Optional[Dict]:
+        with self.lock:
+            self._check_request(request)
+            user = self.users.get(user_id) if user_id else self.by_telegram.get(telegram_id)
+            if user is None:
+                return None
+            now = time.time()
+            result = user_outcome(user, count, now)
+            self._store_taps(user, result, now)
+            self._save_request(request, result)
+            return result
+
+    def _store_taps(self, user: Dict, result: Dict, now: float):
+        if not result["taps"] and not result["package_expired"]:
+            return
+        user["energy"], user["energy_ts"] = result["energy"], now
+        user["daily_taps"], user["day_stamp"] = result["daily_taps"], day_stamp(now)
+        user["earn_cap_remaining"] = result["earn_cap_remaining"]
+        user["balance"] = result["balance"]
+        user["free_taps"] = result["free_taps"]
+        user["package_taps_remaining"] = result["package_taps"]
+        user["total_taps"] = result["total_taps"]
+        user["version"] += 1
+        if result["package_expired"]:
+            self._reset_package(user)
+        self.changes += 1
+
+    @staticmethod
+    def _reset_package(user: Dict):
+        user.update(package_taps_remaining=0, tap_reward=FREE_TAP_REWARD, package_type=None, package_expires=None,
+                    version=user["version"] + 1)
+
+    def apply_tap_batch(self, telegram_id: int, batch_id: str, count: int, user_id: int = None) -> Optional[Dict]:
+        with self.lock:
+            user = self.users.get(user_id) if user_id else self.by_telegram.get(telegram_id)
+            if user is None:
+                return None
+            key = (user["id"], batch_id)
+            duplicate = key in self.tap_batches
+            now = time.time()
+            result = user_outcome(user, 0 if duplicate else count, now)
+            if not duplicate:
+                self.tap_batches[key] = (count, _now_sql())
+                self._store_taps(user, result, now)
+            result["duplicate"] = duplicate
+            return result
+
+    def sync_taps(self, telegram_id: int, version: int, count: int, user_id: int = None,
+                  batch_id: str = None) -> Optional[Dict]:
+        with self.lock:
+            # Под локом строку никто не меняет — версия всегда совпадает с прочитанной
+            user = self.users.get(user_id) if user_id else self.by_telegram.get(telegram_id)
+            if user is None:
+                return None
+            now = time.time()
+            if batch_id is not None:
+                key = (user["id"], batch_id)
+                if key in self.tap_batches:
+                    return dict(sync_result(user, user, NO_TAPS, version, now), duplicate=True)
+                self.tap_batches[key] = (count, _now_sql())
+            before = dict(user)
+            result = user_outcome(user, count, now)
+            self._store_taps(user, result, now)
+            return dict(sync_result(before, user, result, version, now), duplicate=False)
+
+    def prune_tap_batches(self, cutoff: str, limit: int = 500) -> int:
+        with self.lock:
+            old = []
+            for key, (_, created_at) in self.tap_batches.items():
+                if created_at >= cutoff or len(old) >= limit:
+                    break
+                old.append(key)
+            for key in old:
+                del self.tap_batches[key]
+            if old:
+                self.changes += 1
+            return len(old)
+
+    def expire_packages(self, now: int, limit: int = 500) -> List[int]:
+        with self.lock:
+            expired = []
+            # Куча по сроку вместо обхода всех пользователей; запись устарела, если срок с тех пор сменился
+            while self.package_heap and self.package_heap[0][0] <= now and len(expired) < limit:
+                expires, user_id = heapq.heappop(self.package_heap)
+                user = self.users.get(user_id)
+                if user is None or user["package_expires"] != expires:
+                    continue
+                self._reset_package(user)
+                expired.append(user["telegram_id"])
+            if expired:
+                self.changes += 1
+            return expired
+
+    def record_activity(self, last_active: Dict[int, str], days: Dict[str, bytes]):
+        with self.lock:
+            for telegram_id, ts in last_active.items():
+                user = self.by_telegram.get(telegram_id)
+                if user is not None:
+                    user["last_active"] = ts
+            for day, registers in days.items():
+                self.activity[day] = merge_registers(self.activity.get(day), registers)
+            self.changes += 1
+
+    def activity_days(self, first: str, last: str) -> Dict[str, bytes]:
+        with self.lock:
+            return {day: r for day, r in self.activity.items() if first <= day <= last}
+
+    def claim_request(self, key: str, stale: str,
+                      fingerprint: Optional[str] = None) -> Optional[Tuple[Optional[int], Optional[str], Optional[str]]]:
+        with self.lock:
+            item = self.requests.get(key)
+            if item is not None and (item[0] is not None or item[2] >= stale):
+                return item[0], item[1], item[3]
+            # перехваченный резерв переезжает в конец: порядок по времени для prune_requests
+            self.requests.pop(key, None)
+            self.requests[key] = (None, None, _now_sql(), fingerprint)
+            return None
+
+    def finish_request(self, key: str, status: int, body: str):
+        with self.lock:
+            if key in self.requests:
+                _, _, created_at, fingerprint = self.requests[key]
+                self.requests[key] = (status, body, created_at, fingerprint)
+                self.changes += 1
+
+    def find_request(self, key: str) -> Optional[Tuple[Optional[int], Optional[str], Optional[str]]]:
+        with self.lock:
+            item = self.requests.get(key)
+            return (item[0], item[1], item[3]) if item else None
+
+    def _check_request(self, request: Optional[Pending]):
+        if request is None:
+            return
+        item = self.requests.get(request.key)
+        if item is not None and item[0] is not None:
+            raise Replay((item[0], item[1], item[3]))
+
+    def _save_request(self, request: Optional[Pending], result):
+        response = request.respond(result) if request is not None else None
+        if response is None:
+            return
+        self.requests.pop(request.key, None)
+        self.requests[request.key] = (*response, _now_sql(), request.fingerprint)
+        self.changes += 1
+
+    def release_request(self, key: str):
+        with self.lock:
+            if key in self.requests and self.requests[key][0] is None:
+                del self.requests[key]
+
+    def prune_requests(self, cutoff: str, limit: int = 500) -> int:
+        with self.lock:
+            old = []
+            for key, (_, _, created_at, _) in self.requests.items():
+                if created_at >= cutoff or len(old) >= limit:
+                    break
+                old.append(key)
+            for key in old:
+                del self.requests[key]
+            if old:
+                self.changes += 1
+            return len(old)
+
+    # ---------- платежи ----------
+    def create_payment(self, telegram_id: int, package_id: int, amount: float,
+                       candidates) -> Optional[Tuple[int, float]]:
+        with self.lock:
+            unique_amount = next((a for a in candidates if a not in self.pending_amounts), None)
+            if unique_amount is None:
+                return None
+            user = self.by_telegram.get(telegram_id) or self._create_user(telegram_id)
+            payment_id = self.next_payment_id
+            self.next_payment_id += 1
+            self.payments[payment_id] = {
+                "id": payment_id, "user_id": user["id"], "package_id": package_id, "amount": amount,
+                "unique_amount": unique_amount, "status": "pending", "tx_hash": None,
+                "created_at": _now_sql(), "paid_at": None, "expired_at": None,
+            }
+            self.user_payments.setdefault(user["id"], []).append(payment_id)
+            self.pending.add(payment_id)
+            self.pending_amounts[unique_amount] = payment_id
+            self.changes += 1
+            return payment_id, unique_amount
+
+    def _unpend(self, payment: Dict):
+        self.pending.discard(payment["id"])
+        if self.pending_amounts.get(payment["unique_amount"]) == payment["id"]:
+            del self.pending_amounts[payment["unique_amount"]]
+
+    def get_payment(self, telegram_id: int, payment_id: int) -> Optional[Dict]:
+        with self.lock:
+            user = self.by_telegram.get(telegram_id)
+            payment = self.payments.get(payment_id)
+            if user is None or payment is None or payment["user_id"] != user["id"]:
+                return None
+            return dict(payment)
+
+    def confirm_payment(self, payment_id: int, tx: Dict, package: Dict, expires_at: int) -> bool:
+        with self.lock:
+            payment = self.payments.get(payment_id)
+            if payment is None or payment["status"] != "pending":
+                return False
+            payment.update(status="paid", tx_hash=tx["tx_hash"], paid_at=_now_sql())
+            self._unpend(payment)
+            self.processed.setdefault(tx["tx_hash"], (payment_id, tx["amount"], tx["timestamp"]))
+            user = self.users[payment["user_id"]]
+            user["package_taps_remaining"] = (user["package_taps_remaining"] or 0) + package["taps"]
+            user["tap_reward"] = package["reward"]
+            user["package_type"] = package["name"]
+            user["package_expires"] = expires_at
+            user["energy"] = user["energy_ts"] = None
+            user["earn_cap_remaining"] = (user["earn_cap_remaining"] or 0) + package["cap"]
+            user["version"] += 1
+            heapq.heappush(self.package_heap, (expires_at, user["id"]))
+            self.changes += 1
+            return True
+
+    def expire_payments(self, cutoff: str, limit: int = 500) -> List[int]:
+        with self.lock:
+            ids = []
+            now = _now_sql()
+            # по id — это и по created_at (см. payment_history)
+            for payment_id in sorted(self.pending)[:limit]:
+                payment = self.payments[payment_id]
+                if payment["created_at"] >= cutoff:
+                    break
+                payment.update(status="expired", expired_at=now)
+                self._unpend(payment)
+                ids.append(payment_id)
+            if ids:
+                self.changes += 1
+            return ids
+
+    def flag_late_payment(self, payment_id: int, tx: Dict) -> bool:
+        with self.lock:
+            if tx["tx_hash"] in self.reviews or tx["tx_hash"] in self.processed:
+                return False
+            self.reviews[tx["tx_hash"]] = (payment_id, tx["amount"], tx["timestamp"], "late_transfer")
+            self.changes += 1
+            return True
+
+    def pending_payment_ids(self) -> List[int]:
+        with self.lock:
+            return sorted(self.pending)
+
+    def count_pending_payments(self) -> int:
+        return len(self.pending)
+
+    # Платежи создаются с растущими id и created_at, поэтому порядок (created_at, id) — это порядок id
+    def payment_history(self, telegram_id: int, limit: int = 20, before: Tuple = None) -> List[Dict]:
+        with self.lock:
+            user = self.by_telegram.get(telegram_id)
+            if user is None:
+                return []
+            ids = self.user_payments.get(user["id"], [])
+            end = len(ids) if before is None else bisect_left(ids, before[1])
+            return [{k: self.payments[i][k] for k in HISTORY_FIELDS}
+                    for i in reversed(ids[max(0, end - limit):end])]
+
+    def scan_payments(self, status: str = None, since: str = None, until: str = None,
+                      after: Tuple = None, limit: int = 1000) -> List[Dict]:
+        out = []
+        with self.lock:
+            for payment_id in range((after[1] + 1) if after else 1, self.next_payment_id):
+                p = self.payments.get(payment_id)
+                if p is None or (status is not None and p["status"] != status):
+                    continue
+                if since is not None and p["created_at"] < since:
+                    continue
+                if until is not None and p["created_at"] >= until:
+                    break
+                out.append(dict(p))
+                if len(out) >= limit:
+                    break
+        return out
+
+    # ---------- снимки ----------
+    def _export(self) -> Dict:
+        """Под локом: копия состояния кортежами (JSON собирается уже без лока)"""
+        return {
+            "format": SNAPSHOT_FORMAT,
+            "ts": int(time.time()),
+            "next_user_id": self.next_user_id,
+            "next_payment_id": self.next_payment_id,
+            "users": [tuple(u[k] for k in USER_FIELDS) for u in self.users.values()],
+            "payments": [tuple(p[k] for k in PAYMENT_FIELDS) for p in self.payments.values()],
+            "processed": [(h, *v) for h, v in self.processed.items()],
+            "reviews": [(h, *v) for h, v in self.reviews.items()],
+            "tap_batches": [(u, b, *v) for (u, b), v in self.tap_batches.items()],
+            "activity": {day: r.hex() for day, r in self.activity.items()},
+            # незавершённые резервы в снимок не попадают: после рестарта ретрай выполнится
+            "requests": [(k, *v) for k, v in self.requests.items() if v[0] is not None],
+        }
+
+    def snapshot(self, path: str = None) -> Dict:
+        """Записать снимок атомарно; возвращает {"path", "ms", "users", "payments"}"""
+        path = path or self.snapshot_path
+        if not path:
+            raise StorageError("no snapshot path")
+        started = time.perf_counter()
+        with self.lock:
+            data = self._export()
+            changes = self.changes
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"), ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.saved_changes = changes
+        self.last_snapshot = {"path": path, "ms": round((time.perf_counter() - started) * 1000, 1),
+                              "users": len(data["users"]), "payments": len(data["payments"])}
+        return self.last_snapshot
+
+    def load(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") not in range(1, SNAPSHOT_FORMAT + 1):
+            raise StorageError(f"unsupported snapshot format {data.get('format')!r} in {path}")
+        with self.lock:
+            # в старых форматах кортежи короче: недостающие поля (энергия, last_active, квота) — NULL
+            self.users = {r[0]: {**dict.fromkeys(USER_FIELDS), **dict(zip(USER_FIELDS, r))} for r in data["users"]}
+            self.by_telegram = {u["telegram_id"]: u for u in self.users.values()}
+            for u in self.users.values():
+                u["version"] = u["version"] or 0
+                if isinstance(u["package_expires"], str):
+                    u["package_expires"] = _epoch(u["package_expires"])
+            self.package_heap = [(u["package_expires"], uid) for uid, u in self.users.items()
+                                 if u["package_expires"] is not None]
+            heapq.heapify(self.package_heap)
+            self.payments = {r[0]: {"expired_at": None, **dict(zip(PAYMENT_FIELDS, r))} for r in data["payments"]}
+            self.user_payments = {}
+            for pid in sorted(self.payments):
+                self.user_payments.setdefault(self.payments[pid]["user_id"], []).append(pid)
+            self.pending = {pid for pid, p in self.payments.items() if p["status"] == "pending"}
+            self.pending_amounts = {self.payments[pid]["unique_amount"]: pid for pid in sorted(self.pending)}
+            self.processed = {r[0]: tuple(r[1:]) for r in data["processed"]}
+            self.reviews = {r[0]: tuple(r[1:]) for r in data.get("reviews", [])}
+            self.tap_batches = {(r[0], r[1]): tuple(r[2:]) for r in data.get("tap_batches", [])}
+            self.activity = {day: bytes.fromhex(r) for day, r in data.get("activity", {}).items()}
+            # до формата 10 — без отпечатка
+            self.requests = {r[0]: (tuple(r[1:]) + (None,))[:4] for r in data.get("requests", [])}
+            self.next_user_id = data["next_user_id"]
+            self.next_payment_id = data["next_payment_id"]
+            self.changes = self.saved_changes = 0
+
+    def _snapshot_loop(self):
+        while not self._stop.wait(self.snapshot_sec):
+            if self.changes != self.saved_changes:
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    print(f"⚠️ storage snapshot failed: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self.snapshot_path and self.changes != self.saved_changes:
+            info = self.snapshot()
+            print(f"💾 storage snapshot {info['path']}: {info['users']} users, {info['ms']} ms")
+
+
+def create_storage(connect, backend: str = None, snapshot_path: str = None, read=None) -> Storage:
+    """Движок по STORAGE_BACKEND; connect / read — фабрики соединений SQLite (app.get_db / app.read_db)"""
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return SQLiteStorage(connect, read)
+    if backend == "memory":
+        return MemoryStorage(snapshot_path or STORAGE_SNAPSHOT_PATH or None)
+    raise StorageError(f"unknown STORAGE_BACKEND {backend!r} (sqlite | memory)")